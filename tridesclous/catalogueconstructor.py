@@ -19,6 +19,7 @@ from pprint import pprint
 
 import numpy as np
 import scipy.signal
+import joblib
 import scipy.interpolate
 import seaborn as sns
 sns.set_style("white")
@@ -32,7 +33,7 @@ from . import decomposition
 from . import cluster 
 from . import metrics
 
-from .tools import median_mad, get_pairs_over_threshold, int32_to_rgba, rgba_to_int32, make_color_dict
+from .tools import median_mad, median_mad_approx, get_pairs_over_threshold, int32_to_rgba, rgba_to_int32, make_color_dict, run_units_in_parallel
 from . import cleancluster
 
 
@@ -53,7 +54,7 @@ _persistent_metrics = ('spike_waveforms_similarity', 'cluster_similarity',
 _centroids_arrays = ('centroids_median', 'centroids_mad', 'centroids_mean', 'centroids_std', 'centroids_sparse_mask', )
 
 
-_reset_after_peak_sampler = ('some_features', 'channel_to_features', 'some_noise_snippet',
+_reset_after_peak_sampler = ('some_features', 'channel_to_features', 'feature_projections', 'some_noise_snippet',
                 'some_noise_index', 'some_noise_features',) + _persistent_metrics + _centroids_arrays
 
 #~ _reset_after_peak_arrays = ('some_peaks_index', 'some_waveforms', 'some_features',
@@ -66,12 +67,15 @@ _reset_after_peak_arrays = ('some_peaks_index', ) + _reset_after_peak_sampler
 
 
 
-_persitent_arrays = ('all_peaks', 'signals_medians','signals_mads', 'clusters') + \
+_persitent_arrays = ('all_peaks', 'signals_medians','signals_mads', 'clusters', 'peak_candidates') + \
                 _reset_after_peak_arrays
 
 
 _dtype_peak = [('index', 'int64'), ('cluster_label', 'int64'), ('channel', 'int64'),  ('segment', 'int64'), ('extremum_amplitude', 'float64'),]
 
+_dtype_peak_candidate = [('index', 'int64'), ('channel', 'int64'),  ('segment', 'int64'), ('extremum_amplitude', 'float64'),
+                        ('n_span_max', 'int64')]
+
 
 _dtype_cluster = [('cluster_label', 'int64'), ('cell_label', 'int64'), 
             ('extremum_channel', 'int64'), ('extremum_amplitude', 'float64'),
@@ -227,6 +231,9 @@ class CatalogueConstructor:
             self.memory_mode='memmap'
         
         self.projector = None
+        if self.info.get('feature_method', None) == 'pca_by_channel' and self.feature_projections is not None:
+            # fitted projections are cached so the projector is back
+            self.projector = decomposition.PcaByChannel.from_projections(self.feature_projections, self.info['internal_dtype'])
     
     def flush_info(self):
         """ Flush info (mainly parameters) to json files.
@@ -389,6 +396,8 @@ class CatalogueConstructor:
             lowpass_freq=None,
             smooth_size=0,
             common_ref_removal=False,
+            common_ref_mode='median',
+            common_ref_groups=None,
             
             lostfront_chunksize=None,
             
@@ -417,6 +426,12 @@ class CatalogueConstructor:
             like a low pass filter. Can be use instead lowpass_freq.
         common_ref_removal: bool. False by dfault.
             The remove the median of all channel sample by sample.
+        common_ref_mode: 'median' or 'mean'. 'median' by default.
+            Estimator of the common reference.
+        common_ref_groups: None, 'shank' or list of list of channel index.
+            None is one reference for all channels. 'shank' make groups of channels
+            with the geometry (see signalpreprocessor.make_common_ref_groups) so each shank
+            has its own reference.
         lostfront_chunksize: int. default None
             size in sample of the margin at the front edge for each chunk to avoid border effect in backward filter.
             In you don't known put None then lostfront_chunksize will be int(sample_rate/highpass_freq)*3 which is quite robust (<5% error)
@@ -431,15 +446,25 @@ class CatalogueConstructor:
             assert highpass_freq is not None, 'lostfront_chunksize=None needs a highpass_freq'
             lostfront_chunksize = int(self.dataio.sample_rate/highpass_freq*3)
         
+        if isinstance(common_ref_groups, str):
+            assert common_ref_groups == 'shank'
+            geometry = self.dataio.get_geometry(chan_grp=self.chan_grp)
+            common_ref_groups = signalpreprocessor.make_common_ref_groups(geometry)
+        elif common_ref_groups is not None:
+            common_ref_groups = [[int(c) for c in group] for group in common_ref_groups]
+        
         self.signal_preprocessor_params = dict(highpass_freq=highpass_freq, lowpass_freq=lowpass_freq, 
                         smooth_size=smooth_size, common_ref_removal=common_ref_removal,
+                        common_ref_mode=common_ref_mode, common_ref_groups=common_ref_groups,
                         lostfront_chunksize=lostfront_chunksize, output_dtype=self.internal_dtype,
                         engine=engine)
         SignalPreprocessor_class = signalpreprocessor.signalpreprocessor_engines[engine]
         self.signalpreprocessor = SignalPreprocessor_class(self.dataio.sample_rate, self.nb_channel, self.chunksize, self.dataio.source_dtype)
         
         for i in range(self.dataio.nb_segment):
-            self.dataio.reset_processed_signals(seg_num=i, chan_grp=self.chan_grp, dtype=self.internal_dtype)
+            self.dataio.reset_processed_signals(seg_num=i, chan_grp=self.chan_grp, dtype=self.internal_dtype, chunksize=self.chunksize)
+        
+        self._reset_peak_candidates()
         
         # put all params in info
         self.info['signal_preprocessor_params'] = self.signal_preprocessor_params
@@ -490,7 +515,7 @@ class CatalogueConstructor:
         self.info['peak_detector_params'] = self.peak_detector_params
         self.flush_info()
     
-    def estimate_signals_noise(self, seg_num=0, duration=10.):
+    def estimate_signals_noise(self, seg_num=0, duration=10., method='exact', nbins=4096, seed=None):
         """
         This estimate the median and mad on processed signals on 
         a short duration. This will be necessary for normalisation
@@ -501,11 +526,27 @@ class CatalogueConstructor:
         Parameters
         ----------
         seg_num: int
-            segment index
+            segment index (only for method='exact')
         duration: float
             duration in seconds
+        method: 'exact' or 'streaming'
+            'exact' filter the first duration of seg_num in a temporary file and then compute the
+            true median and mad.
+            'streaming' filter blocks taken at random positions across all segments (total duration)
+            and accumulate them in per channel histograms (bounded memory, no file, one pass).
+            Precision is about 1% of mad. Blocks are smaller for short segments and 'exact' is used
+            when segments are too short for the filter warmup.
+        nbins: int
+            Number of bins of histograms for 'streaming'.
+        seed: int or None
+            Random seed for block positions of 'streaming'.
         
         """
+        if method == 'streaming':
+            self._estimate_signals_noise_streaming(duration, nbins=nbins, seed=seed)
+            return
+        assert method == 'exact', 'method must be exact or streaming'
+        
         length = int(duration*self.dataio.sample_rate)
         length -= length%self.chunksize
         
@@ -536,6 +577,63 @@ class CatalogueConstructor:
         
         #detach filetered signals even if the file remains.
         self.arrays.detach_array(name)
+    
+    def _estimate_signals_noise_streaming(self, duration, nbins=4096, seed=None):
+        params2 = dict(self.signal_preprocessor_params)
+        params2.pop('engine')
+        params2['normalize'] = False
+        self.signalpreprocessor.change_params(**params2)
+        
+        lostfront_chunksize = self.signalpreprocessor.lostfront_chunksize
+        # each block is preceded by some chunks to warm up filters
+        n_warmup_chunk = int(np.ceil(3 * lostfront_chunksize / self.chunksize)) + 1
+        warmup_size = n_warmup_chunk * self.chunksize
+        
+        # block of 16 chunks or smaller when segments are short
+        seg_lengths = np.array([self.dataio.get_segment_length(seg_num) for seg_num in range(self.dataio.nb_segment)])
+        n_chunk = (np.max(seg_lengths) - warmup_size - lostfront_chunksize) // self.chunksize
+        if n_chunk < 1:
+            # not even one chunk after the warmup : the exact method on the longest segment
+            seg_num = int(np.argmax(seg_lengths))
+            duration = min(duration, (seg_lengths[seg_num] - 1) / self.dataio.sample_rate)
+            self.estimate_signals_noise(seg_num=seg_num, duration=duration, method='exact')
+            return
+        block_size = self.chunksize * int(min(16, n_chunk))
+        read_size = warmup_size + block_size + lostfront_chunksize
+        
+        # random block positions across segments (proportional to segment length)
+        possible = np.maximum(seg_lengths - read_size + 1, 0)
+        n_block = max(1, int(np.ceil(duration * self.dataio.sample_rate / block_size)))
+        rng = np.random.RandomState(seed)
+        seg_nums = rng.choice(self.dataio.nb_segment, size=n_block, p=possible/np.sum(possible))
+        starts = (rng.rand(n_block) * possible[seg_nums]).astype('int64')
+        order = np.lexsort((starts, seg_nums))
+        
+        def iter_noise_blocks():
+            for seg_num, i_start in zip(seg_nums[order], starts[order]):
+                self.signalpreprocessor.reset_fifo_index()
+                iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=self.chan_grp, chunksize=self.chunksize,
+                                        i_start=i_start, i_stop=i_start + read_size, signal_type='initial')
+                for pos, sigs_chunk in iterator:
+                    pos2, preprocessed_chunk = self.signalpreprocessor.process_data(pos, sigs_chunk)
+                    if preprocessed_chunk is None or pos2 <= i_start + warmup_size:
+                        continue
+                    yield preprocessed_chunk
+        
+        # histogram range is set from the first block : median +- 40 mad
+        blocks = iter_noise_blocks()
+        first_blocks = list(itertools.islice(blocks, block_size // self.chunksize))
+        med0, mad0 = median_mad(np.concatenate(first_blocks), axis=0)
+        mad0 = np.maximum(mad0, 1e-6)
+        value_range = (med0 - 40 * mad0, med0 + 40 * mad0)
+        all_blocks = itertools.chain(first_blocks, blocks)
+        signals_medians, signals_mads = median_mad_approx(all_blocks, nbins=nbins, value_range=value_range)
+        
+        #create  persistant arrays
+        self.arrays.create_array('signals_medians', self.info['internal_dtype'], (self.nb_channel,), 'memmap')
+        self.arrays.create_array('signals_mads', self.info['internal_dtype'], (self.nb_channel,), 'memmap')
+        self.signals_medians[:] = signals_medians
+        self.signals_mads[:] = signals_mads
         
 
     #~ def signalprocessor_one_chunk(self, pos, sigs_chunk, seg_num, detect_peak=True):
@@ -565,7 +663,36 @@ class CatalogueConstructor:
         
     
     
-    def run_signalprocessor_loop_one_segment(self, seg_num=0, duration=60., detect_peak=True):
+    def _make_processing_engines(self):
+        """
+        Re create signalpreprocessor and peakdetector from info without reseting arrays.
+        This is used when the CatalogueConstructor is re-open in a worker process.
+        """
+        self.signal_preprocessor_params = dict(self.info['signal_preprocessor_params'])
+        engine = self.signal_preprocessor_params['engine']
+        SignalPreprocessor_class = signalpreprocessor.signalpreprocessor_engines[engine]
+        self.signalpreprocessor = SignalPreprocessor_class(self.dataio.sample_rate, self.nb_channel, self.chunksize, self.dataio.source_dtype)
+        
+        if 'peak_detector_params' in self.info and len(self.info['peak_detector_params'])>0:
+            self.peak_detector_params = dict(self.info['peak_detector_params'])
+            PeakDetector_class = peakdetector.get_peak_detector_class(self.peak_detector_params['method'], self.peak_detector_params['engine'])
+            geometry = self.dataio.get_geometry(self.chan_grp)
+            self.peakdetector = PeakDetector_class(self.dataio.sample_rate, self.nb_channel,
+                                                            self.chunksize, self.internal_dtype, geometry)
+            p = dict(self.peak_detector_params)
+            p.pop('engine')
+            p.pop('method')
+            self.peakdetector.change_params(**p)
+    
+    def run_signalprocessor_loop_one_segment(self, seg_num=0, duration=60., detect_peak=True, return_peaks=False, prefetch=0):
+        """
+        Run the preprocessing chain and the peak detection on one segment.
+        
+        If return_peaks=True, peaks are returned instead of being appended to all_peaks.
+        prefetch>0 read the next chunks in a background thread (see DataIO.iter_over_chunk).
+        """
+        if return_peaks:
+            seg_peaks = []
         
         if detect_peak:
             assert 'peak_detector_params' in self.info
@@ -590,7 +717,7 @@ class CatalogueConstructor:
         iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=self.chan_grp,
                         chunksize=self.chunksize, i_stop=length, signal_type='initial',
                         pad_width=self.info['signal_preprocessor_params']['lostfront_chunksize'],
-                        with_last_chunk=True)
+                        with_last_chunk=True, prefetch=prefetch)
         for pos, sigs_chunk in iterator:
             #~ print(seg_num, pos, sigs_chunk.shape)
             #~ self.signalprocessor_one_chunk(pos, sigs_chunk, seg_num, detect_peak=detect_peak)
@@ -619,7 +746,10 @@ class CatalogueConstructor:
                         peaks['extremum_amplitude'][:] = 0.
                     else:
                         peaks['extremum_amplitude'][:] = peak_val_peaks
-                    self.arrays.append_chunk('all_peaks',  peaks)
+                    if return_peaks:
+                        seg_peaks.append(peaks)
+                    else:
+                        self.arrays.append_chunk('all_peaks',  peaks)
 
             if pos2>length:
                 # clip writting
@@ -630,9 +760,15 @@ class CatalogueConstructor:
                             i_start=pos2-preprocessed_chunk.shape[0], i_stop=pos2, signal_type='processed')
         
         self.dataio.flush_processed_signals(seg_num=seg_num, chan_grp=self.chan_grp, processed_length=int(pos2))
+        
+        if return_peaks:
+            if len(seg_peaks) > 0:
+                return np.concatenate(seg_peaks)
+            else:
+                return np.zeros(0, dtype=_dtype_peak)
     
     
-    def run_signalprocessor(self, duration=60., detect_peak=True):
+    def run_signalprocessor(self, duration=60., detect_peak=True, n_jobs=1, prefetch=0):
         """
         this run (chunk by chunk), the signal preprocessing chain on
         all segments.
@@ -651,8 +787,18 @@ class CatalogueConstructor:
             total duration in seconds for all segment
         detect_peak: bool (default True)
             Also detect peak.
+        n_jobs: int (default 1)
+            When n_jobs!=1 segments are processed in parallel processes (-1 is all cores).
+            The result is the same as n_jobs=1. Not possible with memory_mode='ram'.
+        prefetch: int (default 0)
+            When n_jobs==1, number of chunks read in advance by a background thread.
         
         """
+        if n_jobs != 1 and self.memory_mode == 'memmap':
+            run_signalprocessor_parallel([self], duration=duration, detect_peak=detect_peak, n_jobs=n_jobs)
+            return
+        
+        self._reset_peak_candidates()
         self.arrays.initialize_array('all_peaks', self.memory_mode,  _dtype_peak, (-1, ))
         
         #~ duration_per_segment = []
@@ -670,7 +816,8 @@ class CatalogueConstructor:
         duration_per_segment = self.dataio.get_duration_per_segments(duration)
         #~ print(duration_per_segment)
         for seg_num in range(self.dataio.nb_segment):
-            self.run_signalprocessor_loop_one_segment(seg_num=seg_num, duration=duration_per_segment[seg_num], detect_peak=detect_peak)
+            self.run_signalprocessor_loop_one_segment(seg_num=seg_num, duration=duration_per_segment[seg_num],
+                            detect_peak=detect_peak, prefetch=prefetch)
         
         # flush peaks
         self.arrays.finalize_array('all_peaks')
@@ -698,11 +845,22 @@ class CatalogueConstructor:
         peak_span_ms: float default 0.3
             Peak span to avoid double detection. In second.
         
+        If cache_peak_candidates() was run before with compatible params ('geometrical' method,
+        same peak_sign/adjacency_radius_um/smooth_radius_um, higher relative_threshold
+        and smaller peak_span_ms) peaks are only filtered from the candidates table
+        and the processed signals are not read again.
         """
         self.set_peak_detector_params(**kargs)
         
         self.arrays.initialize_array('all_peaks', self.memory_mode,  _dtype_peak, (-1, ))
         
+        if self.can_re_detect_from_candidates():
+            self._re_detect_peak_from_candidates()
+            self.arrays.finalize_array('all_peaks')
+            self._reset_arrays(_reset_after_peak_arrays)
+            self.on_new_cluster()
+            return
+        
         for seg_num in range(self.dataio.nb_segment):
             
             self.peakdetector.reset_fifo_index()
@@ -738,6 +896,124 @@ class CatalogueConstructor:
         self.on_new_cluster()
     
     
+    def cache_peak_candidates(self, min_relative_threshold=None, max_peak_span_ms=None):
+        """
+        Detect once all spatiotemporal local extrema ('geometrical' method) of the processed signals
+        at the lowest threshold of interest and keep for each one the largest span for which
+        it is still a peak. Then re_detect_peak() at any higher threshold or with a smaller
+        span is an in-memory filter on this table instead of a pass over the signals.
+        
+        The current peak detector params (peak_sign, adjacency_radius_um, smooth_radius_um)
+        are used. With another method nothing is done.
+        
+        Parameters
+        ----------
+        min_relative_threshold: float or None
+            Lowest threshold of interest. None is the current relative_threshold.
+        max_peak_span_ms: float or None
+            Largest peak_span_ms of interest. None is 4 times the current peak_span_ms.
+        """
+        p = dict(self.info['peak_detector_params'])
+        if p['method'] != 'geometrical':
+            print('WARNING : cache_peak_candidates is only for geometrical method, nothing is cached')
+            return
+        
+        if min_relative_threshold is None:
+            min_relative_threshold = p['relative_threshold']
+        if max_peak_span_ms is None:
+            max_peak_span_ms = p['peak_span_ms'] * 4
+        adjacency_radius_um = p['adjacency_radius_um']
+        if adjacency_radius_um is None:
+            # this is the default of geometrical detector
+            adjacency_radius_um = 200.
+        
+        # used only for neighbours, smooth kernel and n_span
+        geometry = self.dataio.get_geometry(self.chan_grp)
+        detector = peakdetector.PeakDetectorGeometricalNumpy(self.dataio.sample_rate, self.nb_channel,
+                                                        self.chunksize, self.internal_dtype, geometry)
+        detector.change_params(peak_sign=p['peak_sign'], relative_threshold=min_relative_threshold,
+                    peak_span_ms=max_peak_span_ms, adjacency_radius_um=adjacency_radius_um,
+                    smooth_radius_um=p['smooth_radius_um'])
+        max_n_span = detector.n_span
+        sign = 1. if p['peak_sign'] == '+' else -1.
+        
+        chunksize = self.info['chunksize']
+        self.arrays.initialize_array('peak_candidates', self.memory_mode,  _dtype_peak_candidate, (-1, ))
+        for seg_num in range(self.dataio.nb_segment):
+            # same limit as a scan with iter_over_chunk
+            i_stop = self.dataio.get_processed_length(seg_num=seg_num, chan_grp=self.chan_grp)
+            i_stop = i_stop - i_stop % chunksize
+            
+            for i0 in range(0, i_stop, chunksize):
+                i1 = i0 + chunksize
+                # margin of max_n_span on each side
+                # zeros before start (like the detector fifo) and +inf after the end so no peak can use it
+                j0, j1 = max(0, i0 - max_n_span), min(i_stop, i1 + max_n_span)
+                sigs = self.dataio.get_signals_chunk(seg_num=seg_num, chan_grp=self.chan_grp,
+                                i_start=j0, i_stop=j1, signal_type='processed')
+                if detector.spatial_smooth_kernel is not None:
+                    sigs = np.dot(sigs, detector.spatial_smooth_kernel)
+                block = np.zeros((chunksize + 2 * max_n_span, self.nb_channel), dtype=sigs.dtype)
+                block[j0 - i0 + max_n_span:j1 - i0 + max_n_span] = sigs * sign
+                block[j1 - i0 + max_n_span:] = np.inf
+                
+                mask = peakdetector.get_mask_spatiotemporal_peaks(block[max_n_span-1:max_n_span+chunksize+1], 1,
+                                    min_relative_threshold, '+', detector.neighbours)
+                time_ind, chan_ind = np.nonzero(mask)
+                if time_ind.size == 0:
+                    continue
+                time_ind += max_n_span
+                
+                candidates = np.zeros(time_ind.size, dtype=_dtype_peak_candidate)
+                candidates['index'] = time_ind - max_n_span + i0
+                candidates['channel'] = chan_ind
+                candidates['segment'] = seg_num
+                candidates['extremum_amplitude'] = block[time_ind, chan_ind] * sign
+                candidates['n_span_max'] = peakdetector.get_spatiotemporal_peak_span(block, time_ind, chan_ind,
+                                                    detector.neighbours, max_n_span)
+                self.arrays.append_chunk('peak_candidates',  candidates)
+        
+        self.arrays.finalize_array('peak_candidates')
+        
+        self.info['peak_candidates_params'] = dict(peak_sign=p['peak_sign'], adjacency_radius_um=p['adjacency_radius_um'],
+                    smooth_radius_um=p['smooth_radius_um'], min_relative_threshold=min_relative_threshold,
+                    max_n_span=max_n_span)
+        self.flush_info()
+    
+    def _reset_peak_candidates(self):
+        # candidates are no more valid when processed signals change
+        self._reset_arrays(('peak_candidates', ))
+        self.info.pop('peak_candidates_params', None)
+    
+    def can_re_detect_from_candidates(self):
+        if self.peak_candidates is None or 'peak_candidates_params' not in self.info:
+            return False
+        cp = self.info['peak_candidates_params']
+        p = self.peak_detector_params
+        if p['method'] != 'geometrical':
+            return False
+        for k in ('peak_sign', 'adjacency_radius_um', 'smooth_radius_um'):
+            if p[k] != cp[k]:
+                return False
+        return p['relative_threshold'] >= cp['min_relative_threshold'] and self.peakdetector.n_span <= cp['max_n_span']
+    
+    def _re_detect_peak_from_candidates(self):
+        candidates = self.peak_candidates
+        thresh = self.peak_detector_params['relative_threshold']
+        if self.peak_detector_params['peak_sign'] == '+':
+            keep = candidates['extremum_amplitude'] > thresh
+        else:
+            keep = candidates['extremum_amplitude'] < -thresh
+        keep &= candidates['n_span_max'] >= self.peakdetector.n_span
+        candidates = candidates[keep]
+        
+        peaks = np.zeros(candidates.size, dtype=_dtype_peak)
+        for k in ('index', 'channel', 'segment', 'extremum_amplitude'):
+            peaks[k] = candidates[k]
+        peaks['cluster_label'][:] = labelcodes.LABEL_NO_WAVEFORM
+        if peaks.size > 0:
+            self.arrays.append_chunk('all_peaks',  peaks)
+    
     def set_waveform_extractor_params(self, n_left=None, n_right=None,
                             wf_left_ms=None, wf_right_ms=None):
         if n_left is None or n_right is None:
@@ -1202,13 +1478,18 @@ class CatalogueConstructor:
         features, channel_to_features, self.projector = decomposition.project_waveforms(catalogueconstructor=self,method=method, selection=selection, **params)
         
         if features is None:
-            for name in ['some_features', 'channel_to_features', 'some_noise_features']:
+            for name in ['some_features', 'channel_to_features', 'feature_projections', 'some_noise_features']:
                 self.arrays.detach_array(name)
                 setattr(self, name, None)            
         else:
             # make it persistant
             self.arrays.add_array('some_features', features.astype(self.info['internal_dtype']), self.memory_mode)
             self.arrays.add_array('channel_to_features', channel_to_features, self.memory_mode)
+            if hasattr(self.projector, 'projections'):
+                self.arrays.add_array('feature_projections', self.projector.projections, self.memory_mode)
+            else:
+                self.arrays.detach_array('feature_projections')
+                self.feature_projections = None
             
             if self.some_noise_snippet is not None:
                 some_noise_features = self.projector.transform(self.some_noise_snippet)
@@ -1247,7 +1528,7 @@ class CatalogueConstructor:
         
         if selection is None:
             self.on_new_cluster()
-            self.compute_all_centroid(n_spike_for_centroid=self.n_spike_for_centroid)
+            self.compute_all_centroid(n_spike_for_centroid=self.n_spike_for_centroid, n_jobs=self.n_jobs)
             
             if order:
                 self.order_clusters(by='waveforms_rms')
@@ -1382,29 +1663,25 @@ class CatalogueConstructor:
             mask |= self.all_peaks['cluster_label']== k
         self.change_spike_label(mask, labelcodes.LABEL_TRASH)
     
-    def compute_one_centroid(self, k, flush=True, n_spike_for_centroid=None):
-        #~ t1 = time.perf_counter()
+    def _select_peaks_for_centroid(self, k, n_spike_for_centroid=None):
         if n_spike_for_centroid is None:
             n_spike_for_centroid = self.n_spike_for_centroid
-        
-        ind = self.index_of_label(k)
-        
-        n_left = int(self.info['waveform_extractor_params']['n_left'])
-        peak_sign = self.info['peak_detector_params']['peak_sign']
-        
-        
         selected, = np.nonzero(self.all_peaks['cluster_label'][self.some_peaks_index]==k)
         if selected.size>n_spike_for_centroid:
             keep = np.random.choice(selected.size, n_spike_for_centroid, replace=False)
             selected = selected[keep]
         
-        #~ wf = self.some_waveforms[self.all_peaks['cluster_label'][self.some_peaks_index]==k]
-        #~ wf = self.some_waveforms[selected, :, :]
-        wf = self.get_some_waveforms(peaks_index=self.some_peaks_index[selected], channel_indexes=None)
-        
+        # sorted like in get_some_waveforms()
+        peaks_index = np.sort(self.some_peaks_index[selected])
+        seg_nums = self.all_peaks['segment'][peaks_index]
+        peak_sample_indexes = self.all_peaks['index'][peaks_index]
+        return seg_nums, peak_sample_indexes
+    
+    def _set_one_centroid(self, k, median, mad):
+        ind = self.index_of_label(k)
+        n_left = int(self.info['waveform_extractor_params']['n_left'])
+        peak_sign = self.info['peak_detector_params']['peak_sign']
         
-        median, mad = median_mad(wf, axis = 0)
-        # mean, std = np.mean(wf, axis=0), np.std(wf, axis=0) # TODO rome the mean/std
         if peak_sign == '-':
             extremum_channel = np.argmin(median[-n_left,:], axis=0)
         elif peak_sign == '+':
@@ -1424,6 +1701,25 @@ class CatalogueConstructor:
         self.clusters['extremum_channel'][ind] = extremum_channel
         self.clusters['extremum_amplitude'][ind] = median[-n_left, extremum_channel]
         self.clusters['waveform_rms'][ind] = np.sqrt(np.mean(median**2))
+    
+    def compute_one_centroid(self, k, flush=True, n_spike_for_centroid=None, median_method='exact'):
+        """
+        Compute median and mad of one cluster on (at most) n_spike_for_centroid waveforms.
+        
+        median_method: 'exact' or 'approx'
+            'approx' read waveforms by blocks and use median_mad_approx() so the memory
+            is bounded for clusters with huge spike counts.
+        """
+        #~ t1 = time.perf_counter()
+        seg_nums, peak_sample_indexes = self._select_peaks_for_centroid(k, n_spike_for_centroid)
+        n_left = int(self.info['waveform_extractor_params']['n_left'])
+        n_right = int(self.info['waveform_extractor_params']['n_right'])
+        
+        median, mad = _centroid_median_mad(self.dataio, self.chan_grp, seg_nums, peak_sample_indexes,
+                                                    n_left, n_right, median_method)
+        # mean, std = np.mean(wf, axis=0), np.std(wf, axis=0) # TODO rome the mean/std
+        
+        self._set_one_centroid(k, median, mad)
 
         if flush:
             for name in ('clusters',) + _centroids_arrays:
@@ -1432,17 +1728,45 @@ class CatalogueConstructor:
         #~ t2 = time.perf_counter()
         #~ print('compute_one_centroid',k, t2-t1)
     
-    def compute_several_centroids(self, labels, n_spike_for_centroid=None):
-        # TODO make this in paralell
-        for k in labels:
-            self.compute_one_centroid(k, flush=False, n_spike_for_centroid=n_spike_for_centroid)
+    def compute_several_centroids(self, labels, n_spike_for_centroid=None, n_jobs=1, median_method='exact'):
+        """
+        Compute centroids for several labels.
+        
+        n_jobs: int (default 1)
+            When n_jobs!=1, labels are dispatched in worker processes that read waveforms
+            from the processed_signals of the DataIO. -1 is all cores.
+            The spike selection is done here so the result is the same as n_jobs=1.
+        median_method: 'exact' or 'approx'
+            See compute_one_centroid()
+        """
+        if n_jobs < 0:
+            n_jobs = max(1, joblib.cpu_count() + 1 + n_jobs)
+        
+        if n_jobs == 1 or len(labels) <= 1:
+            for k in labels:
+                self.compute_one_centroid(k, flush=False, n_spike_for_centroid=n_spike_for_centroid,
+                                    median_method=median_method)
+        else:
+            n_left = int(self.info['waveform_extractor_params']['n_left'])
+            n_right = int(self.info['waveform_extractor_params']['n_right'])
+            all_selections = [self._select_peaks_for_centroid(k, n_spike_for_centroid) for k in labels]
+            # one batch of labels per worker so each one open the DataIO only once
+            n_jobs = min(n_jobs, len(labels))
+            batches = [all_selections[i::n_jobs] for i in range(n_jobs)]
+            units_args = [(self.dataio.dirname, self.chan_grp, batch, n_left, n_right, median_method)
+                                        for batch in batches]
+            results = run_units_in_parallel(_compute_some_centroids, units_args, n_jobs=n_jobs,
+                                        progressbar=False, desc='centroids')
+            for i, k in enumerate(labels):
+                median, mad = results[i % n_jobs][i // n_jobs]
+                self._set_one_centroid(k, median, mad)
         
         # one global flush
         for name in ('clusters',) + _centroids_arrays:
             self.arrays.flush_array(name)
         
     
-    def compute_all_centroid(self, n_spike_for_centroid=None):
+    def compute_all_centroid(self, n_spike_for_centroid=None, n_jobs=1, median_method='exact'):
         t1 = time.perf_counter()
         #~ if self.some_waveforms is None:
         if self.some_peaks_index is None:
@@ -1462,7 +1786,8 @@ class CatalogueConstructor:
         mask = np.zeros((self.cluster_labels.size, self.nb_channel), dtype='bool')
         self.arrays.add_array('centroids_sparse_mask', mask, self.memory_mode)
         
-        self.compute_several_centroids(self.positive_cluster_labels, n_spike_for_centroid=n_spike_for_centroid)
+        self.compute_several_centroids(self.positive_cluster_labels, n_spike_for_centroid=n_spike_for_centroid,
+                                    n_jobs=n_jobs, median_method=median_method)
     
     def get_one_centroid(self, label, metric='median'):
         ind = self.index_of_label(label)
@@ -1590,7 +1915,58 @@ class CatalogueConstructor:
 
         #~ return self.spike_waveforms_similarity
 
-    def compute_cluster_similarity(self, method='cosine_similarity_with_max'):
+    def _compute_similarity_incremental(self, name, wfs, sparse_mask=None):
+        """
+        cosine_similarity_with_max between all wfs with only changed rows recomputed.
+        
+        Rows are identified by the content of wfs (and sparse_mask) so after a split
+        or a merge only rows of new or modified centroids are computed, the others
+        are taken from the previous matrix (kept in memory, a reload recompute all).
+        """
+        keys = []
+        for i in range(wfs.shape[0]):
+            key = wfs[i].tobytes()
+            if sparse_mask is not None:
+                key += sparse_mask[i].tobytes()
+            keys.append(hash(key))
+        
+        if not hasattr(self, '_similarity_keys'):
+            self._similarity_keys = {}
+        
+        nb = wfs.shape[0]
+        similarity = np.zeros((nb, nb), dtype='float32')
+        
+        old_similarity = getattr(self, name)
+        old_keys = self._similarity_keys.get(name, None)
+        reuse_new, reuse_old = [], []
+        if old_keys is not None and old_similarity is not None and old_similarity.shape[0] == len(old_keys):
+            old_pos = {key: i for i, key in enumerate(old_keys)}
+            for i, key in enumerate(keys):
+                if key in old_pos:
+                    reuse_new.append(i)
+                    reuse_old.append(old_pos[key])
+            reuse_new = np.array(reuse_new, dtype='int64')
+            reuse_old = np.array(reuse_old, dtype='int64')
+            similarity[np.ix_(reuse_new, reuse_new)] = old_similarity[np.ix_(reuse_old, reuse_old)]
+        
+        rows = np.setdiff1d(np.arange(nb), reuse_new)
+        if rows.size > 0:
+            sim_rows = metrics.cosine_similarity_with_max(wfs, rows=rows, sparse_mask=sparse_mask)
+            similarity[rows, :] = sim_rows
+            similarity[:, rows] = sim_rows.T
+        
+        self._similarity_keys[name] = keys
+        
+        return similarity
+
+    def compute_cluster_similarity(self, method='cosine_similarity_with_max', sparse=False):
+        """
+        sparse: bool (default False)
+            If True each pair is restricted to the union of their centroids_sparse_mask.
+            This is opt-in because it change the similarity values (and so auto merge).
+        
+        Only rows of new or modified centroids are recomputed (see _compute_similarity_incremental).
+        """
         if self.centroids_median is None:
             self.compute_all_centroid()
         
@@ -1600,12 +1976,13 @@ class CatalogueConstructor:
         mask = labels>=0
         
         wfs = self.centroids_median[mask, :,  :]
-        wfs = wfs.reshape(wfs.shape[0], -1)
         
         if wfs.size == 0:
             cluster_similarity = None
         else:
-            cluster_similarity = metrics.cosine_similarity_with_max(wfs)
+            assert method == 'cosine_similarity_with_max'
+            sparse_mask = self.centroids_sparse_mask[mask, :] if sparse else None
+            cluster_similarity = self._compute_similarity_incremental('cluster_similarity', wfs, sparse_mask=sparse_mask)
 
         if cluster_similarity is None:
             self.arrays.detach_array('cluster_similarity')
@@ -1639,7 +2016,10 @@ class CatalogueConstructor:
             already_merge[k2] = k1
             self.pop_labels_from_cluster([k2])
 
-    def compute_cluster_ratio_similarity(self, method='cosine_similarity_with_max'):
+    def compute_cluster_ratio_similarity(self, method='cosine_similarity_with_max', sparse=False):
+        """
+        Same as compute_cluster_similarity but on centroids normalized by their extremum.
+        """
         #~ print('compute_cluster_ratio_similarity')
         if self.centroids_median is None:
             self.compute_all_centroid()
@@ -1667,9 +2047,11 @@ class CatalogueConstructor:
         if wf_normed.size == 0:
             cluster_ratio_similarity = None
         else:
-            wf_normed_flat = wf_normed.swapaxes(1, 2).reshape(wf_normed.shape[0], -1)
+            #~ wf_normed_flat = wf_normed.swapaxes(1, 2).reshape(wf_normed.shape[0], -1)
             #~ cluster_ratio_similarity = metrics.compute_similarity(wf_normed_flat, 'cosine_similarity')
-            cluster_ratio_similarity = metrics.cosine_similarity_with_max(wf_normed_flat)
+            assert method == 'cosine_similarity_with_max'
+            sparse_mask = self.centroids_sparse_mask[self.cluster_labels>=0, :] if sparse else None
+            cluster_ratio_similarity = self._compute_similarity_incremental('cluster_ratio_similarity', wf_normed, sparse_mask=sparse_mask)
 
         if cluster_ratio_similarity is None:
             self.arrays.detach_array('cluster_ratio_similarity')
@@ -1690,17 +2072,51 @@ class CatalogueConstructor:
     
     
     
-    def compute_spike_silhouette(self, size_max=1e7):
+    def compute_spike_silhouette(self, size_max=1e7, method='exact', space='waveforms', n_spike_by_cluster=100, seed=None):
+        """
+        Silhouette of each spike of some_peaks_index.
+        
+        method: 'exact', 'subsample' or 'simplified'
+            * 'exact': sklearn.metrics.silhouette_samples, O(n**2), nothing is computed
+               when the data is bigger than size_max
+            * 'subsample': mean distances to at most n_spike_by_cluster spikes of each cluster
+            * 'simplified': distances to the mean of each cluster
+            For approximated methods the memory is bounded by size_max and the cost is linear.
+        space: 'waveforms' or 'features'
+            Waveforms are read by block from processed signals or some_features.
+        """
         #~ t1 = time.perf_counter()
         
         spike_silhouette = None
         #~ wf = self.some_waveforms
         if self.some_peaks_index is not None:
-            wf = self.get_some_waveforms(peaks_index=self.some_peaks_index)
-            wf = wf.reshape(wf.shape[0], -1)
             labels = self.all_peaks['cluster_label'][self.some_peaks_index]
-            if wf.size<size_max:
-                spike_silhouette = metrics.compute_silhouette(wf, labels, metric='euclidean')
+            
+            if space == 'waveforms':
+                def get_data(ind):
+                    # ind is sorted so waveforms come in the same order
+                    wf = self.get_some_waveforms(peaks_index=self.some_peaks_index[ind])
+                    return wf.reshape(wf.shape[0], -1)
+                n_left = self.info['waveform_extractor_params']['n_left']
+                n_right = self.info['waveform_extractor_params']['n_right']
+                data_size = labels.size * (n_right - n_left) * self.nb_channel
+            elif space == 'features':
+                assert self.some_features is not None, 'extract_some_features() before'
+                def get_data(ind):
+                    return self.some_features[ind, :]
+                data_size = self.some_features.size
+            else:
+                raise(NotImplementedError)
+            
+            if method == 'exact':
+                if data_size<size_max:
+                    data = get_data(np.arange(labels.size))
+                    spike_silhouette = metrics.compute_silhouette(data, labels, metric='euclidean')
+            elif method in ('subsample', 'simplified'):
+                spike_silhouette = metrics.compute_silhouette_approx(get_data, labels, method=method,
+                                n_spike_by_cluster=n_spike_by_cluster, size_max=size_max, seed=seed)
+            else:
+                raise(NotImplementedError)
 
         if spike_silhouette is None:
             self.arrays.detach_array('spike_silhouette')
@@ -2101,3 +2517,94 @@ class CatalogueConstructor:
         
         """
         apply_all_catalogue_steps(self, params, verbose=verbose)
+
+
+
+def _run_signalprocessor_one_segment(dirname, chan_grp, name, seg_num, duration, detect_peak):
+    # this run in a separated process with its own DataIO and CatalogueConstructor
+    from .dataio import DataIO
+    dataio = DataIO(dirname)
+    cc = CatalogueConstructor(dataio=dataio, chan_grp=chan_grp, name=name)
+    cc._make_processing_engines()
+    peaks = cc.run_signalprocessor_loop_one_segment(seg_num=seg_num, duration=duration, 
+                                    detect_peak=detect_peak, return_peaks=True)
+    return peaks
+
+
+def _centroid_median_mad(dataio, chan_grp, seg_nums, peak_sample_indexes, n_left, n_right, median_method):
+    if median_method == 'exact' or peak_sample_indexes.size == 0:
+        wf = dataio.get_some_waveforms(seg_nums=seg_nums, chan_grp=chan_grp, peak_sample_indexes=peak_sample_indexes,
+                                                n_left=n_left, n_right=n_right)
+        median, mad = median_mad(wf, axis = 0)
+    elif median_method == 'approx':
+        block_size = 1000
+        blocks = (dataio.get_some_waveforms(seg_nums=seg_nums[i:i+block_size], chan_grp=chan_grp,
+                            peak_sample_indexes=peak_sample_indexes[i:i+block_size], n_left=n_left, n_right=n_right)
+                        for i in range(0, peak_sample_indexes.size, block_size))
+        median, mad = median_mad_approx(blocks)
+    else:
+        raise(NotImplementedError)
+    return median, mad
+
+
+def _compute_some_centroids(dirname, chan_grp, selections, n_left, n_right, median_method):
+    # this run in a separated process with its own DataIO
+    # selections is a list of (seg_nums, peak_sample_indexes), one per label
+    from .dataio import DataIO
+    dataio = DataIO(dirname)
+    return [_centroid_median_mad(dataio, chan_grp, seg_nums, peak_sample_indexes, n_left, n_right, median_method)
+                                    for seg_nums, peak_sample_indexes in selections]
+
+
+def run_signalprocessor_parallel(catalogueconstructors, duration=60., detect_peak=True, n_jobs=-1, progressbar=True):
+    """
+    Run the signal processor for several CatalogueConstructor (typically one per channel group).
+    Each (chan_grp, seg_num) is an independent unit that is run in a pool of
+    worker processes. Peaks are then concatenated in the segment order so the 
+    result is the same as cc.run_signalprocessor() for each one.
+    
+    Parameters
+    ----------
+    catalogueconstructors: list of CatalogueConstructor
+        Must be in memory_mode='memmap' with preprocessor/peak detector params already set
+        and noise already estimated.
+    duration: float
+        total duration in seconds for all segment
+    detect_peak: bool (default True)
+        Also detect peak.
+    n_jobs: int
+        Number of worker processes. -1 is all cores.
+    progressbar: bool
+        Display tqdm progressbar (one step per unit).
+    """
+    units_args = []
+    for cc in catalogueconstructors:
+        assert cc.memory_mode == 'memmap', 'run_signalprocessor_parallel need memory_mode memmap'
+        cc._reset_peak_candidates()
+        if detect_peak:
+            assert 'peak_detector_params' in cc.info
+            assert len(cc.info['peak_detector_params'])>0
+        cc.flush_info()
+        for k in ('signals_medians', 'signals_mads'):
+            cc.arrays.flush_array(k)
+        name = os.path.basename(cc.catalogue_path)
+        duration_per_segment = cc.dataio.get_duration_per_segments(duration)
+        for seg_num in range(cc.dataio.nb_segment):
+            units_args.append((cc.dataio.dirname, cc.chan_grp, name, seg_num, duration_per_segment[seg_num], detect_peak))
+    
+    all_seg_peaks = run_units_in_parallel(_run_signalprocessor_one_segment, units_args, 
+                                    n_jobs=n_jobs, progressbar=progressbar, desc='signalprocessor')
+    
+    i = 0
+    for cc in catalogueconstructors:
+        cc.arrays.initialize_array('all_peaks', cc.memory_mode,  _dtype_peak, (-1, ))
+        for seg_num in range(cc.dataio.nb_segment):
+            # workers have written processed signals
+            cc.dataio.arrays[cc.chan_grp][seg_num].load_if_exists('processed_signals')
+            peaks = all_seg_peaks[i]
+            i += 1
+            if peaks.size > 0:
+                cc.arrays.append_chunk('all_peaks',  peaks)
+        cc.arrays.finalize_array('all_peaks')
+        cc._reset_arrays(_reset_after_peak_arrays)
+        cc.on_new_cluster()
@@ -167,3 +167,56 @@ def apply_all_catalogue_steps(catalogueconstructor, params, verbose=True):
         print('make_catalogue_for_peeler', t2-t1)
     
 
+
+
+def _apply_all_catalogue_steps_one_group(dirname, chan_grp, params, verbose):
+    # this run in a separated process with its own DataIO and CatalogueConstructor
+    from .dataio import DataIO
+    from .catalogueconstructor import CatalogueConstructor
+    dataio = DataIO(dirname)
+    cc = CatalogueConstructor(dataio=dataio, chan_grp=chan_grp)
+    apply_all_catalogue_steps(cc, params, verbose=verbose)
+    return chan_grp
+
+
+def apply_all_catalogue_steps_parallel(dataio, params, chan_grps=None, n_jobs=-1, callback=None, verbose=False):
+    """
+    Same as apply_all_catalogue_steps() for several channel groups, each group
+    is built in its own worker process.
+    
+    Each worker reopen the DataIO and write the catalogue on disk, so
+    CatalogueConstructor and catalogue must be (re)loaded from dataio after.
+    
+    params
+    -----
+    dataio: DataIO
+    params: dict of params (same for all groups)
+    chan_grps: list of chan_grp, None is all
+    n_jobs: max nb of worker process, -1 is all cores. Keep it small when other
+        real time stuff need CPU (OnlineWindow).
+    callback: None or callback(chan_grp) called as soon as one catalogue is ready
+    
+    returns
+    ----
+    chan_grps in the order they have been done
+    """
+    from .tools import run_units_in_parallel
+    if chan_grps is None:
+        chan_grps = list(dataio.channel_groups.keys())
+    
+    params = dict(params)
+    # parallel is done on groups : no nested pool in workers
+    params['n_jobs'] = 1
+    
+    units_args = [(dataio.dirname, chan_grp, params, verbose) for chan_grp in chan_grps]
+    
+    done = []
+    def on_unit_done(i, chan_grp):
+        done.append(chan_grp)
+        if callback is not None:
+            callback(chan_grp)
+    
+    run_units_in_parallel(_apply_all_catalogue_steps_one_group, units_args, n_jobs=n_jobs,
+                            progressbar=False, callback=on_unit_done)
+    
+    return done
@@ -10,6 +10,8 @@ import numpy as np
 import os
 import time
 
+import scipy.sparse
+import scipy.sparse.csgraph
 import sklearn
 import sklearn.cluster
 import sklearn.mixture
@@ -26,7 +28,7 @@ import matplotlib.pyplot as plt
 
 
 from .dip import diptest
-from .waveformtools import equal_template
+from .waveformtools import equal_template, equal_template_pairs
 
 
 import hdbscan
@@ -337,120 +339,83 @@ def auto_merge(catalogueconstructor,
                         maximum_shift=2,
                         amplitude_factor_thresh = 0.2,
         ):
+    """
+    Merge clusters whose centroids are equal (see waveformtools.equal_template)
+    for some shift.
+    
+    At each loop all centroids are stacked and all pairs are tested at once
+    with equal_template_pairs. Merges are then resolved as connected components :
+    all clusters of a component go to the smallest label of the component.
+    The loop stop when nothing is merged.
+    
+    Pairs with non overlapping sparse masks are not tested when the amplitude
+    outside the other mask make the merge impossible anyway.
+    """
     cc = catalogueconstructor
-    peak_sign = cc.info['peak_detector_params']['peak_sign']
-    #~ dense_mode = cc.info['mode'] == 'dense'
-    n_left = cc.info['waveform_extractor_params']['n_left']
-    n_right = cc.info['waveform_extractor_params']['n_right']
-    peak_width = n_right - n_left
-    threshold = cc.info['peak_detector_params']['relative_threshold']
+    n = maximum_shift
     
     while True:
         
         labels = cc.positive_cluster_labels.copy()
+        if labels.size < 2:
+            break
         
+        inds = np.array([cc.index_of_label(k) for k in labels], dtype='int64')
+        centroids = cc.centroids_median[inds, :, :]
+        extremum_amplitudes = np.abs(cc.clusters['extremum_amplitude'][inds])
         
-        nb_merge = 0
+        # mask are done on the centroid stack (same as centroids_sparse_mask)
+        sparse_mask = np.any(np.abs(centroids) > cc.sparse_threshold, axis=1)
         
-        n = labels.size
+        # max amplitude on the part of centroid common to all shifts
+        # on channels outside the other mask the difference is at least inner_ampl - sparse_threshold
+        inner_ampl = np.max(np.abs(centroids[:, 2*n:centroids.shape[1]-2*n, :]), axis=(1, 2))
         
-        #~ pop_from_centroids = []
-        new_centroids = []
-        pop_from_cluster = []
-        for i in range(n):
-            k1 = labels[i]
-            if k1 == -1:
-                # this can have been removed yet
-                continue
-            
-            for j in range(i+1, n):
-                k2 = labels[j]
-                if k2 == -1:
-                    # this can have been removed yet
-                    continue
-                
-                #~ print(k1, k2)
-                #~ print('  k2', k2)
-                
-                ind1 = cc.index_of_label(k1)
-                extremum_amplitude1 = np.abs(cc.clusters[ind1]['extremum_amplitude'])
-                centroid1 = cc.get_one_centroid(k1)
-
-                ind2 = cc.index_of_label(k2)
-                extremum_amplitude2 = np.abs(cc.clusters[ind2]['extremum_amplitude'])
-                centroid2 = cc.get_one_centroid(k2)
+        ind0, ind1 = np.triu_indices(labels.size, k=1)
         
-                thresh = max(extremum_amplitude1, extremum_amplitude2) * amplitude_factor_thresh
-                thresh = max(thresh, auto_merge_threshold)
-                #~ print('thresh', thresh)
-                
-                #~ t1 = time.perf_counter()
-                do_merge = equal_template(centroid1, centroid2, thresh=thresh, n_shift=maximum_shift)
-                #~ t2 = time.perf_counter()
-                #~ print('equal_template', t2-t1)
-                
-                #~ print('do_merge', do_merge)
-                
-                #~ if debug_plot:
-                #~ print(k1, k2)
-                #~ if k1==4  and k2==5:
-                    #~ print(k1, k2, do_merge, thresh)
-                    #~ fig, ax = plt.subplots()
-                    #~ ax.plot(centroid1.T.flatten())
-                    #~ ax.plot(centroid2.T.flatten())
-                    #~ ax.set_title('merge ' + str(do_merge))
-                    #~ plt.show()
-                
-                
-                
-                
-                if do_merge:
-                    #~ print('merge', k1, k2)
-                    #~ cluster_labels2[cluster_labels2==k2] = k1
-
-                    mask = cc.all_peaks['cluster_label'] == k2
-                    cc.all_peaks['cluster_label'][mask] = k1
-                    
-                    #~ t1 = time.perf_counter()
-                    #~ cc.compute_one_centroid(k1)
-                    #~ t2 = time.perf_counter()
-                    #~ print('cc.compute_one_centroid', t2-t1)
-                    
-                    new_centroids.append(k1)
-                    pop_from_cluster.append(k2)
-                    
-                    labels[j] = -1
-                    
-                    nb_merge += 1
-                    
-                    if debug_plot:
-                    
-                        fig, ax = plt.subplots()
-                        ax.plot(centroid1.T.flatten())
-                        ax.plot(centroid2.T.flatten())
-                        ax.set_title('merge '+str(k1)+' '+str(k2))
-                        plt.show()
+        thresholds = np.maximum(extremum_amplitudes[ind0], extremum_amplitudes[ind1]) * amplitude_factor_thresh
+        thresholds = np.maximum(thresholds, auto_merge_threshold)
         
-        #~ for k in np.unique(pop_from_cluster):
-            #~ cc.pop_labels_from_cluster([k])
-        pop_from_cluster = np.unique(pop_from_cluster)
-        cc.pop_labels_from_cluster(pop_from_cluster)
+        overlap = np.any(sparse_mask[ind0, :] & sparse_mask[ind1, :], axis=1)
+        lower_bound = np.maximum(inner_ampl[ind0], inner_ampl[ind1]) - cc.sparse_threshold
+        keep = overlap | (lower_bound < thresholds)
+        ind0, ind1, thresholds = ind0[keep], ind1[keep], thresholds[keep]
         
-        new_centroids = np.unique(new_centroids)
-        new_centroids = [k for k in new_centroids if k not in pop_from_cluster]
-        cc.compute_several_centroids(new_centroids)
-
-        #~ cc.compute_one_centroid(k)
+        pair_inds = np.stack([ind0, ind1], axis=1)
+        equal = equal_template_pairs(centroids, pair_inds, thresholds, n_shift=maximum_shift)
         
+        nb_merge = np.sum(equal)
+        if nb_merge == 0:
+            break
         
+        if debug_plot:
+            for i, j in pair_inds[equal]:
+                fig, ax = plt.subplots()
+                ax.plot(centroids[i].T.flatten())
+                ax.plot(centroids[j].T.flatten())
+                ax.set_title('merge '+str(labels[i])+' '+str(labels[j]))
+                plt.show()
         
-        #~ for k in np.unique(pop_from_centroids):
-            #~ if k in centroids:
-                #~ centroids.pop(k)
+        graph = scipy.sparse.coo_matrix((np.ones(nb_merge, dtype='bool'), (ind0[equal], ind1[equal])),
+                                shape=(labels.size, labels.size))
+        nb_component, component = scipy.sparse.csgraph.connected_components(graph, directed=False)
         
-        #~ print('nb_merge', nb_merge)
-        if nb_merge == 0:
-            break
+        # labels are sorted so the first of each component is the smallest
+        _, first = np.unique(component, return_index=True)
+        new_labels = labels[first][component]
+        
+        # relabel all peaks in one pass with a lookup table
+        peak_labels = cc.all_peaks['cluster_label']
+        lut_offset = min(np.min(peak_labels), 0)
+        lut = np.arange(lut_offset, max(np.max(peak_labels), np.max(labels)) + 1, dtype='int64')
+        lut[labels - lut_offset] = new_labels
+        cc.all_peaks['cluster_label'][:] = lut[peak_labels - lut_offset]
+        
+        pop_from_cluster = labels[new_labels != labels]
+        cc.pop_labels_from_cluster(pop_from_cluster)
+        
+        new_centroids = np.unique(new_labels[new_labels != labels])
+        cc.compute_several_centroids(new_centroids, n_jobs=cc.n_jobs)
 
 
 def trash_low_extremum(cc, min_extremum_amplitude=None):
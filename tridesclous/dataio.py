@@ -13,6 +13,8 @@ import pandas as pd
 from urllib.request import urlretrieve
 import pickle
 import distutils.version
+import threading
+import queue
 
 
 import sklearn.metrics
@@ -26,6 +28,7 @@ from .waveformtools import extract_chunks
 from .export import export_list, export_dict
 
 _signal_types = ['initial', 'processed']
+_spikes_time_index_step = 1024
 
 
 
@@ -91,6 +94,9 @@ class DataIO:
 
     
     """
+    # recompute mode for processed signals : size of blocks (in chunk) and nb of blocks kept in cache
+    _recompute_block_chunks = 32
+    _recompute_cache_size = 4
     
     @staticmethod
     def check_initialized(dirname):
@@ -105,6 +111,9 @@ class DataIO:
     
     def __init__(self, dirname='test'):
         self.dirname = dirname
+        self._recompute_cache = OrderedDict()
+        self._recompute_lock = threading.Lock()
+        self._spikes_time_index_cache = {}
         if not os.path.exists(dirname):
             os.mkdir(dirname)
         
@@ -460,7 +469,7 @@ class DataIO:
                 arrays = ArrayCollection(parent=None, dirname=self.segments_path[chan_grp][i])
                 self.arrays[chan_grp].append(arrays)
             
-                for name in ['processed_signals', 'spikes']:
+                for name in ['processed_signals', 'spikes', 'spikes_time_index']:
                     self.arrays[chan_grp][i].load_if_exists(name)
     
     def get_segment_length(self, seg_num):
@@ -502,7 +511,7 @@ class DataIO:
     
     def get_signals_chunk(self, seg_num=0, chan_grp=0,
                 i_start=None, i_stop=None,
-                signal_type='initial'): #return_type='raw_numpy'
+                signal_type='initial', view=False): #return_type='raw_numpy'
         """
         Get a chunk of signal for for a given segment index and channel group.
         
@@ -521,26 +530,54 @@ class DataIO:
             stop index (not included)
         signal_type: str
             'initial' or 'processed'
-        
-        
+        view: bool
+            For 'initial' only: when True and the channels of the group are contiguous
+            the result can be a view on the source (read-only memmap for raw files)
+            instead of a copy.
         
         """
         channels = self.channel_groups[chan_grp]['channels']
         
         if signal_type=='initial':
-            data = self.datasource.get_signals_chunk(seg_num=seg_num, i_start=i_start, i_stop=i_stop)
-            data = data[:, channels]
+            data = self.datasource.get_signals_chunk_by_channels(seg_num=seg_num, i_start=i_start, i_stop=i_stop,
+                            channels=channels, view=view)
         elif signal_type=='processed':
-            data = self.arrays[chan_grp][seg_num].get('processed_signals')[i_start:i_stop, :]
+            data = self.get_processed_signals(seg_num=seg_num, chan_grp=chan_grp, i_start=i_start, i_stop=i_stop)
         else:
             raise(ValueError, 'signal_type is not valide')
         
         return data
     
-    def iter_over_chunk(self, seg_num=0, chan_grp=0,  i_stop=None, chunksize=1024, pad_width=0, with_last_chunk=False,   **kargs):
+    def read_signals_chunk(self, out, seg_num=0, chan_grp=0, i_start=None, i_stop=None, signal_type='initial'):
+        """
+        Same as get_signals_chunk but write the chunk in the given buffer out[:i_stop-i_start, :].
+        
+        For 'initial' the channel group selection (and the dtype conversion if out.dtype
+        is not the source dtype) is done during the copy, so there is no intermediate array.
+        """
+        n = i_stop - i_start
+        if signal_type=='initial':
+            channels = self.channel_groups[chan_grp]['channels']
+            self.datasource.get_signals_chunk_by_channels(seg_num=seg_num, i_start=i_start, i_stop=i_stop,
+                                channels=channels, out=out[:n, :])
+        elif signal_type=='processed':
+            out[:n, :] = self.get_processed_signals(seg_num=seg_num, chan_grp=chan_grp, i_start=i_start, i_stop=i_stop)
+        else:
+            raise(ValueError, 'signal_type is not valide')
+    
+    def iter_over_chunk(self, seg_num=0, chan_grp=0,  i_stop=None, chunksize=1024, pad_width=0, with_last_chunk=False, i_start=None,
+                    prefetch=0, **kargs):
         """
         Create an iterable on signals. ('initial' or 'processed')
         
+        i_start can be given to start the iteration somewhere in the segment
+        (used by block parallel Peeler). Chunk are then [i_start, i_start+chunksize], ...
+        
+        When prefetch>0, the next `prefetch` chunks are read in a background thread
+        into a ring of preallocated buffers, so disk access and computation overlap.
+        In that case the yielded chunk is a buffer that is reused: it is valid only
+        until the next iteration (copy it to keep it).
+        
         Usage
         ----------
         
@@ -548,13 +585,23 @@ class DataIO:
                 do_something_on_chunk(sig_chunk)
         
         """
+        if prefetch > 0:
+            yield from self._iter_over_chunk_prefetch(seg_num=seg_num, chan_grp=chan_grp, i_stop=i_stop,
+                            chunksize=chunksize, pad_width=pad_width, with_last_chunk=with_last_chunk,
+                            i_start=i_start, prefetch=prefetch, **kargs)
+            return
+        
         seg_length = self.get_segment_length(seg_num)
         
         length = seg_length
         if i_stop is not None:
             length = min(length, i_stop)
         
-        total_length = length + pad_width
+        if i_start is None:
+            i_start = 0
+        first_index = i_start
+        
+        total_length = length + pad_width - first_index
         
         nloop = total_length//chunksize
         if total_length % chunksize and with_last_chunk:
@@ -562,18 +609,19 @@ class DataIO:
         
         last_sample = None
         for i in range(nloop):
-            i_stop = (i+1)*chunksize
+            i_stop = first_index + (i+1)*chunksize
             i_start = i_stop - chunksize
             
             if i_stop > seg_length:
-                sigs_chunk2 = np.zeros((chunksize, sigs_chunk.shape[1]), dtype=sigs_chunk.dtype)
                 if i_start < seg_length:
                     sigs_chunk = self.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp, i_start=i_start, i_stop=seg_length, **kargs)
+                    sigs_chunk2 = np.zeros((chunksize, sigs_chunk.shape[1]), dtype=sigs_chunk.dtype)
                     sigs_chunk2[:sigs_chunk.shape[0], :] = sigs_chunk
                     last_sample = sigs_chunk[-1, :]
                     # extend with last sample : agttenuate fileter border effect
                     sigs_chunk2[sigs_chunk.shape[0]:, :] = last_sample
                 else:
+                    sigs_chunk2 = np.zeros((chunksize, sigs_chunk.shape[1]), dtype=sigs_chunk.dtype)
                     if last_sample is not None:
                         sigs_chunk2[:, :] = last_sample
                 yield  i_stop, sigs_chunk2
@@ -597,12 +645,249 @@ class DataIO:
             
             #~ yield  i_start+chunksize, sigs_chunk2
     
-    def reset_processed_signals(self, seg_num=0, chan_grp=0, dtype='float32'):
+    def _iter_over_chunk_prefetch(self, seg_num=0, chan_grp=0,  i_stop=None, chunksize=1024, pad_width=0, 
+                        with_last_chunk=False, i_start=None, prefetch=2, signal_type='initial'):
+        # same chunks as iter_over_chunk but read by a background thread
+        seg_length = self.get_segment_length(seg_num)
+        
+        length = seg_length
+        if i_stop is not None:
+            length = min(length, i_stop)
+        
+        if i_start is None:
+            i_start = 0
+        first_index = i_start
+        
+        total_length = length + pad_width - first_index
+        
+        nloop = total_length//chunksize
+        if total_length % chunksize and with_last_chunk:
+            nloop += 1
+        
+        if nloop <= 0:
+            return
+        
+        if signal_type=='initial':
+            dtype = self.source_dtype
+        else:
+            dtype = self.get_processed_signals_dtype(chan_grp=chan_grp)
+        nb_channel = self.nb_channel(chan_grp)
+        
+        # the consumer hold one buffer, the queue hold prefetch buffers and the reader fill one
+        nb_buffer = prefetch + 2
+        buffers = np.zeros((nb_buffer, chunksize, nb_channel), dtype=dtype)
+        
+        fifo = queue.Queue(maxsize=prefetch)
+        stop_event = threading.Event()
+        
+        def put(item):
+            while not stop_event.is_set():
+                try:
+                    fifo.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def reader():
+            try:
+                last_sample = None
+                for i in range(nloop):
+                    if stop_event.is_set():
+                        return
+                    buf = buffers[i % nb_buffer]
+                    chunk_stop = first_index + (i+1)*chunksize
+                    chunk_start = chunk_stop - chunksize
+                    n = min(chunk_stop, seg_length) - chunk_start
+                    if n > 0:
+                        self.read_signals_chunk(buf, seg_num=seg_num, chan_grp=chan_grp, i_start=chunk_start,
+                                                        i_stop=chunk_start + n, signal_type=signal_type)
+                        if chunk_stop >= seg_length:
+                            last_sample = buf[n-1, :].copy()
+                    else:
+                        n = 0
+                    if n < chunksize:
+                        # extend with last sample : attenuate filter border effect
+                        if last_sample is None:
+                            buf[n:, :] = 0
+                        else:
+                            buf[n:, :] = last_sample
+                    if not put((chunk_stop, buf)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+        
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = fifo.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop_event.set()
+            thread.join()
+    
+    def set_processed_signals_storage(self, memory_mode='memmap', codec='int16', chunksize=None):
+        """
+        Set how processed signals are stored on disk (taken in account at the next reset_processed_signals).
+        
+        Parameters
+        ------------------
+        memory_mode: 'memmap' or 'compressed'
+            'memmap' is a full length raw array (fast but big).
+            'compressed' stores compressed chunks with a chunk index (see iotools.CompressedChunkedArray).
+        codec: 'int16', 'int16+zlib', 'zlib' or 'lzma'
+            Codec for 'compressed'. 'int16' is scaled int16 with per channel gain (lossy).
+        chunksize: int or None
+            Chunk size of the compressed storage. None is the chunksize given by
+            the Peeler/CatalogueConstructor at reset time.
+        """
+        assert memory_mode in ('memmap', 'compressed')
+        self.info['processed_signals_storage'] = dict(memory_mode=memory_mode, codec=codec, chunksize=chunksize)
+        self.flush_info()
+    
+    def set_processed_signals_recompute(self, chan_grp=0, signal_preprocessor_params=None,
+                    signals_medians=None, signals_mads=None, chunksize=1024, dtype='float32'):
+        """
+        Declare that processed signals of this channel group are not saved
+        after processed_length (Peeler with save_processed_signals=False).
+        
+        Then get_signals_chunk(signal_type='processed') recompute the window on the fly
+        from the raw signals with these preprocessor params (usually catalogue['signal_preprocessor_params']).
+        This is cleared at the next reset_processed_signals.
+        """
+        d = self.info.get('processed_signals_recompute', {})
+        d[str(chan_grp)] = dict(signal_preprocessor_params=dict(signal_preprocessor_params),
+                        signals_medians=np.asarray(signals_medians).tolist(),
+                        signals_mads=np.asarray(signals_mads).tolist(),
+                        chunksize=int(chunksize), dtype=np.dtype(dtype).name)
+        self.info['processed_signals_recompute'] = d
+        self.flush_info()
+        self._clear_recompute_cache()
+    
+    def _clear_recompute_cache(self):
+        with self._recompute_lock:
+            self._recompute_cache.clear()
+    
+    def get_processed_signals_dtype(self, chan_grp=0):
+        recompute = self.info.get('processed_signals_recompute', {}).get(str(chan_grp), None)
+        if recompute is not None:
+            return np.dtype(recompute['dtype'])
+        return self.arrays[chan_grp][0].get('processed_signals').dtype
+    
+    def get_processed_signals(self, seg_num=0, chan_grp=0, i_start=None, i_stop=None):
+        """
+        Read processed signals [i_start:i_stop, :].
+        
+        All reads of processed signals go through here (get_signals_chunk, read_signals_chunk, 
+        iter_over_chunk, get_some_waveforms, ...).
+        In recompute mode (Peeler with save_processed_signals=False, see set_processed_signals_recompute)
+        the signals are recomputed from the raw signals and what is on disk is ignored because
+        it is not from the current run.
+        """
+        recompute = self.info.get('processed_signals_recompute', {}).get(str(chan_grp), None)
+        if recompute is None:
+            return self.arrays[chan_grp][seg_num].get('processed_signals')[i_start:i_stop, :]
+        
+        if i_start is None:
+            i_start = 0
+        if i_stop is None:
+            i_stop = self.get_segment_length(seg_num)
+        return self._recompute_processed_signals(seg_num, chan_grp, i_start, i_stop, recompute)
+    
+    def _recompute_processed_signals(self, seg_num, chan_grp, i_start, i_stop, recompute):
+        # recompute is done by blocks on a fixed grid so that a sample has always the
+        # same value whatever the asked window (get_signals_chunk or get_some_waveforms)
+        block_size = self._recompute_block_chunks * recompute['chunksize']
+        dtype = np.dtype(recompute['dtype'])
+        data = np.zeros((i_stop - i_start, self.nb_channel(chan_grp)), dtype=dtype)
+        b0 = i_start - i_start % block_size
+        while b0 < i_stop:
+            b1 = b0 + block_size
+            key = (seg_num, chan_grp, b0)
+            with self._recompute_lock:
+                block = self._recompute_cache.get(key, None)
+            if block is None:
+                block = self._recompute_processed_block(seg_num, chan_grp, b0, b1, recompute)
+                with self._recompute_lock:
+                    self._recompute_cache[key] = block
+                    while len(self._recompute_cache) > self._recompute_cache_size:
+                        self._recompute_cache.popitem(last=False)
+            i0 = max(i_start, b0)
+            i1 = min(i_stop, b1)
+            data[i0-i_start:i1-i_start] = block[i0-b0:i1-b0]
+            b0 = b1
+        return data
+    
+    def _recompute_processed_block(self, seg_num, chan_grp, i_start, i_stop, recompute):
+        from .signalpreprocessor import signalpreprocessor_engines
+        
+        p = dict(recompute['signal_preprocessor_params'])
+        engine = p.pop('engine')
+        if engine == 'opencl':
+            # this is for viewing, numpy is enough
+            engine = 'numpy'
+        chunksize = recompute['chunksize']
+        dtype = np.dtype(recompute['dtype'])
+        nb_channel = self.nb_channel(chan_grp)
+        seg_length = self.get_segment_length(seg_num)
+        
+        signalpreprocessor = signalpreprocessor_engines[engine](self.sample_rate, nb_channel, chunksize, self.source_dtype)
+        p['normalize'] = True
+        p['signals_medians'] = np.array(recompute['signals_medians'], dtype=dtype)
+        p['signals_mads'] = np.array(recompute['signals_mads'], dtype=dtype)
+        signalpreprocessor.change_params(**p)
+        lostfront_chunksize = signalpreprocessor.lostfront_chunksize
+        
+        # warmup : the filter start with zeros state so the begining is a transient
+        warmup_size = 3 * lostfront_chunksize + chunksize
+        start = max(0, i_start - warmup_size)
+        start = start - start % chunksize
+        
+        data = np.zeros((i_stop - i_start, nb_channel), dtype=dtype)
+        iterator = self.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=chunksize,
+                            i_start=start, i_stop=min(seg_length, i_stop + chunksize), 
+                            pad_width=lostfront_chunksize, with_last_chunk=True, signal_type='initial')
+        for pos, sigs_chunk in iterator:
+            pos2, preprocessed_chunk = signalpreprocessor.process_data(pos, sigs_chunk)
+            if preprocessed_chunk is None:
+                continue
+            chunk_start = pos2 - preprocessed_chunk.shape[0]
+            i0 = max(chunk_start, i_start)
+            i1 = min(pos2, i_stop)
+            if i1 > i0:
+                data[i0-i_start:i1-i_start] = preprocessed_chunk[i0-chunk_start:i1-chunk_start]
+            if pos2 >= i_stop:
+                break
+        
+        return data
+    
+    def reset_processed_signals(self, seg_num=0, chan_grp=0, dtype='float32', chunksize=None):
         """
         Reset processed signals.
+        
+        chunksize is used to align chunks when the storage is 'compressed'.
         """
-        self.arrays[chan_grp][seg_num].create_array('processed_signals', dtype, 
-                            self.get_segment_shape(seg_num, chan_grp=chan_grp), 'memmap')
+        if str(chan_grp) in self.info.get('processed_signals_recompute', {}):
+            self.info['processed_signals_recompute'].pop(str(chan_grp))
+            self.flush_info()
+            self._clear_recompute_cache()
+        storage = self.info.get('processed_signals_storage', {'memory_mode': 'memmap'})
+        shape = self.get_segment_shape(seg_num, chan_grp=chan_grp)
+        if storage['memory_mode'] == 'compressed':
+            if storage['chunksize'] is not None:
+                chunksize = storage['chunksize']
+            elif chunksize is None:
+                chunksize = 1024
+            self.arrays[chan_grp][seg_num].create_array('processed_signals', dtype, shape, 'compressed',
+                            codec=storage['codec'], chunksize=chunksize)
+        else:
+            self.arrays[chan_grp][seg_num].create_array('processed_signals', dtype, shape, 'memmap')
         self.arrays[chan_grp][seg_num].annotate('processed_signals', processed_length=0)
     
     def set_signals_chunk(self,sigs_chunk, seg_num=0, chan_grp=0, i_start=None, i_stop=None, signal_type='processed'):
@@ -644,6 +929,7 @@ class DataIO:
         """
         assert dtype is not None
         self.arrays[chan_grp][seg_num].initialize_array('spikes', 'memmap', dtype, (-1,))
+        self._spikes_time_index_cache.pop((chan_grp, seg_num), None)
         
     def append_spikes(self, seg_num=0, chan_grp=0, spikes=None):
         """
@@ -657,20 +943,91 @@ class DataIO:
         Flush underlying memmap for spikes.
         """
         self.arrays[chan_grp][seg_num].finalize_array('spikes')
+        self._make_spikes_time_index(seg_num=seg_num, chan_grp=chan_grp)
+    
+    def _make_spikes_time_index(self, seg_num=0, chan_grp=0):
+        """
+        Sort spikes by sample index if needed and save the index of one spike
+        every _spikes_time_index_step in 'spikes_time_index'.
+        This is a small contiguous array used by get_spikes_slice() for np.searchsorted.
+        This is the write path (flush_spikes).
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        spikes = arrays.get('spikes')
+        if spikes is None:
+            return
+        if spikes.size > 1 and np.any(np.diff(spikes['index']) < 0):
+            spikes[:] = spikes.take(np.argsort(spikes['index'], kind='stable'))
+            arrays.flush_array('spikes')
+        time_index = spikes['index'][::_spikes_time_index_step].copy()
+        arrays.add_array('spikes_time_index', time_index, 'memmap')
+        self._spikes_time_index_cache.pop((chan_grp, seg_num), None)
+    
+    def _get_spikes_time_index(self, seg_num=0, chan_grp=0):
+        # read path : never write on disk
+        arrays = self.arrays[chan_grp][seg_num]
+        spikes = arrays.get('spikes')
+        expected_size = (spikes.size + _spikes_time_index_step - 1) // _spikes_time_index_step
+        
+        time_index = arrays.get('spikes_time_index') if arrays.has_key('spikes_time_index') else None
+        if time_index is not None and time_index.size == expected_size:
+            return time_index
+        
+        # folder made by an older version or spikes not flushed yet : in memory only
+        time_index = self._spikes_time_index_cache.get((chan_grp, seg_num), None)
+        if time_index is not None and time_index.size == expected_size:
+            return time_index
+        
+        if spikes.size > 1 and np.any(np.diff(spikes['index']) < 0):
+            raise(ValueError('spikes are not sorted by index for seg_num={} chan_grp={}, use flush_spikes()'.format(seg_num, chan_grp)))
+        time_index = spikes['index'][::_spikes_time_index_step].copy()
+        self._spikes_time_index_cache[(chan_grp, seg_num)] = time_index
+        return time_index
+    
+    def get_spikes_slice(self, seg_num=0, chan_grp=0, t_start=None, t_stop=None):
+        """
+        Position (i_start, i_stop) in spikes of the spikes with t_start <= index < t_stop.
+        t_start and t_stop are in sample. This is O(log n) with the spikes_time_index.
+        Spikes must be sorted by index (this is done by flush_spikes).
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        spikes = arrays.get('spikes')
+        assert spikes is not None, 'spikes not computed'
+        time_index = self._get_spikes_time_index(seg_num=seg_num, chan_grp=chan_grp)
+        
+        def search(t):
+            b = int(np.searchsorted(time_index, t, side='left'))
+            # first spike >= t is in ]step*(b-1), step*b]
+            lo = 0 if b == 0 else _spikes_time_index_step * (b - 1) + 1
+            hi = min(_spikes_time_index_step * b, spikes.size)
+            if hi <= lo:
+                return hi
+            return lo + int(np.searchsorted(spikes['index'][lo:hi], t, side='left'))
+        
+        i_start = 0 if t_start is None else search(t_start)
+        i_stop = spikes.size if t_stop is None else search(t_stop)
+        i_stop = max(i_start, i_stop)
+        return i_start, i_stop
     
     def is_spike_computed(self, chan_grp=0):
         done = all(self.arrays[chan_grp][seg_num].has_key('spikes') for seg_num in range(self.nb_segment))
         return done
     
-    def get_spikes(self, seg_num=0, chan_grp=0, i_start=None, i_stop=None):
+    def get_spikes(self, seg_num=0, chan_grp=0, i_start=None, i_stop=None, t_start=None, t_stop=None):
         """
         Read spikes
+        
+        i_start/i_stop are positions in the spikes array.
+        t_start/t_stop are sample indexes: spikes with t_start <= index < t_stop (see get_spikes_slice).
         """
         if not self.arrays[chan_grp][seg_num].has_key('spikes'):
             return None
         spikes = self.arrays[chan_grp][seg_num].get('spikes')
         if spikes is None:
             return
+        if t_start is not None or t_stop is not None:
+            assert i_start is None and i_stop is None, 'give i_start/i_stop or t_start/t_stop'
+            i_start, i_stop = self.get_spikes_slice(seg_num=seg_num, chan_grp=chan_grp, t_start=t_start, t_stop=t_stop)
         return spikes[i_start:i_stop]
 
     def get_peak_values(self,  seg_num=0, chan_grp=0, sample_indexes=None, channel_indexes=None):
@@ -679,11 +1036,9 @@ class DataIO:
         """
         assert sample_indexes is not None, 'Provide sample_indexes'
         assert channel_indexes is not None, 'Provide channel_indexes'
-        sigs = self.arrays[chan_grp][seg_num].get('processed_signals')
-        
         peak_values = []
         for s, c in zip(sample_indexes, channel_indexes):
-            peak_values.append(sigs[s, c])
+            peak_values.append(self.get_processed_signals(seg_num=seg_num, chan_grp=chan_grp, i_start=s, i_stop=s+1)[0, c])
         peak_values = np.array(peak_values)
         return peak_values
         
@@ -706,7 +1061,7 @@ class DataIO:
             nb_chan = len(channel_indexes)
         
         if waveforms is None:
-            dtype = self.arrays[chan_grp][0].get('processed_signals').dtype
+            dtype = self.get_processed_signals_dtype(chan_grp=chan_grp)
             waveforms = np.zeros((peak_sample_indexes.size, peak_width, nb_chan), dtype=dtype)
         else:
             assert waveforms.shape[0] == peak_sample_indexes.size
@@ -714,9 +1069,7 @@ class DataIO:
         
         if seg_num is not None:
             left_indexes = peak_sample_indexes + n_left
-            sigs = self.arrays[chan_grp][seg_num].get('processed_signals')
-            extract_chunks(sigs, left_indexes, peak_width, 
-                                        channel_indexes=channel_indexes, chunks=waveforms)
+            self._extract_processed_waveforms(seg_num, chan_grp, left_indexes, peak_width, channel_indexes, waveforms)
         elif seg_nums is not None and isinstance(seg_nums, np.ndarray):
             n = 0
             for seg_num in np.unique(seg_nums):
@@ -726,9 +1079,7 @@ class DataIO:
                 if left_indexes.size == 0:
                     continue
                 chunks = waveforms[n:n+left_indexes.size] # this avoid a copy
-                sigs = self.arrays[chan_grp][seg_num].get('processed_signals')
-                extract_chunks(sigs, left_indexes, peak_width, 
-                                            channel_indexes=channel_indexes, chunks=chunks)
+                self._extract_processed_waveforms(seg_num, chan_grp, left_indexes, peak_width, channel_indexes, chunks)
                 n += left_indexes.size
         else:
             raise 'error seg_num or seg_nums'
@@ -736,6 +1087,26 @@ class DataIO:
         return waveforms
 
 
+    def _extract_processed_waveforms(self, seg_num, chan_grp, left_indexes, width, channel_indexes, chunks):
+        recompute = self.info.get('processed_signals_recompute', {}).get(str(chan_grp), None)
+        if recompute is None:
+            sigs = self.arrays[chan_grp][seg_num].get('processed_signals')
+            extract_chunks(sigs, left_indexes, width, channel_indexes=channel_indexes, chunks=chunks)
+            return
+        
+        # recompute mode : peaks are grouped by recompute block
+        seg_length = self.get_segment_length(seg_num)
+        block_size = self._recompute_block_chunks * recompute['chunksize']
+        left_indexes = np.asarray(left_indexes)
+        valid, = np.nonzero((left_indexes >= 0) & (left_indexes < (seg_length - width)))
+        block_inds = left_indexes[valid] // block_size
+        for block_ind in np.unique(block_inds):
+            inds = valid[block_inds == block_ind]
+            b0 = block_ind * block_size
+            b1 = min(b0 + block_size + width + 1, seg_length)
+            sigs = self.get_processed_signals(seg_num=seg_num, chan_grp=chan_grp, i_start=b0, i_stop=b1)
+            chunks[inds] = extract_chunks(sigs, left_indexes[inds] - b0, width, channel_indexes=channel_indexes)
+    
     def save_catalogue(self, catalogue, name='initial'):
         """
         Save the catalogue made by `CatalogueConstructor` and needed
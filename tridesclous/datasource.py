@@ -32,6 +32,108 @@ class DataSourceBase:
     def get_signals_chunk(self, seg_num=0, i_start=None, i_stop=None):
         raise NotImplementedError
     
+    # bytes accounting for get_signals_chunk_by_channels
+    last_bytes_read = 0
+    last_bytes_used = 0
+    total_bytes_read = 0
+    total_bytes_used = 0
+    
+    def get_signals_chunk_by_channels(self, seg_num=0, i_start=None, i_stop=None, channels=None, out=None, dtype=None, view=False):
+        """
+        Get a chunk of signals for a subset of channels.
+        
+        Parameters
+        ------------------
+        channels: None, slice or list of int
+            Channel indexes. None is all channels.
+        out: None or np.array
+            Buffer to write in. The dtype conversion is done while copying.
+        dtype: None or dtype
+            Output dtype when out is None.
+        view: bool (default False)
+            When True, the channels are contiguous and the output dtype is the source dtype,
+            the result is a view (no copy) on the source array (the memmap for RawDataSource,
+            often read-only). Otherwise the result is always a new array (or out).
+        
+        Channels are copied in one pass directly into the result, so scattered channels
+        do not need an intermediate array (except for dtype conversion where one buffer is reused).
+        
+        Bytes read from the source (all channels of the rows) and bytes really
+        used are kept in last_bytes_read/last_bytes_used (and total_bytes_read/total_bytes_used)
+        to see the I/O amplification.
+        """
+        data = self.get_signals_chunk(seg_num=seg_num, i_start=i_start, i_stop=i_stop)
+        
+        if channels is not None and not isinstance(channels, slice):
+            channels = np.asarray(channels, dtype='int64')
+            if channels.size > 0 and (channels.min() < 0 or channels.max() >= data.shape[1]):
+                raise(IndexError('channels {} out of range for {} channels'.format(channels, data.shape[1])))
+        
+        sl = _channels_as_slice(channels)
+        if sl is not None:
+            sub = data[:, sl]
+            if out is None and view and (dtype is None or np.dtype(dtype) == sub.dtype):
+                result = sub
+            else:
+                if out is None:
+                    out = np.empty(sub.shape, dtype=sub.dtype if dtype is None else dtype)
+                out[...] = sub
+                result = out
+        else:
+            if out is None:
+                out = np.empty((data.shape[0], channels.size), dtype=data.dtype if dtype is None else dtype)
+            # channels are already checked so mode='clip' never clips (and avoid the internal buffer of 'raise')
+            if out.dtype == data.dtype:
+                np.take(data, channels, axis=1, out=out, mode='clip')
+            else:
+                out[...] = np.take(data, channels, axis=1, out=self._get_take_buffer(data.shape[0], channels.size, data.dtype), mode='clip')
+            result = out
+        
+        self.last_bytes_read = data.nbytes
+        self.last_bytes_used = result.shape[0] * result.shape[1] * data.dtype.itemsize
+        self.total_bytes_read += self.last_bytes_read
+        self.total_bytes_used += self.last_bytes_used
+        
+        return result
+    
+    def _get_take_buffer(self, n, nb_channel, dtype):
+        # one buffer reused for scattered channels + dtype conversion
+        buf = getattr(self, '_take_buffer', None)
+        if buf is None or buf.shape[0] < n or buf.shape[1] != nb_channel or buf.dtype != dtype:
+            buf = np.empty((n, nb_channel), dtype=dtype)
+            self._take_buffer = buf
+        return buf[:n, :]
+    
+    def get_io_stats(self):
+        """
+        Bytes read vs bytes used by get_signals_chunk_by_channels.
+        """
+        d = dict(last_bytes_read=self.last_bytes_read, last_bytes_used=self.last_bytes_used,
+                total_bytes_read=self.total_bytes_read, total_bytes_used=self.total_bytes_used)
+        if self.total_bytes_used > 0:
+            d['amplification'] = self.total_bytes_read / self.total_bytes_used
+        else:
+            d['amplification'] = None
+        return d
+
+
+def _channels_as_slice(channels):
+    """
+    Return a slice when channels are contiguous (or None) else None.
+    """
+    if channels is None:
+        return slice(None)
+    if isinstance(channels, slice):
+        return channels
+    if isinstance(channels, range) and channels.step == 1:
+        return slice(channels.start, channels.stop)
+    channels = np.asarray(channels)
+    if channels.size == 0:
+        return None
+    if channels.size == 1 or np.all(np.diff(channels) == 1):
+        return slice(int(channels[0]), int(channels[-1]) + 1)
+    return None
+
 
     
 class InMemoryDataSource(DataSourceBase):
@@ -128,115 +128,173 @@ class PeakMaxOnChannel:
         #~ return None
 
 
+def _extract_sparse_waveforms(cc, peaks_index, channel_table, block_size=4096):
+    """
+    Extract waveforms of peaks_index in one pass in a compact buffer.
+    
+    channel_table is (nb_channel, k) for each peak channel give the k channels
+    to keep, padded with -1. None is all channels.
+    
+    Returns
+    -----------
+    waveforms: np.ndarray shape (peaks_index.size, peak_width, k)
+    """
+    n_left = cc.info['waveform_extractor_params']['n_left']
+    n_right = cc.info['waveform_extractor_params']['n_right']
+    k = cc.nb_channel if channel_table is None else channel_table.shape[1]
+    waveforms = np.zeros((peaks_index.size, n_right - n_left, k), dtype=cc.info['internal_dtype'])
+    for i0 in range(0, peaks_index.size, block_size):
+        i1 = min(i0 + block_size, peaks_index.size)
+        # rows of the memmap are all channels so one read by peak
+        wfs = cc.get_some_waveforms(peaks_index=peaks_index[i0:i1])
+        if channel_table is None:
+            waveforms[i0:i1] = wfs
+            continue
+        table = channel_table[cc.all_peaks['channel'][peaks_index[i0:i1]], :]
+        wfs = np.take_along_axis(wfs, np.maximum(table, 0)[:, None, :], axis=2)
+        wfs[np.broadcast_to((table < 0)[:, None, :], wfs.shape)] = 0
+        waveforms[i0:i1] = wfs
+    return waveforms
+
+
+def _fit_one_channel(wf_chan, n_components_by_channel, params):
+    if wf_chan.shape[0] - 1 > n_components_by_channel:
+        pca = sklearn.decomposition.TruncatedSVD(n_components=n_components_by_channel, **params)
+        pca.fit(wf_chan)
+        return pca.components_.T
+    else:
+        return None
+
+
 class PcaByChannel:
-    def __init__(self, catalogueconstructor=None, selection=None, n_components_by_channel=3, adjacency_radius_um=200, **params):
+    """
+    One TruncatedSVD by channel fitted on peaks detected on this channel.
+    
+    Waveforms are read only once, in sparse mode only adjacent channels are kept.
+    Channels are fitted in parallel threads (n_jobs, None is cc.n_jobs)
+    and all channels are transformed with one batched matrix product.
+    
+    The fitted projections (nb_channel, peak_width, n_components_by_channel) are
+    kept by the CatalogueConstructor in 'feature_projections' so the projector
+    is available again after reload (see PcaByChannel.from_projections).
+    """
+    def __init__(self, catalogueconstructor=None, selection=None, n_components_by_channel=3, adjacency_radius_um=200, 
+                        n_jobs=None, **params):
         
         cc = catalogueconstructor
         
-        thresh = cc.info['peak_detector_params']['relative_threshold']
-        n_left = cc.info['waveform_extractor_params']['n_left']
         self.dtype = cc.info['internal_dtype']
         
-        
-        #~ self.waveforms = waveforms
         self.n_components_by_channel = n_components_by_channel
         self.adjacency_radius_um = adjacency_radius_um
         
+        if n_jobs is None:
+            n_jobs = getattr(cc, 'n_jobs', 1)
+        
+        nb_channel = cc.nb_channel
+        if cc.mode == 'dense':
+            self.channel_table = None
+        elif cc.mode == 'sparse':
+            assert cc.info['peak_detector_params']['method'] == 'geometrical'
+            channel_adjacency = cc.dataio.get_channel_adjacency(chan_grp=cc.chan_grp, adjacency_radius_um=self.adjacency_radius_um)
+            k = max(len(channel_adjacency[c]) for c in range(nb_channel))
+            self.channel_table = -np.ones((nb_channel, k), dtype='int64')
+            for c in range(nb_channel):
+                chans = np.sort(channel_adjacency[c])
+                self.channel_table[c, :chans.size] = chans
+        else:
+            raise(NotImplementedError)
         
         #~ t1 = time.perf_counter()
         if selection is None:
             peaks_index = cc.some_peaks_index
+            # the buffer is kept for get_features
+            self.waveforms = _extract_sparse_waveforms(cc, peaks_index, self.channel_table)
+            peak_channels = cc.all_peaks['channel'][peaks_index]
+            if self.channel_table is None:
+                own_slot = np.arange(nb_channel)
+            else:
+                own_slot = np.argmax(self.channel_table == np.arange(nb_channel)[:, None], axis=1)
+            wf_own = self.waveforms[np.arange(peaks_index.size), :, own_slot[peak_channels]]
         else:
             peaks_index,  = np.nonzero(selection)
+            self.waveforms = None
+            own_table = np.arange(nb_channel)[:, None]
+            peak_channels = cc.all_peaks['channel'][peaks_index]
+            wf_own = _extract_sparse_waveforms(cc, peaks_index, own_table)[:, :, 0]
         
-        some_peaks = cc.all_peaks[peaks_index]
+        # threads : the SVD release the GIL
+        projections = joblib.Parallel(n_jobs=n_jobs, backend='threading')(
+                    joblib.delayed(_fit_one_channel)(wf_own[peak_channels == chan], n_components_by_channel, params)
+                    for chan in range(nb_channel))
+        
+        self.projections = np.zeros((nb_channel, wf_own.shape[1], n_components_by_channel), dtype=self.dtype)
+        for chan, proj in enumerate(projections):
+            if proj is not None:
+                self.projections[chan] = proj
         
-        self.pcas = []
-        for chan in range(cc.nb_channel):
-        #~ for chan in range(20):
-            #~ print('fit', chan)
-            sel = some_peaks['channel'] == chan
-            wf_chan = cc.get_some_waveforms(peaks_index=peaks_index[sel], channel_indexes=[chan])
-            wf_chan = wf_chan[:, :, 0]
-            #~ print(wf_chan.shape)
-            
-            if wf_chan.shape[0] - 1 > n_components_by_channel:
-                #~ pca = sklearn.decomposition.IncrementalPCA(n_components=n_components_by_channel, **params)
-                #~ print('PcaByChannel SVD')
-                pca = sklearn.decomposition.TruncatedSVD(n_components=n_components_by_channel, **params)
-                pca.fit(wf_chan)
-            else:
-                pca = None
-            self.pcas.append(pca)
-
         #~ t2 = time.perf_counter()
         #~ print('pca fit', t2-t1)
-            
-
-
-            
-            #~ pca = get_pca_one_channel(waveforms, chan, thresh, n_left, n_components_by_channel, params)
-            
-        #~ n_jobs = -1
-        #~ self.pcas = joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(get_pca_one_channel)(waveforms, chan, thresh, n_components_by_channel, params) for chan in range(cc.nb_channel))
         
-
+        self._make_channel_to_features(nb_channel)
+    
+    @classmethod
+    def from_projections(cls, projections, dtype):
+        """
+        Rebuild a projector (only for transform) from saved projections.
+        """
+        self = cls.__new__(cls)
+        self.dtype = dtype
+        self.projections = projections
+        self.n_components_by_channel = projections.shape[2]
+        self.waveforms = None
+        self.channel_table = None
+        self._make_channel_to_features(projections.shape[0])
+        return self
+    
+    def _make_channel_to_features(self, nb_channel):
         #In full PcaByChannel n_components_by_channel feature correspond to one channel
-        self.channel_to_features = np.zeros((cc.nb_channel, cc.nb_channel*n_components_by_channel), dtype='bool')
-        for c in range(cc.nb_channel):
-            self.channel_to_features[c, c*n_components_by_channel:(c+1)*n_components_by_channel] = True
+        n = self.n_components_by_channel
+        self.channel_to_features = np.zeros((nb_channel, nb_channel*n), dtype='bool')
+        for c in range(nb_channel):
+            self.channel_to_features[c, c*n:(c+1)*n] = True
 
     def get_features(self, catalogueconstructor):
         cc = catalogueconstructor
         
+        if self.waveforms is None:
+            self.waveforms = _extract_sparse_waveforms(cc, cc.some_peaks_index, self.channel_table)
+        
         nb = cc.some_peaks_index.size
         n = self.n_components_by_channel
         
-        features = np.zeros((nb, cc.nb_channel*self.n_components_by_channel), dtype=self.dtype)
-        
-        some_peaks = cc.all_peaks[cc.some_peaks_index]
-
-        if cc.mode == 'sparse':
-            assert cc.info['peak_detector_params']['method'] == 'geometrical'
-            #~ adjacency_radius_um = cc.info['peak_detector_params']['adjacency_radius_um']
-            channel_adjacency = cc.dataio.get_channel_adjacency(chan_grp=cc.chan_grp, adjacency_radius_um=self.adjacency_radius_um)
-        
         #~ t1 = time.perf_counter()
-        for chan, pca in enumerate(self.pcas):
-            if pca is None:
-                continue
-            #~ print('transform', chan)
-            #~ sel = some_peaks['channel'] == chan
-            
-            if cc.mode == 'dense':
-                wf_chan = cc.get_some_waveforms(peaks_index=cc.some_peaks_index, channel_indexes=[chan])
-                wf_chan = wf_chan[:, :, 0]
-                #~ print('dense', wf_chan.shape)
-                features[:, chan*n:(chan+1)*n] = pca.transform(wf_chan)
-            elif cc.mode == 'sparse':
-                sel = np.in1d(some_peaks['channel'], channel_adjacency[chan])
-                #~ print(chan, np.sum(sel))
-                wf_chan = cc.get_some_waveforms(peaks_index=cc.some_peaks_index[sel], channel_indexes=[chan])
-                wf_chan = wf_chan[:, :, 0]
-                #~ print('sparse', wf_chan.shape)
-                features[:, chan*n:(chan+1)*n][sel, :] = pca.transform(wf_chan)
-
+        if cc.mode == 'dense':
+            features = self.transform(self.waveforms)
+        elif cc.mode == 'sparse':
+            features = np.zeros((nb, cc.nb_channel*n), dtype=self.dtype)
+            features3d = features.reshape(nb, cc.nb_channel, n)
+            peak_channels = cc.all_peaks['channel'][cc.some_peaks_index]
+            for peak_chan in np.unique(peak_channels):
+                ind,  = np.nonzero(peak_channels == peak_chan)
+                chans = self.channel_table[peak_chan]
+                chans = chans[chans>=0]
+                wfs = self.waveforms[ind, :, :chans.size]
+                # (chans, peaks, width) @ (chans, width, n)
+                f = np.matmul(wfs.transpose(2, 0, 1), self.projections[chans])
+                features3d[ind[:, None], chans[None, :], :] = f.transpose(1, 0, 2)
         #~ t2 = time.perf_counter()
         #~ print('pca transform', t2-t1)
-            
-            
-        return features
         
+        self.waveforms = None
+        
+        return features
     
     def transform(self, waveforms):
         n = self.n_components_by_channel
-        all = np.zeros((waveforms.shape[0], waveforms.shape[2]*n), dtype=self.dtype)
-        for c, pca in enumerate(self.pcas):
-            if pca is None:
-                continue
-            #~ print(c)
-            all[:, c*n:(c+1)*n] = pca.transform(waveforms[:, :, c])
-        return all
+        # (chans, peaks, width) @ (chans, width, n)
+        f = np.matmul(np.asarray(waveforms, dtype=self.dtype).transpose(2, 0, 1), self.projections)
+        return f.transpose(1, 0, 2).reshape(waveforms.shape[0], waveforms.shape[2]*n)
 
 
 
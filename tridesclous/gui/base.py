@@ -3,6 +3,8 @@ import pyqtgraph as pg
 
 import time
 
+import numpy as np
+
 
 class ControllerBase(QT.QObject):
     spike_selection_changed = QT.pyqtSignal()
@@ -14,6 +16,7 @@ class ControllerBase(QT.QObject):
     def __init__(self, parent=None):
         QT.QObject.__init__(self, parent=parent)
         self.views = []
+        self._spike_time_index = None
     
     def declare_a_view(self, new_view):
         assert new_view not in self.views, 'view already declared {}'.format(self)
@@ -66,6 +69,56 @@ class ControllerBase(QT.QObject):
             #~ t2 = time.perf_counter()
             #~ print('on_cluster_tag_changed',view,  t2-t1)
 
+    def get_spike_window(self, seg_num, i_start, i_stop):
+        """
+        Select in self.spikes the spikes of segment seg_num with i_start<=index<i_stop.
+        
+        Return a slice when spikes are sorted by (segment, index), this is done with
+        np.searchsorted on a cached contiguous copy of spikes['index'].
+        Otherwise return a boolean mask.
+        """
+        spikes = self.spikes
+        if self._spike_time_index is None or self._spike_time_index[0] is not spikes or \
+                    self._spike_time_index[1].size != spikes.size:
+            index = spikes['index'].copy()
+            segment = spikes['segment'].copy()
+            d_seg = np.diff(segment)
+            is_sorted = np.all((d_seg > 0) | ((d_seg == 0) & (np.diff(index) >= 0)))
+            if is_sorted:
+                seg_offsets = np.searchsorted(segment, np.arange(self.dataio.nb_segment + 1), side='left')
+            else:
+                seg_offsets = None
+            self._spike_time_index = (spikes, index, seg_offsets)
+        
+        _, index, seg_offsets = self._spike_time_index
+        if seg_offsets is None:
+            return (spikes['segment'] == seg_num) & (spikes['index'] >= i_start) & (spikes['index'] < i_stop)
+        
+        s0, s1 = seg_offsets[seg_num], seg_offsets[seg_num+1]
+        i0 = s0 + np.searchsorted(index[s0:s1], i_start, side='left')
+        i1 = s0 + np.searchsorted(index[s0:s1], i_stop, side='left')
+        return slice(int(i0), int(max(i0, i1)))
+    
+    def get_spikes_in_window(self, seg_num, i_start, i_stop):
+        """
+        Return (spikes_chunk, selected) : copy of spikes of segment seg_num
+        with i_start<=index<i_stop and their selection state.
+        """
+        keep = self.get_spike_window(seg_num, i_start, i_stop)
+        spikes_chunk = np.array(self.spikes[keep], copy=True)
+        selected = np.array(self.spike_selection[keep])
+        return spikes_chunk, selected
+    
+    @property
+    def spikes_loaded(self):
+        return True
+    
+    def get_spike_fields(self, fields):
+        """
+        Return a dict field -> array of this field for all spikes (all segments).
+        """
+        return {k: self.spikes[k] for k in fields}
+    
     @property
     def channel_indexes(self):
         channel_group = self.dataio.channel_groups[self.chan_grp]
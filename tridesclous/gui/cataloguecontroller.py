@@ -109,6 +109,10 @@ class CatalogueController(ControllerBase):
     def cell_labels(self):
         return self.cc.clusters['cell_label']
         
+    @property
+    def nb_spike(self):
+        return self.cc.nb_peak
+    
     @property
     def spike_index(self):
         return self.cc.all_peaks['index']
@@ -224,7 +224,13 @@ class CatalogueWindow(QT.QMainWindow):
         dia.resize(450, 500)
         if dia.exec_():
             d = dia.get()
-            self.catalogueconstructor.re_detect_peak(**d)
+            cc = self.catalogueconstructor
+            if d['method'] == 'geometrical':
+                # candidates are detected once, next tries with higher threshold are only a filter
+                cc.set_peak_detector_params(**d)
+                if not cc.can_re_detect_from_candidates():
+                    cc.cache_peak_candidates()
+            cc.re_detect_peak(**d)
             self.controller.init_plot_attributes()
         self.refresh()
     
@@ -273,7 +279,7 @@ class CatalogueWindow(QT.QMainWindow):
             cc.clean_peaks(**d['clean_peaks'])
             cc.sample_some_peaks(**d['peak_sampler'])
             cc.extract_some_noise(**d['noise_snippet'])
-            cc.compute_all_centroid(n_spike_for_centroid=_default_n_spike_for_centroid)
+            cc.compute_all_centroid(n_spike_for_centroid=_default_n_spike_for_centroid, n_jobs=cc.n_jobs)
             self.refresh()
 
     def new_features(self):
@@ -298,7 +304,8 @@ class CatalogueWindow(QT.QMainWindow):
             #~ self.catalogueconstructor.compute_spike_waveforms_similarity(method=d['spike_waveforms_similarity'], size_max=d['size_max'])
             self.catalogueconstructor.compute_cluster_similarity(method=d['cluster_similarity'])
             self.catalogueconstructor.compute_cluster_ratio_similarity(method=d['cluster_ratio_similarity'])
-            self.catalogueconstructor.compute_spike_silhouette(size_max=d['size_max'])
+            self.catalogueconstructor.compute_spike_silhouette(size_max=d['size_max'], method=d['silhouette_method'],
+                                space=d['silhouette_space'], n_spike_by_cluster=d['n_spike_by_cluster'])
             #TODO refresh only metrics concerned
             self.refresh()
         
@@ -57,7 +57,7 @@ class CrossCorrelogramViewer(WidgetBase):
     
     def compute_ccg(self):
         cluster_labels = self.controller.positive_cluster_labels
-        spikes = self.controller.spikes
+        spikes = self.controller.get_spike_fields(['index', 'cluster_label', 'segment'])
         try:
             # this prevent some bug like this one https://github.com/tridesclous/tridesclous/issues/69
             self.ccg, self.bins = compute_cross_correlograms(spikes['index'], spikes['cluster_label'],
@@ -14,6 +14,7 @@ Preprocessor
     * common_ref_removal (bool): this substracts sample by sample the median across channels
        When there is a strong noise that appears on all channels (sometimes due to reference) you
        can substract it. This is as if all channels would re referenced numerically to there medians.
+    * common_ref_mode (str): 'median' or 'mean', the estimator used for the common reference.
     * chunksize (int): the whole processing chain is applied chunk by chunk, this is the chunk size in sample. Typically 1024.
        The smaller size lead to less memory but more CPU comsuption in Peeler. For online, this will be more or less the latency.
     * lostfront_chunksize (int): size in sample of the margin at the front edge for each chunk to avoid border effect in backward filter.
@@ -22,7 +23,8 @@ Preprocessor
     * engine (str): 'numpy' or 'opencl'. There is a double implementation for signal preprocessor : With numpy/scipy
       flavor (and so CPU) or opencl with home made CL kernel (and so use GPU computing). If you have big fat GPU and are able to install
       "opencl driver" (ICD) for your platform the opencl flavor should speedup the peeler because pre processing signal take a quite
-      important amoung of time.
+      important amoung of time. 'numpy_threads' is the numpy flavor with channels splitted across threads, this
+      help for high channel count.
     
 Peak detector
 ----------------------
@@ -154,14 +156,15 @@ preprocessor_params = [
     {'name': 'lowpass_freq', 'type': 'float', 'value':5000., 'step': 10., 'suffix': 'Hz', 'siPrefix': True},
     {'name': 'smooth_size', 'type': 'int', 'value':0},
     {'name': 'common_ref_removal', 'type': 'bool', 'value':False},
+    {'name': 'common_ref_mode', 'type': 'list', 'value':'median', 'values':['median', 'mean']},
     #~ {'name': 'chunksize', 'type': 'int', 'value':1024, 'decimals':10},
     {'name': 'lostfront_chunksize', 'type': 'int', 'value':-1, 'decimals':10, 'limits': (-1, np.inf),},
-    {'name': 'engine', 'type': 'list', 'value' : 'numpy', 'values':['numpy', 'opencl']},
+    {'name': 'engine', 'type': 'list', 'value' : 'numpy', 'values':['numpy', 'numpy_threads', 'opencl']},
 ]
 
 peak_detector_params = [
     {'name': 'method', 'type': 'list', 'value' : 'global', 'values':['global', 'geometrical']},
-    {'name': 'engine', 'type': 'list', 'value' : 'numpy', 'values':['numpy', 'opencl', 'numba']},
+    {'name': 'engine', 'type': 'list', 'value' : 'numpy', 'values':['numpy', 'opencl', 'numba', 'numba_list']},
     {'name': 'peak_sign', 'type': 'list',  'value':'-', 'values':['-', '+']},
     {'name': 'relative_threshold', 'type': 'float', 'value': 5., 'step': .1,},
     {'name': 'peak_span_ms', 'type': 'float', 'value':0.5, 'step': 0.05, 'suffix': 'ms', 'siPrefix': False},
@@ -297,6 +300,9 @@ metrics_params = [
     {'name': 'cluster_similarity', 'type': 'list', 'values' : [ 'cosine_similarity_with_max']},
     {'name': 'cluster_ratio_similarity', 'type': 'list', 'values' : [ 'cosine_similarity_with_max']},
     {'name': 'size_max', 'type': 'int', 'value':10000000},
+    {'name': 'silhouette_method', 'type': 'list', 'values' : ['subsample', 'simplified', 'exact']},
+    {'name': 'silhouette_space', 'type': 'list', 'values' : ['waveforms', 'features']},
+    {'name': 'n_spike_by_cluster', 'type': 'int', 'value':100},
 ]
 
 
@@ -317,7 +323,7 @@ _classic_peeler_params = _common_peeler_params + [
 ]
 
 _geometrical_peeler_params = _common_peeler_params + [
-    {'name': 'argmin_method', 'type': 'list', 'values' : [ 'numpy', 'opencl', 'numba',]},
+    {'name': 'argmin_method', 'type': 'list', 'values' : [ 'numpy', 'opencl', 'numba', 'xcorr']},
     {'name':'adjacency_radius_um', 'type': 'float', 'value':100., 'suffix': 'µm', 'siPrefix': False},
 ]
 
@@ -60,13 +60,11 @@ class ISIViewer(WidgetBase):
         #ISI are computed on demand
         self.all_isi = {}
     
-    def _compute_isi(self, k):
-        spikes = self.controller.spikes
-        
+    def _compute_isi(self, k, spikes):
         isi = []
         for seg_num in range(self.controller.dataio.nb_segment):
             sel = (spikes['segment'] == seg_num) & (spikes['cluster_label'] == k)
-            isi.append(np.diff(spikes[sel]['index'])/self.controller.dataio.sample_rate)
+            isi.append(np.diff(spikes['index'][sel])/self.controller.dataio.sample_rate)
         isi = np.concatenate(isi)
         self.all_isi[k] = isi * 1000. #ms
 
@@ -74,12 +72,16 @@ class ISIViewer(WidgetBase):
         self.plot.clear()
         
         n = 0
+        spikes = None
         for k in self.controller.positive_cluster_labels:
             if not self.controller.cluster_visible[k]:
                 continue
             
             if k not in self.all_isi:
-                self._compute_isi(k)
+                if spikes is None:
+                    # only needed fields, this do not force the controller to load all spikes
+                    spikes = self.controller.get_spike_fields(['segment', 'cluster_label', 'index'])
+                self._compute_isi(k, spikes)
             
             isi = self.all_isi[k]
             if len(isi) ==0:
@@ -34,47 +34,21 @@ class PeelerController(ControllerBase):
         self.update_visible_spikes()
     
     def init_plot_attributes(self):
-        #concatenate all spikes for all segments
-        self.spikes = []
+        # spikes of all segments are concatenated only when self.spikes is accessed
+        # the window accessor get_spikes_in_window() read directly the DataIO
+        self._spikes = None
+        self._cluster_count = None
         
+        sizes = []
         for i in range(self.dataio.nb_segment):
             local_spikes = self.dataio.get_spikes(seg_num=i, chan_grp=self.chan_grp)
-            spikes = np.zeros(local_spikes.shape, dtype=_dtype_spike+_dtype_complement)
-            for k, _ in _dtype_spike:
-                spikes[k] = local_spikes[k]
-            spikes['segment'] = i
-            spikes['visible'] = spikes['cluster_label']>=0
-            spikes['selected'] = False
-            
-            
-            clusters = self.catalogue['clusters']
-            cluster_labels = clusters['cluster_label']
-            cell_labels = clusters['cell_label']
-            
-            #set cell_label <0 are the same >0 are converted for 'clusters' table in catalogue
-            mask = spikes['cluster_label']<0
-            spikes['cell_label'][mask] = spikes['cluster_label'][mask]
-            
-            mask = spikes['cluster_label']>=0
-            # searchsorter wotk with ordered
-            clus = clusters[clusters['cluster_label']>=0]
-            order = np.argsort(clus['cluster_label'])
-            clus = clus[order].copy()
-            spike_cluster_index = np.searchsorted(clus['cluster_label'], spikes['cluster_label'][mask].copy())
-            spikes['cell_label'][mask] = clus['cell_label'][spike_cluster_index]
-            
-            self.spikes.append(spikes)
-        self.spikes = np.concatenate(self.spikes)
-        
-        self.nb_spike = int(self.spikes.size)
+            sizes.append(0 if local_spikes is None else local_spikes.size)
+        self.segment_spike_offsets = np.cumsum([0] + sizes)
+        self.nb_spike = int(self.segment_spike_offsets[-1])
         
         self.cluster_labels = self.catalogue['clusters']['cluster_label']
         
-        # set channel for each cluster
-        for i, k in enumerate(self.cluster_labels):
-            chan = self.catalogue['extremum_channel'][i]
-            sel = self.spikes['cluster_label'] == k
-            self.spikes['channel'][sel] = chan
+        self._make_label_lookup_tables()
         
         # compute sparse mask
         # TODO : put this mask in catalogue directly
@@ -87,10 +61,6 @@ class PeelerController(ControllerBase):
         
         #~ self.cluster_labels = np.unique(self.spikes['cluster_label'])#TODO take from catalogue
         
-        
-        self.cluster_count = { k:np.sum(self.spikes['cluster_label']==k) for k in self.cluster_labels}
-        
-        
         self.cluster_visible = {k:k>=0 for k  in self.cluster_labels}
 
         
@@ -103,6 +73,102 @@ class PeelerController(ControllerBase):
         
         self.spike_visible_mode = spike_visible_modes[0]
     
+    def _make_label_lookup_tables(self):
+        # cluster_label -> cell_label and cluster_label -> channel
+        # tables are indexed by cluster_label - self._lut_offset
+        clusters = self.catalogue['clusters']
+        all_labels = np.concatenate([clusters['cluster_label'], list(labelcodes.to_name.keys())])
+        self._lut_offset = int(np.min(all_labels))
+        size = int(np.max(all_labels)) - self._lut_offset + 1
+        
+        # cell_label <0 are the same >0 are converted for 'clusters' table in catalogue
+        self._cell_label_lut = np.arange(size, dtype='int64') + self._lut_offset
+        pos = clusters['cluster_label']>=0
+        self._cell_label_lut[clusters['cluster_label'][pos] - self._lut_offset] = clusters['cell_label'][pos]
+        
+        self._channel_lut = np.zeros(size, dtype='int64')
+        self._channel_lut[self.cluster_labels - self._lut_offset] = self.catalogue['extremum_channel']
+    
+    def _lookup(self, lut, cluster_labels):
+        ind = cluster_labels - self._lut_offset
+        valid = (ind>=0) & (ind<lut.size)
+        if np.all(valid):
+            return lut[ind]
+        out = np.zeros(cluster_labels.shape, dtype=lut.dtype)
+        out[valid] = lut[ind[valid]]
+        return out
+    
+    def _make_spikes_table(self, local_spikes, seg_num):
+        spikes = np.zeros(local_spikes.shape, dtype=_dtype_spike+_dtype_complement)
+        for k, _ in _dtype_spike:
+            spikes[k] = local_spikes[k]
+        spikes['segment'] = seg_num
+        spikes['cell_label'] = self._lookup(self._cell_label_lut, spikes['cluster_label'])
+        spikes['channel'] = self._lookup(self._channel_lut, spikes['cluster_label'])
+        spikes['visible'] = self._visible_mask(spikes)
+        spikes['selected'] = False
+        return spikes
+    
+    @property
+    def spikes(self):
+        if self._spikes is None:
+            all_spikes = []
+            for i in range(self.dataio.nb_segment):
+                local_spikes = self.dataio.get_spikes(seg_num=i, chan_grp=self.chan_grp)
+                if local_spikes is None:
+                    local_spikes = np.zeros(0, dtype=_dtype_spike)
+                all_spikes.append(self._make_spikes_table(local_spikes, i))
+            self._spikes = np.concatenate(all_spikes)
+        return self._spikes
+    
+    def get_spikes_in_window(self, seg_num, i_start, i_stop):
+        if self._spikes is not None:
+            return ControllerBase.get_spikes_in_window(self, seg_num, i_start, i_stop)
+        # not concatenated yet : only this window is read, nothing can be selected
+        local_spikes = self.dataio.get_spikes(seg_num=seg_num, chan_grp=self.chan_grp, t_start=i_start, t_stop=i_stop)
+        spikes_chunk = self._make_spikes_table(local_spikes, seg_num)
+        return spikes_chunk, spikes_chunk['selected'].copy()
+    
+    @property
+    def spikes_loaded(self):
+        return self._spikes is not None
+    
+    def get_spike_fields(self, fields):
+        if self._spikes is not None:
+            return ControllerBase.get_spike_fields(self, fields)
+        # not concatenated yet : only the needed fields are read segment by segment
+        out = {k: [] for k in fields}
+        for i in range(self.dataio.nb_segment):
+            local_spikes = self.dataio.get_spikes(seg_num=i, chan_grp=self.chan_grp)
+            if local_spikes is None:
+                local_spikes = np.zeros(0, dtype=_dtype_spike)
+            for k in fields:
+                if k == 'segment':
+                    v = np.full(local_spikes.size, i, dtype='int64')
+                elif k == 'cell_label':
+                    v = self._lookup(self._cell_label_lut, local_spikes['cluster_label'])
+                elif k == 'channel':
+                    v = self._lookup(self._channel_lut, local_spikes['cluster_label'])
+                else:
+                    v = np.array(local_spikes[k], copy=True)
+                out[k].append(v)
+        return {k: np.concatenate(out[k]) for k in fields}
+    
+    @property
+    def cluster_count(self):
+        if self._cluster_count is None:
+            # bincount on the label field without concatenating segments
+            counts = np.zeros(self._channel_lut.size, dtype='int64')
+            for i in range(self.dataio.nb_segment):
+                local_spikes = self.dataio.get_spikes(seg_num=i, chan_grp=self.chan_grp)
+                if local_spikes is None or local_spikes.size == 0:
+                    continue
+                ind = local_spikes['cluster_label'] - self._lut_offset
+                ind = ind[(ind>=0) & (ind<counts.size)]
+                counts += np.bincount(ind, minlength=counts.size)
+            self._cluster_count = {k: int(counts[k - self._lut_offset]) for k in self.cluster_labels}
+        return self._cluster_count
+    
     def check_plot_attributes(self):
         for k in self.cluster_labels:
             if k not in self.cluster_visible:
@@ -120,6 +186,9 @@ class PeelerController(ControllerBase):
     
     @property
     def spike_selection(self):
+        if self._spikes is None:
+            # nothing can be selected before spikes are concatenated
+            return np.zeros(self.nb_spike, dtype='bool')
         return self.spikes['selected']
 
     @property
@@ -217,23 +286,39 @@ class PeelerController(ControllerBase):
         #~ print(mode)
         self.spike_visible_mode = mode
         
-    def update_visible_spikes(self):
-        #~ print('update_visible_spikes', self.spike_visible_mode)
+    def get_spike_window(self, seg_num, i_start, i_stop):
+        # self.spikes is the concatenation of sorted spikes of each segment
+        # so the time index of the DataIO is used directly
+        i0, i1 = self.dataio.get_spikes_slice(seg_num=seg_num, chan_grp=self.chan_grp, t_start=i_start, t_stop=i_stop)
+        offset = self.segment_spike_offsets[seg_num]
+        return slice(int(offset + i0), int(offset + i1))
+    
+    def _visible_mask(self, spikes):
         #~ ['selected', 'all',  'collision']
         if self.spike_visible_mode=='selected':
-            visibles = np.array([k for k, v in self.cluster_visible.items() if v ])
-            self.spikes['visible'][:] = np.in1d(self.spikes['cluster_label'], visibles)
+            visible_lut = np.zeros(self._channel_lut.size, dtype='bool')
+            for k, v in self.cluster_visible.items():
+                visible_lut[k - self._lut_offset] = v
+            visible = self._lookup(visible_lut, spikes['cluster_label'])
         elif self.spike_visible_mode=='all':
-            self.spikes['visible'][:] = True
+            visible = np.ones(spikes.size, dtype='bool')
         elif self.spike_visible_mode=='collision':
-            self.spikes['visible'][:] = False
-            d = np.diff(self.spikes['index'])
-            labels0 = self.spikes['cluster_label'][:-1]
-            labels1 = self.spikes['cluster_label'][1:]
+            visible = np.zeros(spikes.size, dtype='bool')
+            d = np.diff(spikes['index'])
+            labels0 = spikes['cluster_label'][:-1]
+            labels1 = spikes['cluster_label'][1:]
             mask = (d>0) & (d< self.catalogue['peak_width'] ) & (labels0>0) & (labels1>0)
             ind, = np.nonzero(mask)
-            self.spikes['visible'][ind] = True
-            self.spikes['visible'][ind+1] = True
+            visible[ind] = True
+            visible[ind+1] = True
+        return visible
+    
+    def update_visible_spikes(self):
+        #~ print('update_visible_spikes', self.spike_visible_mode)
+        if self._spikes is None:
+            # done when spikes are concatenated
+            return
+        self._spikes['visible'][:] = self._visible_mask(self._spikes)
             
             
             
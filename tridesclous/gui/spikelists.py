@@ -23,7 +23,11 @@ class SpikeModel(QT.QAbstractItemModel):
     def rowCount(self, parentIndex):
         #~ if not parentIndex.isValid() and self.cc.peak_label is not None:
         if not parentIndex.isValid():
-            self.visible_ind, = np.nonzero(self.controller.spikes['visible'])
+            if not self.controller.spikes_loaded:
+                # the full spikes table is loaded only on user demand
+                self.visible_ind = np.zeros(0, dtype='int64')
+            else:
+                self.visible_ind, = np.nonzero(self.controller.spikes['visible'])
             return self.visible_ind.size
             
         else :
@@ -123,6 +127,10 @@ class SpikeList(WidgetBase):
         self.combo.addItems(spike_visible_modes)
         self.combo.currentTextChanged.connect(self.change_visible_mode)
         
+        self.but_load = QT.QPushButton('Load all spikes')
+        self.layout.addWidget(self.but_load)
+        self.but_load.clicked.connect(self.load_spikes)
+        
         self.tree = QT.QTreeView(minimumWidth = 100, uniformRowHeights = True,
                     selectionMode= QT.QAbstractItemView.ExtendedSelection, selectionBehavior = QT.QTreeView.SelectRows,
                     contextMenuPolicy = QT.Qt.CustomContextMenu,)
@@ -137,10 +145,18 @@ class SpikeList(WidgetBase):
         for i in range(self.model.columnCount(None)):
             self.tree.resizeColumnToContents(i)
         self.tree.setColumnWidth(0,80)
+        
+        self.but_load.setVisible(not self.controller.spikes_loaded)
     
     def refresh(self):
+        self.but_load.setVisible(not self.controller.spikes_loaded)
         self.model.refresh_colors()
     
+    def load_spikes(self):
+        # this concatenate spikes of all segments, can be long for big dataset
+        self.controller.spikes
+        self.refresh()
+    
     def on_tree_selection(self):
         self.controller.spikes['selected'][:] = False
         for index in self.tree.selectedIndexes():
@@ -150,6 +166,12 @@ class SpikeList(WidgetBase):
         self.spike_selection_changed.emit()
     
     def on_spike_selection_changed(self):
+        if not self.controller.spikes_loaded:
+            return
+        elif not self.but_load.isHidden():
+            # spikes have been loaded by another view
+            self.refresh()
+        
         self.tree.selectionModel().selectionChanged.disconnect(self.on_tree_selection)
         
         row_selected, = np.nonzero(self.controller.spikes['selected'][self.model.visible_ind])
@@ -127,7 +127,47 @@ def test_PeelerWindow():
     if __name__ == '__main__':
         app.exec_()
 
+
+@pytest.mark.skipif(ON_CI_CLOUD, reason='ON_CI_CLOUD')
+def test_PeelerWindow_lazy_spikes():
+    dataio = DataIO(dirname='test_peelerwindow')
+    initial_catalogue = dataio.load_catalogue(chan_grp=0)
+
+    app = pg.mkQApp()
+    win = PeelerWindow(dataio=dataio, catalogue=initial_catalogue)
+    win.show()
+    app.processEvents()
+    controller = win.controller
+    for k in controller.cluster_labels:
+        controller.cluster_visible[k] = False
+    for k in controller.cluster_labels[3:6]:
+        controller.cluster_visible[k] = True
     
+    # views that list all spikes must not concatenate the spikes table
+    win.isiviewer.refresh()
+    win.crosscorrelogramviewer.compute_ccg()
+    win.spikelist.refresh()
+    app.processEvents()
+    assert not controller.spikes_loaded
+    assert win.spikelist.model.rowCount(QT.QModelIndex()) == 0
+    lazy_isi = dict(win.isiviewer.all_isi)
+    lazy_ccg = win.crosscorrelogramviewer.ccg.copy()
+    
+    # same result once the table is loaded on user demand
+    win.spikelist.load_spikes()
+    assert controller.spikes_loaded
+    assert win.spikelist.model.rowCount(QT.QModelIndex()) == np.sum(controller.spikes['visible'])
+    
+    win.isiviewer.all_isi = {}
+    win.isiviewer.refresh()
+    assert list(lazy_isi.keys()) == list(win.isiviewer.all_isi.keys())
+    for k, isi in lazy_isi.items():
+        np.testing.assert_array_equal(isi, win.isiviewer.all_isi[k])
+    win.crosscorrelogramviewer.compute_ccg()
+    np.testing.assert_array_equal(lazy_ccg, win.crosscorrelogramviewer.ccg)
+    
+    win.close()
+
     
 if __name__ == '__main__':
     setup_module()
@@ -140,6 +180,7 @@ if __name__ == '__main__':
     #~ test_PeelerWaveformViewer()
     #~ test_ISIViewer()
     #~ test_CrossCorrelogramViewer()
+    #~ test_PeelerWindow_lazy_spikes()
     
     test_PeelerWindow()
 
@@ -417,17 +417,14 @@ class BaseTraceViewer(WidgetBase):
         
         
         # plot peak on signal
-        all_spikes = self.controller.spikes
-        if len(all_spikes)>0:
-            keep = (all_spikes['segment']==self.seg_num) & (all_spikes['index']>=ind1) & (all_spikes['index']<ind2)
-            spikes_chunk = np.array(all_spikes[keep], copy=True)
+        if self.controller.nb_spike>0:
+            spikes_chunk, inwindow_selected = self.controller.get_spikes_in_window(self.seg_num, ind1, ind2)
             spikes_chunk['index'] -= ind1
             inwindow_ind = spikes_chunk['index']
             inwindow_label = spikes_chunk['cluster_label']
             inwindow_chan = spikes_chunk['channel']
             if np.any(inwindow_chan==-1):
                 inwindow_chan = None
-            inwindow_selected = np.array(self.controller.spike_selection[keep])
 
             self.scatter.clear()
             all_x = []
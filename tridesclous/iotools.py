@@ -4,9 +4,281 @@ import io
 import sys
 import shutil
 import gc
+import zlib
+import lzma
+from collections import OrderedDict
 
 import numpy as np
 
+
+class CompressedChunkedArray:
+    """
+    2D array (nb_sample x nb_channel) stored on disk as compressed chunks along axis 0.
+    
+    This is used by ArrayCollection for memory_mode='compressed' (typically for processed_signals).
+    
+    Each chunk of `chunksize` samples is encoded and appended in the data file.
+    A chunk index (offset, nbytes) give random access to chunks.
+    A rewritten chunk is written in place when it is not bigger than the previous one,
+    otherwise in a free slot (left by previous rewrites) or at the end of the file.
+    
+    Codecs:
+      * 'int16' : scaled int16 with a gain per channel (and per chunk). Lossy (1/65535 of the chunk max).
+      * 'int16+zlib' : same + zlib
+      * 'zlib' : lossless zlib of the raw buffer
+      * 'lzma' : lossless lzma of the raw buffer
+    
+    Reading is done with slicing on axis 0 like a np.memmap: arr[i_start:i_stop, :].
+    Writing must be done on full rows: arr[i_start:i_stop, :] = data.
+    Chunks being written are kept in memory until evicted or flush().
+    Non written chunks are read as zeros.
+    """
+    codecs = ('int16', 'int16+zlib', 'zlib', 'lzma')
+    max_pending = 2
+    
+    def __init__(self, filename, shape, dtype, chunksize=1024, codec='int16', mode='r+'):
+        assert codec in self.codecs, 'codec must be in {}'.format(self.codecs)
+        assert len(shape) == 2
+        self.filename = filename
+        self.index_filename = filename + '.index'
+        self.shape = tuple(int(e) for e in shape)
+        self.dtype = np.dtype(dtype)
+        self.chunksize = int(chunksize)
+        self.codec = codec
+        
+        self.nb_chunk = (self.shape[0] + self.chunksize - 1) // self.chunksize
+        
+        if mode == 'w+' or not os.path.exists(self.filename):
+            self._file = open(self.filename, mode='w+b')
+            # offset, nbytes (nbytes=0 means not written)
+            self.index = np.zeros((self.nb_chunk, 2), dtype='int64')
+        else:
+            self._file = open(self.filename, mode='r+b')
+            with open(self.index_filename, mode='rb') as f:
+                self.index = np.load(f)
+            assert self.index.shape == (self.nb_chunk, 2)
+        # free slots (offset, nbytes) in the file left by rewritten chunks
+        self._free = self._make_free_list()
+        
+        self._pending = OrderedDict()
+        self._cache_ind = None
+        self._cache_data = None
+    
+    @property
+    def ndim(self):
+        return 2
+    
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __array__(self, dtype=None):
+        arr = self[:, :]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+    
+    def _chunk_length(self, ind):
+        return min(self.chunksize, self.shape[0] - ind * self.chunksize)
+    
+    def _encode(self, data):
+        if self.codec.startswith('int16'):
+            data = data.astype('float32')
+            gains = np.max(np.abs(data), axis=0) / 32767.
+            gains[gains == 0] = 1.
+            gains = gains.astype('float32')
+            data_int16 = np.round(data / gains).astype('int16')
+            buf = gains.tobytes() + data_int16.tobytes()
+            if self.codec == 'int16+zlib':
+                buf = zlib.compress(buf, 1)
+        elif self.codec == 'zlib':
+            buf = zlib.compress(np.ascontiguousarray(data).tobytes(), 1)
+        elif self.codec == 'lzma':
+            buf = lzma.compress(np.ascontiguousarray(data).tobytes(), preset=0)
+        return buf
+    
+    def _decode(self, buf, length):
+        nb_channel = self.shape[1]
+        if self.codec.startswith('int16'):
+            if self.codec == 'int16+zlib':
+                buf = zlib.decompress(buf)
+            gains = np.frombuffer(buf, dtype='float32', count=nb_channel)
+            data_int16 = np.frombuffer(buf, dtype='int16', offset=4*nb_channel).reshape(length, nb_channel)
+            data = (data_int16 * gains).astype(self.dtype)
+        elif self.codec == 'zlib':
+            data = np.frombuffer(zlib.decompress(buf), dtype=self.dtype).reshape(length, nb_channel).copy()
+        elif self.codec == 'lzma':
+            data = np.frombuffer(lzma.decompress(buf), dtype=self.dtype).reshape(length, nb_channel).copy()
+        return data
+    
+    def _read_chunk(self, ind):
+        if ind in self._pending:
+            return self._pending[ind]
+        if ind == self._cache_ind:
+            return self._cache_data
+        length = self._chunk_length(ind)
+        offset, nbytes = self.index[ind]
+        if nbytes == 0:
+            data = np.zeros((length, self.shape[1]), dtype=self.dtype)
+        else:
+            self._file.seek(offset)
+            data = self._decode(self._file.read(nbytes), length)
+        self._cache_ind = ind
+        self._cache_data = data
+        return data
+    
+    def _make_free_list(self):
+        # holes between written chunks (after rewrites) that can be reused
+        used = self.index[self.index[:, 1] > 0]
+        used = used[np.argsort(used[:, 0])]
+        free = []
+        pos = 0
+        for offset, nbytes in used:
+            if offset > pos:
+                free.append([int(pos), int(offset - pos)])
+            pos = max(pos, int(offset + nbytes))
+        return free
+    
+    def _release(self, offset, nbytes):
+        # add a free slot and merge it with its neighbours
+        free = sorted(self._free + [[offset, nbytes]])
+        self._free = [free[0]]
+        for offset, nbytes in free[1:]:
+            last = self._free[-1]
+            if last[0] + last[1] == offset:
+                last[1] += nbytes
+            else:
+                self._free.append([offset, nbytes])
+    
+    def _allocate(self, nbytes):
+        # first fit in the free list, otherwise at the end of the file
+        for i, (offset, size) in enumerate(self._free):
+            if size >= nbytes:
+                if size == nbytes:
+                    self._free.pop(i)
+                else:
+                    self._free[i] = [offset + nbytes, size - nbytes]
+                return offset
+        self._file.seek(0, os.SEEK_END)
+        return self._file.tell()
+    
+    def _write_chunk(self, ind, data):
+        buf = self._encode(data)
+        old_offset, old_nbytes = (int(e) for e in self.index[ind])
+        if old_nbytes > 0 and len(buf) <= old_nbytes:
+            # rewrite in place, the end of the old slot is free
+            offset = old_offset
+            if len(buf) < old_nbytes:
+                self._release(old_offset + len(buf), old_nbytes - len(buf))
+        else:
+            if old_nbytes > 0:
+                self._release(old_offset, old_nbytes)
+            offset = self._allocate(len(buf))
+        self._file.seek(offset)
+        self._file.write(buf)
+        self.index[ind, 0] = offset
+        self.index[ind, 1] = len(buf)
+        if ind == self._cache_ind:
+            self._cache_ind = None
+            self._cache_data = None
+    
+    def _get_pending(self, ind):
+        if ind not in self._pending:
+            data = self._read_chunk(ind).copy()
+            self._pending[ind] = data
+            while len(self._pending) > self.max_pending:
+                ind0, data0 = self._pending.popitem(last=False)
+                self._write_chunk(ind0, data0)
+        return self._pending[ind]
+    
+    def _rows(self, key):
+        # return (i_start, i_stop) for a contiguous slice or an index array
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step == 1:
+                return start, max(start, stop)
+            return np.arange(start, stop, step)
+        elif np.isscalar(key):
+            key = int(key)
+            if key < 0:
+                key += self.shape[0]
+            return key, key + 1
+        else:
+            return np.asarray(key)
+    
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            assert len(key) <= 2
+            key0 = key[0]
+            key1 = key[1] if len(key) == 2 else slice(None)
+        else:
+            key0, key1 = key, slice(None)
+        
+        rows = self._rows(key0)
+        if isinstance(rows, tuple):
+            i_start, i_stop = rows
+            out = np.empty((i_stop - i_start, self.shape[1]), dtype=self.dtype)
+            ind = i_start // self.chunksize
+            while ind * self.chunksize < i_stop:
+                chunk_start = ind * self.chunksize
+                chunk = self._read_chunk(ind)
+                a = max(i_start, chunk_start)
+                b = min(i_stop, chunk_start + chunk.shape[0])
+                out[a - i_start:b - i_start] = chunk[a - chunk_start:b - chunk_start]
+                ind += 1
+        else:
+            out = np.empty((rows.size, self.shape[1]), dtype=self.dtype)
+            chunk_inds = rows // self.chunksize
+            for ind in np.unique(chunk_inds):
+                mask = chunk_inds == ind
+                out[mask] = self._read_chunk(ind)[rows[mask] - ind * self.chunksize]
+        
+        if np.isscalar(key0):
+            out = out[0]
+            return out[key1]
+        return out[:, key1]
+    
+    def __setitem__(self, key, value):
+        if isinstance(key, tuple):
+            key0 = key[0]
+            assert len(key) == 1 or key[1] == slice(None), 'CompressedChunkedArray only write full rows'
+        else:
+            key0 = key
+        rows = self._rows(key0)
+        assert isinstance(rows, tuple), 'CompressedChunkedArray only write contiguous rows'
+        i_start, i_stop = rows
+        value = np.broadcast_to(value, (i_stop - i_start, self.shape[1]))
+        
+        ind = i_start // self.chunksize
+        while ind * self.chunksize < i_stop:
+            chunk_start = ind * self.chunksize
+            chunk = self._get_pending(ind)
+            a = max(i_start, chunk_start)
+            b = min(i_stop, chunk_start + chunk.shape[0])
+            chunk[a - chunk_start:b - chunk_start] = value[a - i_start:b - i_start]
+            ind += 1
+    
+    def flush(self):
+        while len(self._pending) > 0:
+            ind, data = self._pending.popitem(last=False)
+            self._write_chunk(ind, data)
+        self._file.flush()
+        with open(self.index_filename, mode='wb') as f:
+            np.save(f, self.index)
+    
+    def close(self, flush=True):
+        if self._file.closed:
+            return
+        if flush:
+            self.flush()
+        self._file.close()
+    
+    def nbytes_on_disk(self):
+        return int(os.path.getsize(self.filename))
+
 class ArrayCollection:
     """
     Collection of arrays.
@@ -43,6 +315,9 @@ class ArrayCollection:
                                 shape=list(self._array[name].shape),
                                 annotations=self._array_attr[name]['annotations']
                                 )
+                if self._array_attr[name]['memory_mode'] == 'compressed':
+                    arr = self._array[name]
+                    d[name]['compressed'] = dict(chunksize=arr.chunksize, codec=arr.codec)
                 
             json.dump(d, f, indent=4)        
     
@@ -72,6 +347,13 @@ class ArrayCollection:
         
         """
         
+        if name in self._array and (self._array_attr[name]['memory_mode'] == 'compressed'):
+            a = self._array.pop(name)
+            a.close()
+            if self.parent is not None:
+                delattr(self.parent, name)
+            self._array_attr.pop(name)
+        
         if name in self._array and (self._array_attr[name]['memory_mode'] == 'memmap'):
             if (self._array_attr[name]['state'] == 'a'):
                 # case appendable and memmap
@@ -124,8 +406,11 @@ class ArrayCollection:
             #~ mode='w+'
         #~ return mode
     
-    def create_array(self, name, dtype, shape, memory_mode):
-        
+    def create_array(self, name, dtype, shape, memory_mode, **compressed_kargs):
+        """
+        memory_mode can be 'ram', 'memmap' or 'compressed'.
+        For 'compressed', compressed_kargs (chunksize, codec) are given to CompressedChunkedArray.
+        """
         if memory_mode=='ram':
             arr = np.zeros(shape, dtype=dtype)
         elif memory_mode=='memmap':
@@ -142,6 +427,9 @@ class ArrayCollection:
                     f.write('')
                 arr = np.empty(shape, dtype=dtype)
                 #~ print('empty array memmap !!!!', name, shape)
+        elif memory_mode=='compressed':
+            self._fix_existing(name)
+            arr = CompressedChunkedArray(self._fname(name), shape, dtype, mode='w+', **compressed_kargs)
         
         self._array[name] = arr
         self._array_attr[name] = {'state':'w', 'memory_mode':memory_mode, 'annotations':{}}
@@ -228,6 +516,8 @@ class ArrayCollection:
         elif memory_mode=='memmap':
             if self._array[name].size>0:
                 self._array[name].flush()
+        elif memory_mode=='compressed':
+            self._array[name].flush()
     
     
     def load_if_exists(self, name):
@@ -251,15 +541,23 @@ class ArrayCollection:
             else:
                 dtype = np.dtype([ (k,v) for k,v in d[name]['dtype']])
             shape = d[name]['shape']
-            if np.prod(d[name]['shape'])>0:
+            if 'compressed' in d[name]:
+                if name in self._array and self._array_attr[name]['memory_mode'] == 'compressed':
+                    # the file can have been written by another process: do not flush the old index
+                    self._array[name].close(flush=False)
+                arr = CompressedChunkedArray(self._fname(name), shape, dtype, mode='r+', **d[name]['compressed'])
+                memory_mode = 'compressed'
+            elif np.prod(d[name]['shape'])>0:
                 arr = np.memmap(self._fname(name), dtype=dtype, mode='r+')
                 arr = arr[:np.prod(shape)]
                 arr = arr.reshape(shape)
+                memory_mode = 'memmap'
             else:
+                memory_mode = 'memmap'
                 # little hack array is empty
                 arr = np.empty(shape, dtype=dtype)
             self._array[name] = arr
-            self._array_attr[name] = {'state':'r', 'memory_mode':'memmap'}
+            self._array_attr[name] = {'state':'r', 'memory_mode':memory_mode}
             self._array_attr[name]['annotations'] = d[name].get('annotations', {})
             if self.parent is not None:
                 setattr(self.parent, name, self._array[name])
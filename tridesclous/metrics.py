@@ -1,6 +1,14 @@
 import numpy as np
 import sklearn.metrics.pairwise
 import scipy.spatial
+import scipy.sparse
+
+try:
+    import numba
+    HAVE_NUMBA = True
+    from .numba_tools import numba_cosine_similarity_with_max
+except ImportError:
+    HAVE_NUMBA = False
 
 import matplotlib.pyplot as plt
 
@@ -13,29 +21,72 @@ def compute_similarity(data, method):
         raise(NotImplementedError)
 
 
-def cosine_similarity_with_max(x):
+def cosine_similarity_with_max(x, rows=None, sparse_mask=None, engine=None):
     """
     Similar to cosine_similarity but normed by the max(abs) on each dim.
     
     m = np.maximum(np.abs(u), np.abs(v))
     similarity = np.dot(u, v.T)/np.dot(m, m.T)
     
+    The numerator is one matrix product and the denominator use
+    sum(max(a, b)) = (sum(a) + sum(b) + sum(|a - b|)) / 2 with a = u**2, b = v**2
+    so it is a cityblock cdist.
+    
+    Arguments
+    ---------------
+    x: np.ndarray
+        shape (nb, ...) one flatten vector by row.
+        Must be (nb, width, nb_channel) when sparse_mask is given.
+    rows: None or np.array
+        Compute only theses rows (nb_row, nb) for incremental update.
+        None is all : (nb, nb)
+    sparse_mask: None or np.array
+        (nb, nb_channel) bool. When given each vector is zeros outside its mask,
+        so each pair is restricted to the union of their channels.
+    engine: None or 'numpy' or 'numba'
+        numba only for sparse. None is numba for sparse when available.
     """
-    def func(u, v):
-        #cosine affinity
-        #~ sim_final = np.dot(u, v.T)/(np.sqrt(np.dot(u, u.T))*np.sqrt(np.dot(v, v.T)))
-        
-        #cosine affinity
-        sim_final = np.dot(u, v.T)
-        #~ sim_final /= (np.sqrt(np.dot(u, u.T))*np.sqrt(np.dot(v, v.T)))
-        m = np.maximum(np.abs(u), np.abs(v))
-        sim_final /= np.dot(m, m.T)
-        return sim_final
+    nb = x.shape[0]
+    # all rows : only the upper triangle is computed
+    upper = rows is None
+    if rows is None:
+        rows = np.arange(nb)
+    rows = np.asarray(rows, dtype='int64')
+    
+    if engine is None:
+        engine = 'numba' if (HAVE_NUMBA and sparse_mask is not None) else 'numpy'
+    
+    if sparse_mask is not None:
+        assert x.ndim == 3
+        x = x * sparse_mask[:, None, :]
+    
+    if engine == 'numpy':
+        x = x.reshape(nb, -1).astype('float64')
+        a = x ** 2
+        sq_sum = np.sum(a, axis=1)
+        num = x[rows, :] @ x.T
+        if upper:
+            l1 = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(a, metric='cityblock'))
+        else:
+            l1 = scipy.spatial.distance.cdist(a[rows, :], a, metric='cityblock')
+        den = (sq_sum[rows, None] + sq_sum[None, :] + l1) / 2.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarity = num / den
+    elif engine == 'numba':
+        assert sparse_mask is not None
+        # channel first for a contiguous loop on samples
+        x = np.ascontiguousarray(x.transpose(0, 2, 1), dtype='float64')
+        sq_sum = np.sum(x ** 2, axis=(1, 2))
+        similarity = np.zeros((rows.size, nb), dtype='float64')
+        numba_cosine_similarity_with_max(x, np.ascontiguousarray(sparse_mask), sq_sum, rows, upper, similarity)
+        if upper:
+            similarity += similarity.T
+    else:
+        raise(NotImplementedError)
+    
+    similarity[np.arange(rows.size), rows] = 1.
     
-    cluster_similarity = scipy.spatial.distance.pdist(x, metric=func)
-    cluster_similarity = scipy.spatial.distance.squareform(cluster_similarity)
-    cluster_similarity += np.eye(cluster_similarity.shape[0])
-    return cluster_similarity
+    return similarity
     
     
 
@@ -57,3 +108,126 @@ def compute_silhouette(data, labels, metric='euclidean'):
     
     return silhouette_values#, silhouette_avg
     
+
+
+def compute_silhouette_approx(get_data, labels, method='subsample', n_spike_by_cluster=100, 
+                size_max=1e7, seed=None):
+    """
+    Approximate silhouette (euclidean) with bounded memory and a cost linear
+    in the number of spikes.
+    
+    Arguments
+    ---------------
+    get_data: function
+        get_data(ind) return the flatten data (ind.size, D) for ind a sorted array of
+        index in labels. So data can be read by block (waveforms in memmap for instance).
+    labels: np.array
+        label of each spike, all labels are clusters like in sklearn.metrics.silhouette_samples
+    method: 'subsample' or 'simplified'
+        * 'subsample': mean distances are computed to at most n_spike_by_cluster
+          spikes of each cluster
+        * 'simplified': distances to the mean of each cluster.
+    n_spike_by_cluster: int
+        Size of reference set by cluster for 'subsample'.
+    size_max: int
+        Max size of distance/data block in memory. When the reference set of
+        'subsample' (nb_ref, D) is bigger than size_max it is not kept in memory
+        but read again by block with get_data for each block of spikes.
+        For 'simplified', the (nb_cluster, D) means are always in memory.
+    seed: None or int
+        For the subsample.
+    
+    Returns
+    -----------
+    silhouette_values: np.array or None
+    """
+    labels = np.asarray(labels)
+    labels_list, cluster_index, cluster_size = np.unique(labels, return_inverse=True, return_counts=True)
+    nb_cluster = labels_list.size
+    if nb_cluster < 2:
+        return
+    
+    nb = labels.size
+    dim = get_data(np.arange(1)).shape[1]
+    
+    # reference blocks are (j0, j1, refs, refs_sq) with refs=None when read on demand
+    if method == 'subsample':
+        rng = np.random.RandomState(seed)
+        ref_index = []
+        for c in range(nb_cluster):
+            ind,  = np.nonzero(cluster_index == c)
+            if ind.size > n_spike_by_cluster:
+                ind = np.sort(rng.choice(ind, size=n_spike_by_cluster, replace=False))
+            ref_index.append(ind)
+        ref_index = np.sort(np.concatenate(ref_index))
+        ref_cluster = cluster_index[ref_index]
+        ref_count = np.bincount(ref_cluster, minlength=nb_cluster)
+        
+        is_ref = np.zeros(nb, dtype='bool')
+        is_ref[ref_index] = True
+        # sparse (nb_ref, nb_cluster) to sum distances by cluster
+        onehot = scipy.sparse.csr_matrix((np.ones(ref_index.size), (np.arange(ref_index.size), ref_cluster)),
+                                        shape=(ref_index.size, nb_cluster))
+        
+        ref_block_size = max(1, int(size_max // dim))
+        if ref_index.size <= ref_block_size:
+            refs = np.asarray(get_data(ref_index), dtype='float64')
+            ref_blocks = [(0, ref_index.size, refs, np.sum(refs**2, axis=1))]
+        else:
+            ref_blocks = [(j0, min(j0 + ref_block_size, ref_index.size), None, None)
+                                    for j0 in range(0, ref_index.size, ref_block_size)]
+    elif method == 'simplified':
+        # one pass for the mean of each cluster
+        refs = np.zeros((nb_cluster, dim), dtype='float64')
+        block_size = max(1, int(size_max // dim))
+        for i0 in range(0, nb, block_size):
+            ind = np.arange(i0, min(i0 + block_size, nb))
+            data = np.asarray(get_data(ind), dtype='float64')
+            summing = scipy.sparse.coo_matrix((np.ones(ind.size), (cluster_index[ind], np.arange(ind.size))),
+                                        shape=(nb_cluster, ind.size))
+            refs += summing @ data
+        refs /= cluster_size[:, None]
+        ref_blocks = [(0, nb_cluster, refs, np.sum(refs**2, axis=1))]
+    else:
+        raise(NotImplementedError)
+    
+    silhouette_values = np.zeros(nb, dtype='float64')
+    ref_size = max(j1 - j0 for j0, j1, _, _ in ref_blocks)
+    block_size = max(1, int(size_max // max(ref_size, dim)))
+    for i0 in range(0, nb, block_size):
+        ind = np.arange(i0, min(i0 + block_size, nb))
+        data = np.asarray(get_data(ind), dtype='float64')
+        data_sq = np.sum(data**2, axis=1)
+        
+        own = cluster_index[ind]
+        rows = np.arange(ind.size)
+        if method == 'subsample':
+            dist_sum = np.zeros((ind.size, nb_cluster), dtype='float64')
+        for j0, j1, refs, refs_sq in ref_blocks:
+            if refs is None:
+                refs = np.asarray(get_data(ref_index[j0:j1]), dtype='float64')
+                refs_sq = np.sum(refs**2, axis=1)
+            dist = data_sq[:, None] + refs_sq[None, :] - 2 * data @ refs.T
+            dist = np.sqrt(np.maximum(dist, 0.))
+            if method == 'subsample':
+                dist_sum += np.asarray(onehot[j0:j1].T @ dist.T).T
+        
+        if method == 'subsample':
+            # mean distance by cluster, the spike itself do not count in its own cluster
+            count = np.tile(ref_count[None, :].astype('float64'), (ind.size, 1))
+            count[rows, own] -= is_ref[ind]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean_dist = dist_sum / count
+        else:
+            mean_dist = dist
+        
+        a = mean_dist[rows, own]
+        mean_dist[rows, own] = np.inf
+        b = np.min(mean_dist, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = (b - a) / np.maximum(a, b)
+        # singleton cluster is 0 like in sklearn
+        s[(cluster_size[own] == 1) | ~np.isfinite(s)] = 0.
+        silhouette_values[ind] = s
+    
+    return silhouette_values
@@ -71,6 +71,43 @@ def numba_explore_shifts(long_waveform, one_center,  one_mask, maximum_jitter_sh
     return all_dist
 
 
+@jit(parallel=True)
+def numba_batch_sparse_dist(fifo, left_inds, centers,  mask, maximum_jitter_shift):
+    """
+    Same as numba_loop_sparse_dist but for several peaks and all shifts at once.
+    Return all_dist with shape (nb_peak, nb_shift, nb_clus)
+    """
+    nb_clus, width, nb_chan = centers.shape
+    nb_peak = left_inds.size
+    n = maximum_jitter_shift*2 +1
+    
+    all_dist = np.zeros((nb_peak, n, nb_clus), dtype=np.float32)
+    
+    for p in prange(nb_peak):
+        rms_waveform_channel = np.zeros(nb_chan, dtype=np.float64)
+        for shift in range(n):
+            i0 = left_inds[p] - maximum_jitter_shift + shift
+            for c in range(nb_chan):
+                rms = 0.
+                for s in range(width):
+                    v = fifo[i0+s, c]
+                    rms += v*v
+                rms_waveform_channel[c] = rms
+            
+            for clus in range(nb_clus):
+                sum = 0.
+                for c in range(nb_chan):
+                    if mask[clus, c]:
+                        for s in range(width):
+                            d = fifo[i0+s, c] - centers[clus, s, c]
+                            sum += d*d
+                    else:
+                        sum +=rms_waveform_channel[c]
+                all_dist[p, shift, clus] = sum
+    
+    return all_dist
+
+
 @jit(parallel=True)
 def peak_loop_plus(sigs, sig_center, mask_peaks, n_span, thresh, peak_sign, neighbours):
     for chan in prange(sig_center.shape[1]):
@@ -129,3 +166,201 @@ def numba_get_mask_spatiotemporal_peaks(sigs, n_span, thresh, peak_sign, neighbo
 
 
 
+
+
+@jit(parallel=True, nopython=True)
+def numba_extract_chunks(signals, left_sample_indexes, width, chunks):
+    nb_peak = left_sample_indexes.size
+    nb_chan = signals.shape[1]
+    for i in prange(nb_peak):
+        ind = left_sample_indexes[i]
+        for s in range(width):
+            for c in range(nb_chan):
+                chunks[i, s, c] = signals[ind + s, c]
+
+
+@jit(parallel=True, nopython=True)
+def numba_extract_chunks_channels(signals, left_sample_indexes, width, channel_indexes, chunks):
+    nb_peak = left_sample_indexes.size
+    nb_chan = channel_indexes.size
+    for i in prange(nb_peak):
+        ind = left_sample_indexes[i]
+        for s in range(width):
+            for c in range(nb_chan):
+                chunks[i, s, c] = signals[ind + s, channel_indexes[c]]
+
+
+@jit(parallel=True, nopython=True)
+def numba_extract_chunks_sparse(signals, left_sample_indexes, width, peak_channel_indexes, adjacency_mask, chunks):
+    # adjacency_mask is (nb_chan, nb_chan) boolean : adjacency_mask[peak_chan, c]
+    nb_peak = left_sample_indexes.size
+    nb_chan = signals.shape[1]
+    for i in prange(nb_peak):
+        ind = left_sample_indexes[i]
+        chan = peak_channel_indexes[i]
+        for s in range(width):
+            for c in range(nb_chan):
+                if adjacency_mask[chan, c]:
+                    chunks[i, s, c] = signals[ind + s, c]
+
+
+@jit(parallel=True, nopython=True)
+def numba_detect_spatiotemporal_peaks(sigs, n_span, thresh, sign, neighbours, block_size,
+                                        out_time, out_chan, out_value, counts):
+    # same rules as peak_loop_plus/peak_loop_minus but with a sign so only one loop
+    # each time block is scanned once with early exit and write peaks in its own part of buffers
+    # counts[b] can be > capacity if the buffer is too small (then not all peaks are written)
+    n = sigs.shape[0] - 2 * n_span
+    nb_chan = sigs.shape[1]
+    nb_block = counts.size
+    capacity = out_time.size // nb_block
+    for b in prange(nb_block):
+        s0 = b * block_size
+        s1 = min(s0 + block_size, n)
+        k = b * capacity
+        count = 0
+        for s in range(s0, s1):
+            for chan in range(nb_chan):
+                v = sign * sigs[s + n_span, chan]
+                if v <= thresh:
+                    continue
+                ok = True
+                for j in range(neighbours.shape[1]):
+                    neighbour = neighbours[chan, j]
+                    if neighbour < 0:
+                        continue
+                    if neighbour != chan and v < sign * sigs[s + n_span, neighbour]:
+                        ok = False
+                        break
+                    for i in range(n_span):
+                        if v <= sign * sigs[s + i, neighbour] or v < sign * sigs[n_span + s + i + 1, neighbour]:
+                            ok = False
+                            break
+                    if not ok:
+                        break
+                if ok:
+                    if count < capacity:
+                        out_time[k + count] = s
+                        out_chan[k + count] = chan
+                        out_value[k + count] = sigs[s + n_span, chan]
+                    count += 1
+        counts[b] = count
+
+
+@jit(nopython=True)
+def _select_kth_inplace(buf, n, k):
+    # quickselect (Hoare) on buf[:n] : after this buf[k] is the kth smallest
+    # and buf[:k] <= buf[k] <= buf[k+1:n]
+    left = 0
+    right = n - 1
+    while right > left:
+        pivot = buf[(left + right) // 2]
+        i = left
+        j = right
+        while i <= j:
+            while buf[i] < pivot:
+                i += 1
+            while buf[j] > pivot:
+                j -= 1
+            if i <= j:
+                tmp = buf[i]
+                buf[i] = buf[j]
+                buf[j] = tmp
+                i += 1
+                j -= 1
+        if k <= j:
+            right = j
+        elif k >= i:
+            left = i
+        else:
+            break
+    return buf[k]
+
+
+@jit(parallel=True, nopython=True)
+def numba_remove_common_ref(data, groups_channels, groups_offsets, use_median, block_size):
+    # data is modified inplace : data[s, chans] -= median or mean of data[s, chans] for each group
+    # groups are given flat : channels of group g are groups_channels[groups_offsets[g]:groups_offsets[g+1]]
+    n = data.shape[0]
+    nb_group = groups_offsets.size - 1
+    nb_block = (n + block_size - 1) // block_size
+    for b in prange(nb_block):
+        buf = np.empty(data.shape[1], dtype=data.dtype)
+        for s in range(b * block_size, min(n, (b + 1) * block_size)):
+            for g in range(nb_group):
+                i0 = groups_offsets[g]
+                m = groups_offsets[g + 1] - i0
+                if m == 0:
+                    continue
+                if use_median:
+                    for j in range(m):
+                        buf[j] = data[s, groups_channels[i0 + j]]
+                    k = m // 2
+                    ref = _select_kth_inplace(buf, m, k)
+                    if m % 2 == 0:
+                        # lower middle is the max of the lower part
+                        lower = buf[0]
+                        for j in range(1, k):
+                            if buf[j] > lower:
+                                lower = buf[j]
+                        ref = (ref + lower) / 2.
+                else:
+                    ref = 0.
+                    for j in range(m):
+                        ref += data[s, groups_channels[i0 + j]]
+                    ref /= m
+                for j in range(m):
+                    data[s, groups_channels[i0 + j]] -= ref
+
+
+@jit(parallel=True, nopython=True)
+def numba_equal_template_pairs(centroids, pair_inds, thresholds, n_shift, equal):
+    # same as waveformtools.equal_template for many pairs of centroids
+    # a shift is abandoned as soon as one sample is above the threshold
+    nb_pair = pair_inds.shape[0]
+    width = centroids.shape[1] - 2 * n_shift
+    nb_chan = centroids.shape[2]
+    for p in prange(nb_pair):
+        i0 = pair_inds[p, 0]
+        i1 = pair_inds[p, 1]
+        thresh = thresholds[p]
+        for shift in range(n_shift * 2 + 1):
+            ok = True
+            for s in range(width):
+                for c in range(nb_chan):
+                    d = abs(centroids[i1, s + shift, c] - centroids[i0, s + n_shift, c])
+                    if d >= thresh:
+                        ok = False
+                        break
+                if not ok:
+                    break
+            if ok:
+                equal[p] = True
+                break
+
+
+@jit(parallel=True, nopython=True)
+def numba_cosine_similarity_with_max(x, sparse_mask, sq_sum, rows, upper, out):
+    # x is (nb, nb_chan, width) and is zeros outside sparse_mask, sq_sum is sum(x**2) for each
+    # sum(max(u**2, v**2)) = sum(u**2) + sum(v**2) - sum(min(u**2, v**2))
+    # and min is not zeros only on common channels
+    # when upper only j>i is computed (rows must be all)
+    nb, nb_chan, width = x.shape
+    for r in prange(rows.size):
+        i = rows[r]
+        j0 = i + 1 if upper else 0
+        for j in range(j0, nb):
+            num = 0.
+            min_sum = 0.
+            for c in range(nb_chan):
+                if sparse_mask[i, c] and sparse_mask[j, c]:
+                    for s in range(width):
+                        u = x[i, c, s]
+                        v = x[j, c, s]
+                        num += u * v
+                        min_sum += min(u * u, v * v)
+            den = sq_sum[i] + sq_sum[j] - min_sum
+            if den > 0:
+                out[r, j] = num / den
+            else:
+                out[r, j] = np.nan
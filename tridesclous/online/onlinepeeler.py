@@ -1,3 +1,6 @@
+import threading
+import traceback
+
 from ..peeler import Peeler
 
 
@@ -7,12 +10,14 @@ import pyacq
 from pyacq import Node, register_node_type, ThreadPollInput
 
 from ..peeler import _dtype_spike
+from ..peeler_tools import _dtype_chunk_telemetry
 
 
 
 
 class PeelerThread(ThreadPollInput):
     def __init__(self, input_stream, output_streams, peeler,in_group_channels, geometry,
+                        signalpreprocessor_engine=None, signalpreprocessor_n_jobs=None, preprocess_pipelined=False,
                         timeout = 200, parent = None):
         
         ThreadPollInput.__init__(self, input_stream,  timeout=timeout, return_data=True, parent = parent)
@@ -20,11 +25,21 @@ class PeelerThread(ThreadPollInput):
         self.peeler = peeler
         self.in_group_channels = in_group_channels
         self.geometry = geometry
+        self.signalpreprocessor_engine = signalpreprocessor_engine
+        self.signalpreprocessor_n_jobs = signalpreprocessor_n_jobs
+        self.preprocess_pipelined = preprocess_pipelined
         
         self.sample_rate = input_stream.params['sample_rate']
         self.total_channel = self.input_stream().params['shape'][1]
         
         self.mutex = Mutex()
+        
+        # catalogue hot-swap : engine prepared in background and swap at chunk boundary
+        self.pending_swap = None
+        self.swap_request = 0
+        self.last_swap_report = None
+        
+        self.nb_telemetry = 0
     
     def process_data(self, pos, sigs_chunk):
         #TODO maybe remove this
@@ -32,12 +47,20 @@ class PeelerThread(ThreadPollInput):
         assert sigs_chunk.shape[0] == self.peeler.chunksize, 'PeelerThread chunksize is BAD!! {} {}'.format(sigs_chunk.shape[0], self.peeler.chunksize)
         
         with self.mutex:
+            if self.pending_swap is not None:
+                self.last_swap_report = self.peeler.swap_online_engine(self.pending_swap)
+                self.last_swap_report['error'] = None
+                self.pending_swap = None
+            
             #take only channels concerned
             sigs_chunk = sigs_chunk[:, self.in_group_channels]
             #~ print('pos', pos)
             #~ print(sigs_chunk.shape, sigs_chunk.dtype)
             #~ print('signals_medians', self.peeler.signalpreprocessor.signals_medians)
             sig_index, preprocessed_chunk, total_spike, spikes  = self.peeler.process_one_chunk(pos, sigs_chunk)
+            if sig_index is None:
+                # pipelined preprocessing : first chunk
+                return
             #~ print('sig_index', sig_index)
             
             #~ print('total_spike', total_spike, len(spikes))
@@ -47,11 +70,61 @@ class PeelerThread(ThreadPollInput):
             #~ if spikes is not None and spikes.size>0:
             if spikes.size>0:
                 self.output_streams['spikes'].send(spikes, index=total_spike)
+            
+            # the telemetry output is optional
+            telemetry_stream = self.output_streams['telemetry']
+            if getattr(telemetry_stream, 'configured', False):
+                self.nb_telemetry += 1
+                telemetry_stream.send(self.peeler.peeler_engine.get_chunk_telemetry().copy(), index=self.nb_telemetry)
         
     
     def change_params(self, **kargs):
         print('PeelerThread.change_params')
+        if not self.isRunning() or getattr(self.peeler, 'peeler_engine', None) is None:
+            # not streaming yet : blocking initialization
+            self._change_params_blocking(**kargs)
+            return
+        
+        # streaming : the new engine is prepared in background, the old one continue
+        # to peel, and the swap is done by process_data() at the next chunk boundary
         with self.mutex:
+            self.swap_request += 1
+            request = self.swap_request
+        thread = threading.Thread(target=self._prepare_swap, args=(request, ), kwargs=kargs)
+        thread.daemon = True
+        thread.start()
+    
+    def _prepare_swap(self, request, **kargs):
+        kargs.pop('save_processed_signals', None)
+        try:
+            prepared = self.peeler.prepare_online_engine(sample_rate=self.sample_rate,
+                                                nb_channel=len(self.in_group_channels),
+                                                source_dtype=self.input_stream().params['dtype'],
+                                                geometry=self.geometry,
+                                                processor_engine=self.signalpreprocessor_engine,
+                                                processor_n_jobs=self.signalpreprocessor_n_jobs,
+                                                **kargs)
+        except Exception as e:
+            # the old engine continue to peel, the error is reported in last_swap_report
+            with self.mutex:
+                if request == self.swap_request:
+                    self.last_swap_report = dict(error=e, traceback=traceback.format_exc())
+            return
+        
+        with self.mutex:
+            # only the most recent request is swapped, others are released
+            if request == self.swap_request:
+                if self.pending_swap is not None:
+                    self.pending_swap['peeler_engine'].close()
+                self.pending_swap = prepared
+            else:
+                prepared['peeler_engine'].close()
+    
+    def _change_params_blocking(self, **kargs):
+        with self.mutex:
+            if self.pending_swap is not None:
+                self.pending_swap['peeler_engine'].close()
+            self.pending_swap = None
             self.peeler.change_params(**kargs)
             
             buffer_spike_index = self.output_streams['spikes'].last_index
@@ -65,6 +138,9 @@ class PeelerThread(ThreadPollInput):
                                                 nb_channel=len(self.in_group_channels),
                                                 source_dtype=self.input_stream().params['dtype'],
                                                 geometry=self.geometry,
+                                                processor_engine=self.signalpreprocessor_engine,
+                                                processor_n_jobs=self.signalpreprocessor_n_jobs,
+                                                pipelined=self.preprocess_pipelined,
                                                 )
             
             #~ print('self.peeler.peeler_engine.total_spike', self.peeler.peeler_engine.total_spike)
@@ -78,10 +154,15 @@ class OnlinePeeler(Node):
     """
     Wrapper on top of Peeler class to make a pyacq Node.
     And so to have on line spike sorting!!
+    
+    The optional 'telemetry' output (only sent if configured) give for each chunk
+    the duration of each stage, peel loop iterations and nb of spikes.
+    'budget_ratio' >= 1 means that the peeler is slower than real time.
     """
     _input_specs = {'signals' : dict(streamtype = 'signals')}
     _output_specs = {'signals' : dict(streamtype = 'signals'),
                                 'spikes': dict(streamtype='events', shape = (-1, ),  dtype=_dtype_spike),
+                                'telemetry': dict(streamtype='events', shape = (-1, ),  dtype=_dtype_chunk_telemetry),
                                 }
 
     def __init__(self , **kargs):
@@ -89,8 +170,17 @@ class OnlinePeeler(Node):
     
     def _configure(self, in_group_channels=None, catalogue=None, chunksize=None,
                                     internal_dtype='float32', peeler_engine='classic',
-                                    geometry=None,
+                                    geometry=None, signalpreprocessor_engine=None,
+                                    signalpreprocessor_n_jobs=2, preprocess_pipelined=False,
                                     **peeler_engine_kargs):
+        """
+        signalpreprocessor_engine: None (the one of the catalogue) or for instance 'numpy_threads'
+            to shard channels across threads.
+        signalpreprocessor_n_jobs: number of threads for 'numpy_threads' (2 by default, -1 is all cores).
+            Keep it small, other nodes (and other peelers) share the cores.
+        preprocess_pipelined: preprocess chunk N+1 in a thread while peeling chunk N.
+            This add one chunksize of latency.
+        """
         
         if 'engine' in peeler_engine_kargs:
             peeler_engine = peeler_engine_kargs.pop('engine')
@@ -104,6 +194,9 @@ class OnlinePeeler(Node):
         self.internal_dtype = internal_dtype
         self.peeler_engine = peeler_engine
         self.geometry = geometry
+        self.signalpreprocessor_engine = signalpreprocessor_engine
+        self.signalpreprocessor_n_jobs = signalpreprocessor_n_jobs
+        self.preprocess_pipelined = preprocess_pipelined
         self.peeler_engine_kargs = peeler_engine_kargs
         
         
@@ -124,12 +217,17 @@ class OnlinePeeler(Node):
             self.outputs['signals'].params['channel_info'] = channel_info
     
     def _initialize(self):
+        if getattr(self, 'peeler', None) is not None:
+            self.peeler.close_online_loop()
         
         self.peeler = Peeler(dataio=None)
         #~ self.peeler.change_params(catalogue=self.catalogue, 
                                         #~ chunksize=self.chunksize, internal_dtype=self.internal_dtype,)
         
-        self.thread = PeelerThread(self.input, self.outputs, self.peeler, self.in_group_channels, self.geometry)
+        self.thread = PeelerThread(self.input, self.outputs, self.peeler, self.in_group_channels, self.geometry,
+                        signalpreprocessor_engine=self.signalpreprocessor_engine,
+                        signalpreprocessor_n_jobs=self.signalpreprocessor_n_jobs,
+                        preprocess_pipelined=self.preprocess_pipelined)
         self.change_catalogue(self.catalogue)
         
     def _start(self):
@@ -141,10 +239,12 @@ class OnlinePeeler(Node):
     def _stop(self):
         self.thread.stop()
         self.thread.wait()
+        # threads are re-created at the next chunk if started again
+        self.peeler.close_online_loop()
 
         
     def _close(self):
-        pass
+        self.peeler.close_online_loop()
     
     def change_catalogue(self, catalogue):
         print('change_catalogue', catalogue['label_to_index'])
@@ -154,6 +254,16 @@ class OnlinePeeler(Node):
         self.thread.change_params(catalogue=catalogue, 
                                         chunksize=self.chunksize, internal_dtype=self.internal_dtype,
                                         engine=self.peeler_engine, **self.peeler_engine_kargs)
+    
+    def get_last_swap_report(self):
+        """
+        Report of the last catalogue hot-swap (None if no swap yet).
+        
+        'error' is None when the swap is done, with timing keys ('prepare_duration', 'swap_duration', ...).
+        When the new engine can not be prepared, 'error' is the exception and 'traceback' its
+        formatted traceback; in that case the previous catalogue is still used.
+        """
+        return self.thread.last_swap_report
                                         
                                         
         
@@ -17,7 +17,7 @@ from pyacq.rec import RawRecorder
 # internals import
 from ..dataio import DataIO
 from ..catalogueconstructor import CatalogueConstructor
-from .. cataloguetools import apply_all_catalogue_steps
+from .. cataloguetools import apply_all_catalogue_steps, apply_all_catalogue_steps_parallel
 from ..signalpreprocessor import estimate_medians_mads_after_preprocesing
 
 from ..gui import CatalogueWindow
@@ -157,7 +157,12 @@ class TdcOnlineWindow(MainWindowNode):
                             outputstream_params={'protocol': 'tcp', 'interface':'127.0.0.1', 'transfermode':'plaindata'},
                             nodegroup_friends=None, 
                             peeler_params={},
+                            catalogue_n_jobs=None,
                             ):
+        """
+        catalogue_n_jobs: max nb of worker processes that build catalogues (one group per process)
+            after the recording. None is half of the cores, to keep CPU for real time peelers.
+        """
         
         self.sample_rate = None
         
@@ -167,6 +172,9 @@ class TdcOnlineWindow(MainWindowNode):
         self.workdir = workdir
         self.outputstream_params = outputstream_params
         self.nodegroup_friends = nodegroup_friends
+        if catalogue_n_jobs is None:
+            catalogue_n_jobs = max(1, os.cpu_count() // 2)
+        self.catalogue_n_jobs = catalogue_n_jobs
 
         
         #~ self.median_estimation_duration = 1
@@ -626,10 +634,9 @@ class TdcOnlineWindow(MainWindowNode):
                     dtype=self.input.params['dtype'], total_channel=self.total_channel)
         self.dataio.set_channel_groups(self.channel_groups)
 
-        # create new self.catalogueconstructors
-        for chan_grp in self.channel_groups:
-            cc = CatalogueConstructor(dataio=self.dataio, chan_grp=chan_grp)
-            self.catalogueconstructors[chan_grp] = cc
+        # catalogueconstructors are built in worker processes
+        # and loaded in on_catalogue_done()
+        self.catalogueconstructors = {}
         
         fisrt_chan_grp = list(self.channel_groups.keys())[0]
         
@@ -652,16 +659,21 @@ class TdcOnlineWindow(MainWindowNode):
         
         
 
-        self.worker = Worker(self.catalogueconstructors, params)
+        self.worker = Worker(self.dataio, list(self.channel_groups.keys()), params, self.catalogue_n_jobs)
         
         self.worker.moveToThread(self.worker_thread)
         self.request_compute.connect(self.worker.compute)
-        self.worker.done.connect(self.on_new_catalogue)
+        self.worker.done.connect(self.on_catalogue_done)
         self.worker.compute_catalogue_error.connect(self.on_compute_catalogue_error)
         self.request_compute.emit()
         
         self.overview.refresh()
     
+    def on_catalogue_done(self, chan_grp):
+        # the worker process have written on disk : reload
+        self.catalogueconstructors[chan_grp] = CatalogueConstructor(dataio=self.dataio, chan_grp=chan_grp)
+        self.on_new_catalogue(chan_grp)
+    
     def on_compute_catalogue_error(self, e):
         self.errorToMessageBox(e)
     
@@ -832,34 +844,26 @@ class WidgetOverview(QT.QWidget):
 
 
 class Worker(QT.QObject):
+    """
+    Build catalogues of all channel groups in a bounded pool of worker processes.
+    done(chan_grp) is emitted as soon as each catalogue is ready.
+    """
     done = QT.pyqtSignal(int)
     compute_catalogue_error = QT.pyqtSignal(object)
-    def __init__(self, catalogueconstructors, params, parent=None):
+    def __init__(self, dataio, chan_grps, params, n_jobs, parent=None):
         QT.QObject.__init__(self, parent=parent)
         
-        self.catalogueconstructors = catalogueconstructors
+        self.dataio = dataio
+        self.chan_grps = chan_grps
         self.params = params
+        self.n_jobs = n_jobs
     
     def compute(self):
         #~ print('compute')
+        print('self.params duration', self.params['duration'])
         
-        for chan_grp, catalogueconstructor in self.catalogueconstructors.items():
-        
-            print(catalogueconstructor)
-            print('self.params duration', self.params['duration'])
-            
-            #~ try:
-            if 1:
-                apply_all_catalogue_steps(catalogueconstructor, self.params,  verbose=False)
-                
-                catalogueconstructor.make_catalogue_for_peeler()
-                print(catalogueconstructor)
-                self.done.emit(chan_grp)
-                
-            #~ except Exception as e:
-                #~ self.compute_catalogue_error.emit(e)
-        
-        # release cataloguecontrustors otherwise they cannot be deleted
-        self.catalogueconstructors = {}
-        
-            
+        try:
+            apply_all_catalogue_steps_parallel(self.dataio, self.params, chan_grps=self.chan_grps,
+                            n_jobs=self.n_jobs, callback=self.done.emit, verbose=False)
+        except Exception as e:
+            self.compute_catalogue_error.emit(e)
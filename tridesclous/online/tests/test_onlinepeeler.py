@@ -116,9 +116,19 @@ def test_OnlinePeeler():
     stream_params = dict(protocol='tcp', interface='127.0.0.1', transfermode='plaindata')
     peeler.outputs['signals'].configure(**stream_params)
     peeler.outputs['spikes'].configure(**stream_params)
+    peeler.outputs['telemetry'].configure(**stream_params)
     peeler.initialize()
     peeler.start()
     
+    # a hot-swap that fail is reported and the current catalogue is still used
+    peeler.thread.change_params(catalogue=catalogue, chunksize=chunksize, engine='not_an_engine')
+    t0 = time.perf_counter()
+    while peeler.get_last_swap_report() is None and time.perf_counter() - t0 < 5.:
+        time.sleep(0.05)
+    report = peeler.get_last_swap_report()
+    assert isinstance(report['error'], KeyError)
+    assert peeler.thread.pending_swap is None
+    
     # Node traceviewer
     tviewer = OnlineTraceViewer()
     tviewer.configure(peak_buffer_size = 1000, catalogue=lighter_catalogue(catalogue))
@@ -32,7 +32,7 @@ if HAVE_PYOPENCL:
 try:
     import numba
     HAVE_NUMBA = True
-    from .numba_tools import numba_get_mask_spatiotemporal_peaks
+    from .numba_tools import numba_get_mask_spatiotemporal_peaks, numba_detect_spatiotemporal_peaks
 except ImportError:
     HAVE_NUMBA = False
 
@@ -366,6 +366,36 @@ def get_mask_spatiotemporal_peaks(sigs, n_span, thresh, peak_sign, neighbours):
 
 
 
+def get_spatiotemporal_peak_span(sigs, time_ind, chan_ind, neighbours, max_n_span):
+    """
+    For local maxima at (time_ind, chan_ind) give the largest n_span (<=max_n_span) for which
+    they are still detected by get_mask_spatiotemporal_peaks(peak_sign='+').
+    Because the comparison with neighbours do not depend on the threshold, peaks at
+    any higher threshold are then candidates with value>thresh and n_span_max>=n_span.
+    
+    sigs must be already signed (-sigs for peak_sign='-') and have max_n_span samples
+    on both sides of time_ind.
+    """
+    values = sigs[time_ind, chan_ind][:, None]
+    # -1 (no neighbour) is replaced by the channel itself which is always a neighbour
+    neighb = neighbours[chan_ind, :]
+    neighb = np.where(neighb>=0, neighb, chan_ind[:, None])
+    
+    n_span_max = np.full(time_ind.size, max_n_span, dtype='int64')
+    alive = np.arange(time_ind.size)
+    for i in range(1, max_n_span+1):
+        t = time_ind[alive][:, None]
+        v = values[alive]
+        n = neighb[alive]
+        blocked = np.any(sigs[t-i, n] >= v, axis=1) | np.any(sigs[t+i, n] > v, axis=1)
+        n_span_max[alive[blocked]] = i - 1
+        alive = alive[~blocked]
+        if alive.size == 0:
+            break
+    
+    return n_span_max
+
+
 class PeakDetectorGeometricalNumpy(BasePeakDetector):
     def process_data(self, pos, newbuf):
         self.fifo_sigs.new_chunk(newbuf, pos)
@@ -432,6 +462,72 @@ class PeakDetectorGeometricalNumba(PeakDetectorGeometricalNumpy):
     
 
 
+class PeakDetectorGeometricalNumbaList(PeakDetectorGeometricalNumpy):
+    """
+    Same detection as PeakDetectorGeometricalNumba but the compiled kernel directly
+    give the list of peaks (time_ind, chan_ind, value) in preallocated buffers.
+    Signals are scanned once by time blocks in parallel and neighbours
+    are tested with early exit.
+    """
+    def process_data(self, pos, newbuf):
+        self.fifo_sigs.new_chunk(newbuf, pos)
+        sigs = self.fifo_sigs.get_data(pos-(newbuf.shape[0]+2*self.n_span), pos)
+        
+        if self.spatial_smooth_kernel is not None:
+            sigs = np.dot(sigs, self.spatial_smooth_kernel)
+        
+        time_ind_peaks, chan_ind_peaks, peak_val_peaks = self.detect_peaks_in_chunk(sigs)
+        
+        if time_ind_peaks.size>0:
+            time_ind_peaks += (pos - newbuf.shape[0] - self.n_span)
+            return time_ind_peaks, chan_ind_peaks, peak_val_peaks
+
+        return None, None, None
+    
+    def get_mask_peaks_in_chunk(self, fifo_residuals):
+        # used by peeler engine geometry
+        time_ind_peaks, chan_ind_peaks, _ = self.detect_peaks_in_chunk(fifo_residuals)
+        mask_peaks = np.zeros((fifo_residuals.shape[0] - 2 * self.n_span, self.nb_channel), dtype='bool')
+        mask_peaks[time_ind_peaks, chan_ind_peaks] = True
+        return mask_peaks
+    
+    def _allocate_peak_buffers(self, length, dtype):
+        n = length - 2 * self.n_span
+        nb_thread = numba.get_num_threads()
+        self.block_size = max(32, -(-n // (4 * nb_thread)))
+        nb_block = max(1, -(-n // self.block_size))
+        # 2 peaks on the same channel are separated by more than n_span
+        self.block_capacity = (self.block_size // (self.n_span + 1) + 1) * self.nb_channel
+        self.peak_time_buffer = np.zeros(nb_block * self.block_capacity, dtype='int64')
+        self.peak_chan_buffer = np.zeros(nb_block * self.block_capacity, dtype='int64')
+        self.peak_value_buffer = np.zeros(nb_block * self.block_capacity, dtype=dtype)
+        self.peak_counts = np.zeros(nb_block, dtype='int64')
+        self._buffer_length = length
+    
+    def detect_peaks_in_chunk(self, sigs):
+        if sigs.shape[0] != self._buffer_length or self.peak_value_buffer.dtype != sigs.dtype:
+            self._allocate_peak_buffers(sigs.shape[0], sigs.dtype)
+        
+        sign = 1. if self.peak_sign == '+' else -1.
+        numba_detect_spatiotemporal_peaks(sigs, self.n_span, self.relative_threshold, sign, self.neighbours,
+                        self.block_size, self.peak_time_buffer, self.peak_chan_buffer, self.peak_value_buffer, self.peak_counts)
+        
+        if np.any(self.peak_counts > self.block_capacity):
+            # should not happen when each channel is in its own neighbours
+            mask_peaks = numba_get_mask_spatiotemporal_peaks(sigs, self.n_span, self.relative_threshold, self.peak_sign, self.neighbours)
+            time_ind_peaks, chan_ind_peaks = np.nonzero(mask_peaks)
+            return time_ind_peaks, chan_ind_peaks, sigs[time_ind_peaks+self.n_span, chan_ind_peaks]
+        
+        # blocks are in time order and peaks are in (time, chan) order inside a block like np.nonzero
+        keep = np.arange(self.block_capacity)[None, :] < self.peak_counts[:, None]
+        keep = keep.flatten()
+        return self.peak_time_buffer[keep], self.peak_chan_buffer[keep], self.peak_value_buffer[keep]
+    
+    def change_params(self, **kargs):
+        PeakDetectorGeometricalNumpy.change_params(self, **kargs)
+        self._allocate_peak_buffers(self.chunksize+2*self.n_span, self.dtype)
+
+
 class PeakDetectorGeometricalOpenCL(PeakDetectorGeometricalNumpy, OpenCL_Helper):
         
     def process_data(self, pos, newbuf):
@@ -616,14 +712,14 @@ __kernel void get_mask_spatiotemporal_peaks(__global  float *sigs,
 # TODO rename engine propagate to GUI/examples/online
 
 def get_peak_detector_class(method, engine):
-    if engine == 'numba':
+    if engine in ('numba', 'numba_list'):
         assert HAVE_NUMBA, 'You must install numba'
     if engine == 'opencl':
         assert HAVE_PYOPENCL, 'You must install opencl'
     
     
     
-    if method == 'global' and engine =='numba':
+    if method == 'global' and engine in ('numba', 'numba_list'):
         print('WARNING : no peak detector global + numba use numpy instead')
         engine ='numpy'
     
@@ -638,6 +734,7 @@ peakdetector_classes = {
     ('global', 'opencl') : PeakDetectorGlobalOpenCL,
     ('geometrical', 'numpy') : PeakDetectorGeometricalNumpy,
     ('geometrical', 'numba') : PeakDetectorGeometricalNumba,
+    ('geometrical', 'numba_list') : PeakDetectorGeometricalNumbaList,
     ('geometrical', 'opencl'): PeakDetectorGeometricalOpenCL,
 }
 
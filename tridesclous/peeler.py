@@ -9,16 +9,21 @@ import os
 import json
 from collections import OrderedDict, namedtuple
 import time
+from concurrent.futures import ThreadPoolExecutor, Future
 
 import numpy as np
 import scipy.signal
 
 
-from .peeler_tools import _dtype_spike
+from .peeler_tools import _dtype_spike, _dtype_chunk_telemetry, summarize_chunk_telemetry
+from .signalpreprocessor import renormalize_chunk
+from .tools import run_units_in_parallel
 
 
 from tqdm import tqdm
 
+from joblib import cpu_count
+
 from .peeler_engine_classic import PeelerEngineClassic
 #~ from .peeler_engine_testing import PeelerEngineTesting
 from .peeler_engine_geometry import PeelerEngineGeometrical
@@ -73,27 +78,161 @@ class Peeler:
         
         return t
 
-    def change_params(self, catalogue=None, engine='classic', internal_dtype='float32', chunksize=1024, **params):
+    def change_params(self, catalogue=None, engine='classic', internal_dtype='float32', chunksize=1024, 
+                    save_processed_signals=True, **params):
+        """
+        Set the catalogue and params. params are given to the engine.
+        
+        When save_processed_signals=False, the processed signals computed by the peeler are
+        not written on disk (only spikes). DataIO.get_signals_chunk(signal_type='processed')
+        then recompute them on the fly from the raw signals (for viewers).
+        """
         assert catalogue is not None
         
         self.catalogue = catalogue
         self.internal_dtype = internal_dtype
         self.chunksize = chunksize
+        self.save_processed_signals = save_processed_signals
+        self.online_pipelined = False
         self.engine_name = engine
+        # keep them for re-creating engines in workers (parallel run)
+        self.engine_params = dict(params)
+        if getattr(self, 'peeler_engine', None) is not None:
+            self.peeler_engine.close()
         self.peeler_engine = peeler_engines[engine]()
         self.peeler_engine.change_params(catalogue=catalogue, internal_dtype=internal_dtype, chunksize=chunksize, **params)
     
     def process_one_chunk(self,  pos, sigs_chunk):
         # this is for online
-        return self.peeler_engine.process_one_chunk(pos, sigs_chunk)
+        if not self.online_pipelined:
+            return self.peeler_engine.process_one_chunk(pos, sigs_chunk)
+        
+        # pipelined : chunk N+1 is preprocessed in background while the engine peel chunk N
+        # this add one chunksize of latency, so the first call do not give spikes
+        if self.preprocess_executor is None:
+            self.preprocess_executor = ThreadPoolExecutor(max_workers=1)
+        future = self.preprocess_executor.submit(_timed_preprocess, self.peeler_engine.signalpreprocessor, pos, sigs_chunk)
+        previous_future = self.pending_preprocess
+        self.pending_preprocess = future
+        if previous_future is None:
+            return None, None, self.peeler_engine.total_spike, np.zeros(0, dtype=_dtype_spike)
+        
+        pos2, preprocessed_chunk, preprocess_duration = previous_future.result()
+        result = self.peeler_engine.process_one_chunk(pos2, preprocessed_chunk)
+        
+        # the engine only see an already processed chunk : the preprocessing time
+        # is the one of the background thread, the stream is limited by the slower thread
+        tel = self.peeler_engine.get_chunk_telemetry()
+        tel['preprocess'] = preprocess_duration
+        tel['budget_ratio'] = max(tel['total'][0], preprocess_duration) * self.peeler_engine.sample_rate / self.chunksize
+        return result
     
-    def initialize_online_loop(self, sample_rate=None, nb_channel=None, source_dtype=None, geometry=None):
+    def initialize_online_loop(self, sample_rate=None, nb_channel=None, source_dtype=None, geometry=None,
+                    processor_engine=None, processor_n_jobs=None, pipelined=False):
+        """
+        processor_engine can force the signal preprocessor engine (for instance 'numpy_threads').
+        processor_n_jobs is the number of threads of 'numpy_threads' (None is its default).
+        When pipelined=True the signal preprocessor run in its own thread, one chunk ahead.
+        
+        Threads are released by close_online_loop().
+        """
         # global initialize
         self.peeler_engine.initialize(sample_rate=sample_rate, nb_channel=nb_channel,
-                        source_dtype=source_dtype, already_processed=False, geometry=geometry)
-        self.peeler_engine.initialize_before_each_segment(already_processed=False)
+                        source_dtype=source_dtype, already_processed=False, geometry=geometry,
+                        processor_engine=processor_engine, processor_n_jobs=processor_n_jobs)
+        
+        self.online_pipelined = pipelined
+        self.pending_preprocess = None
+        if self.online_pipelined:
+            # the engine then consider chunks as already processed
+            if getattr(self, 'preprocess_executor', None) is None:
+                self.preprocess_executor = ThreadPoolExecutor(max_workers=1)
+            self.peeler_engine.initialize_before_each_segment(already_processed=True)
+        else:
+            self._close_preprocess_executor()
+            self.peeler_engine.initialize_before_each_segment(already_processed=False)
+    
+    def _close_preprocess_executor(self):
+        if getattr(self, 'preprocess_executor', None) is not None:
+            self.preprocess_executor.shutdown(wait=True)
+        self.preprocess_executor = None
+    
+    def close_online_loop(self):
+        """
+        Release the threads of the online loop (pipelined preprocessing and
+        'numpy_threads' preprocessor). They are re-created if process_one_chunk()
+        is called again.
+        """
+        self._close_preprocess_executor()
+        if getattr(self, 'peeler_engine', None) is not None:
+            self.peeler_engine.close()
+    
+    def prepare_online_engine(self, sample_rate=None, nb_channel=None, source_dtype=None, geometry=None,
+                    processor_engine=None, processor_n_jobs=None, catalogue=None, engine='classic', internal_dtype='float32',
+                    chunksize=1024, **params):
+        """
+        Build and initialize a new engine for an online catalogue hot-swap.
+        
+        This is the slow part (kernels compilation, templates on device, ...) and
+        it does not touch the running engine, so it can be done in a background thread
+        while the stream continue with the old catalogue.
+        Then swap_online_engine() must be called at a chunk boundary.
+        """
+        assert catalogue is not None
+        t0 = time.perf_counter()
+        peeler_engine = peeler_engines[engine]()
+        peeler_engine.change_params(catalogue=catalogue, internal_dtype=internal_dtype, chunksize=chunksize, **params)
+        peeler_engine.initialize(sample_rate=sample_rate, nb_channel=nb_channel,
+                        source_dtype=source_dtype, already_processed=False, geometry=geometry,
+                        processor_engine=processor_engine, processor_n_jobs=processor_n_jobs)
+        peeler_engine.initialize_before_each_segment(already_processed=getattr(self, 'online_pipelined', False))
+        t1 = time.perf_counter()
+        
+        prepared = dict(peeler_engine=peeler_engine, catalogue=catalogue, engine=engine,
+                        engine_params=dict(params), internal_dtype=internal_dtype, chunksize=chunksize,
+                        prepare_duration=t1-t0)
+        return prepared
+    
+    def swap_online_engine(self, prepared):
+        """
+        Replace the running engine by a prepared one (see prepare_online_engine).
+        
+        Must be called in between 2 process_one_chunk(). The state of the stream
+        (fifo residuals, filter state, spikes near border) is carried so there is
+        no gap in the spike train and no filter transient when the filter is unchanged.
+        
+        Return a report dict.
+        """
+        assert prepared['chunksize'] == self.chunksize, 'hot-swap need the same chunksize'
+        t0 = time.perf_counter()
+        old_engine = self.peeler_engine
+        new_engine = prepared['peeler_engine']
+        
+        if self.online_pipelined and self.pending_preprocess is not None:
+            # the next chunk is already preprocessed with the old medians/mads
+            pos2, preprocessed_chunk, preprocess_duration = self.pending_preprocess.result()
+            preprocessed_chunk = preprocessed_chunk.copy()
+            renormalize_chunk(preprocessed_chunk, old_engine.signalpreprocessor, new_engine.signalpreprocessor)
+            future = Future()
+            future.set_result((pos2, preprocessed_chunk, preprocess_duration))
+            self.pending_preprocess = future
+        new_engine.already_processed = self.online_pipelined
+        
+        carried = new_engine.take_online_state(old_engine)
+        old_engine.close()
+        
+        self.peeler_engine = new_engine
+        self.catalogue = prepared['catalogue']
+        self.internal_dtype = prepared['internal_dtype']
+        self.engine_name = prepared['engine']
+        self.engine_params = prepared['engine_params']
+        t1 = time.perf_counter()
+        
+        report = dict(prepare_duration=prepared['prepare_duration'], swap_duration=t1-t0)
+        report.update(carried)
+        return report
     
-    def run_offline_loop_one_segment(self, seg_num=0, duration=None, progressbar=True):
+    def run_offline_loop_one_segment(self, seg_num=0, duration=None, progressbar=True, prefetch=0):
         chan_grp = self.catalogue['chan_grp']
 
         if duration is not None:
@@ -116,22 +255,26 @@ class Peeler:
             signal_type = 'initial'
         
             #initialize engines
-            self.dataio.reset_processed_signals(seg_num=seg_num, chan_grp=chan_grp, dtype=self.internal_dtype)
+            self._reset_processed_signals(seg_num)
+        
+        save_processed = not already_processed and self.save_processed_signals
         
         self.dataio.reset_spikes(seg_num=seg_num, chan_grp=chan_grp, dtype=_dtype_spike)
 
         iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=self.chunksize, 
-                                                    i_stop=length, signal_type=signal_type)
+                                                    i_stop=length, signal_type=signal_type, prefetch=prefetch)
         if progressbar:
             iterator = tqdm(iterable=iterator, total=length//self.chunksize)
         
+        telemetry = []
         for pos, sigs_chunk in iterator:
             sig_index, preprocessed_chunk, total_spike, spikes = self.peeler_engine.process_one_chunk(pos, sigs_chunk)
+            telemetry.append(self.peeler_engine.get_chunk_telemetry().copy())
             
             if sig_index<=0:
                 continue
             
-            if not already_processed:
+            if save_processed:
                 # save preprocessed_chunk to file
                 self.dataio.set_signals_chunk(preprocessed_chunk, seg_num=seg_num,chan_grp=chan_grp,
                             i_start=sig_index-preprocessed_chunk.shape[0], i_stop=sig_index,
@@ -146,17 +289,217 @@ class Peeler:
             if extra_spikes.size>0:
                 self.dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=extra_spikes)
         
-        if not already_processed:
+        if save_processed:
             self.dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp, processed_length=int(sig_index))
             
         self.dataio.flush_spikes(seg_num=seg_num, chan_grp=chan_grp)
+        
+        if not hasattr(self, 'chunk_telemetry'):
+            self.chunk_telemetry = {}
+        if len(telemetry) > 0:
+            self.chunk_telemetry[seg_num] = np.concatenate(telemetry)
+        else:
+            self.chunk_telemetry[seg_num] = np.zeros(0, dtype=_dtype_chunk_telemetry)
+    
+    def get_telemetry_summary(self, seg_num=None, alarm_ratio=0.8):
+        """
+        Summary of per chunk telemetry (stage durations, peel loop iterations, spikes)
+        of the last offline run (serial or parallel).
+        
+        seg_num: None is all segments.
+        alarm_ratio: chunks processed slower than alarm_ratio * chunksize / sample_rate
+            are counted in 'nb_chunk_alarm'.
+        """
+        assert hasattr(self, 'chunk_telemetry'), 'Run the peeler first'
+        if seg_num is None:
+            assert len(self.chunk_telemetry) > 0, 'No telemetry, the peeler run is not finished'
+            telemetry = np.concatenate([self.chunk_telemetry[k] for k in sorted(self.chunk_telemetry.keys())])
+        else:
+            assert seg_num in self.chunk_telemetry, 'No telemetry for segment {}'.format(seg_num)
+            telemetry = self.chunk_telemetry[seg_num]
+        summary = summarize_chunk_telemetry(telemetry, alarm_ratio=alarm_ratio)
+        summary['chunk_duration'] = self.chunksize / self.peeler_engine.sample_rate
+        return summary
+    
+    def _reset_processed_signals(self, seg_num):
+        chan_grp = self.catalogue['chan_grp']
+        if self.save_processed_signals:
+            self.dataio.reset_processed_signals(seg_num=seg_num, chan_grp=chan_grp, dtype=self.internal_dtype, chunksize=self.chunksize)
+        else:
+            self.dataio.set_processed_signals_recompute(chan_grp=chan_grp,
+                        signal_preprocessor_params=self.catalogue['signal_preprocessor_params'],
+                        signals_medians=self.catalogue['signals_medians'], signals_mads=self.catalogue['signals_mads'],
+                        chunksize=self.chunksize, dtype=self.internal_dtype)
+
+    def run_offline_loop_one_block(self, seg_num=0, length=None, block_start=0, block_stop=None, 
+                    warmup_size=0, tail_size=0, already_processed=False):
+        """
+        Peel only one time block [block_start, block_stop] of a segment.
+        
+        The engine start warmup_size samples before the block (aligned on chunksize) 
+        and stop tail_size after it, so that filter, fifo and near border spikes are 
+        in the same state as the full loop. Only spikes and processed signals inside the block
+        are kept. processed_signals must be already allocated (reset_processed_signals).
+        
+        Return spikes, sig_index of the last chunk and the telemetry of chunks inside the block.
+        """
+        chan_grp = self.catalogue['chan_grp']
+        if block_stop is None:
+            block_stop = length
+        
+        self.peeler_engine.initialize_before_each_segment(already_processed=already_processed)
+        
+        if already_processed:
+            signal_type = 'processed'
+        else:
+            signal_type = 'initial'
+        
+        i_start = max(0, block_start - warmup_size)
+        i_start = i_start - i_start % self.chunksize
+        i_stop = min(length, block_stop + tail_size)
+        iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=self.chunksize, 
+                                                    i_start=i_start, i_stop=i_stop, signal_type=signal_type)
+        
+        sig_index = 0
+        all_spikes = []
+        telemetry = []
+        for pos, sigs_chunk in iterator:
+            sig_index, preprocessed_chunk, total_spike, spikes = self.peeler_engine.process_one_chunk(pos, sigs_chunk)
+            if block_start <= pos - self.chunksize < block_stop:
+                # warmup and tail chunks are counted by the neighbour blocks
+                telemetry.append(self.peeler_engine.get_chunk_telemetry().copy())
+            
+            if sig_index is None or sig_index<=0:
+                sig_index = 0
+                continue
+            
+            if not already_processed and self.save_processed_signals:
+                # save only the part inside the block
+                chunk_start = sig_index-preprocessed_chunk.shape[0]
+                i0 = max(chunk_start, block_start)
+                i1 = min(sig_index, block_stop)
+                if i1 > i0:
+                    self.dataio.set_signals_chunk(preprocessed_chunk[i0-chunk_start:i1-chunk_start], 
+                                seg_num=seg_num,chan_grp=chan_grp, i_start=i0, i_stop=i1, signal_type='processed')
+            
+            if spikes is not None and spikes.size>0:
+                all_spikes.append(spikes)
+        
+        extra_spikes = self.peeler_engine.get_remaining_spikes()
+        if extra_spikes is not None and extra_spikes.size>0:
+            all_spikes.append(extra_spikes)
+        
+        if not already_processed and self.save_processed_signals:
+            self.dataio.arrays[chan_grp][seg_num].flush_array('processed_signals')
+        
+        if len(all_spikes) > 0:
+            spikes = np.concatenate(all_spikes)
+        else:
+            spikes = np.zeros(0, dtype=_dtype_spike)
+        keep = (spikes['index'] >= block_start) & (spikes['index'] < block_stop)
+        spikes = spikes[keep]
+        
+        if len(telemetry) > 0:
+            telemetry = np.concatenate(telemetry)
+        else:
+            telemetry = np.zeros(0, dtype=_dtype_chunk_telemetry)
+        
+        return spikes, sig_index, telemetry
+    
+    def run_parallel_one_segment(self, seg_num=0, duration=None, n_jobs=-1, block_size=None, progressbar=True):
+        """
+        Same as run_offline_loop_one_segment but the segment is split in time blocks
+        peeled in separated processes. Each block has an overlap (warmup) with the previous
+        one to initialize filters and fifo. Spikes are stitched at block borders.
+        
+        Note that only the first block is strictly identical to the serial loop. For other blocks
+        the warmup is long enough for the filter state to settle but tiny numerical differences
+        remain possible near the begining. Use parallel_mode='segment' for an exact result.
+        """
+        chan_grp = self.catalogue['chan_grp']
+        
+        if duration is not None:
+            length = int(duration*self.dataio.sample_rate)
+        else:
+            length = self.dataio.get_segment_length(seg_num)
+        
+        already_processed = self.dataio.already_processed(seg_num=seg_num, chan_grp=chan_grp, length=length)
+        
+        engine = self.peeler_engine
+        if already_processed:
+            lostfront_chunksize = 0
+        else:
+            lostfront_chunksize = engine.signalpreprocessor.lostfront_chunksize
+            if self.save_processed_signals:
+                storage = self.dataio.info.get('processed_signals_storage', {'memory_mode': 'memmap'})
+                assert storage['memory_mode'] == 'memmap', "parallel_mode='block' need memmap processed_signals, use parallel_mode='segment'"
+            self._reset_processed_signals(seg_num)
+        
+        # warmup : filter transient (same margin as DataIO recompute) + fifo + spike left border
+        warmup_size = 3 * lostfront_chunksize + engine.fifo_size + self.chunksize
+        # tail : all spikes of the block must be out of the near border fifo
+        tail_size = lostfront_chunksize + engine.fifo_size + 2 * self.chunksize
+        
+        if n_jobs < 0:
+            n_worker = max(1, cpu_count() + 1 + n_jobs)
+        else:
+            n_worker = n_jobs
+        
+        if block_size is None:
+            block_size = int(np.ceil(length / n_worker))
+        # block must be large compared to warmup to be efficient
+        block_size = max(block_size, 4 * warmup_size)
+        block_size = int(np.ceil(block_size / self.chunksize)) * self.chunksize
+        
+        block_starts = np.arange(0, length, block_size)
+        block_stops = np.append(block_starts[1:], length)
+        
+        engine_kargs = dict(self._engine_kargs)
+        engine_kargs['already_processed'] = already_processed
+        if already_processed:
+            engine_kargs['source_dtype'] = self.internal_dtype
+        else:
+            engine_kargs['source_dtype'] = self.dataio.source_dtype
+        
+        units_args = [(self.dataio.dirname, self.catalogue, self.engine_name, self.internal_dtype,
+                                self.chunksize, self.engine_params, engine_kargs, seg_num, length, 
+                                block_start, block_stop, warmup_size, tail_size, already_processed,
+                                self.save_processed_signals)
+                                for block_start, block_stop in zip(block_starts, block_stops)]
+        results = run_units_in_parallel(_run_one_block, units_args, n_jobs=n_jobs, 
+                                progressbar=progressbar, desc='peeler block')
+        
+        dedup_size = engine.maximum_jitter_shift * 2 + engine.n_span
+        spikes = _stitch_block_spikes([r[0] for r in results], block_starts, dedup_size)
+        if len(results) > 0:
+            sig_index = results[-1][1]
+        else:
+            # empty segment (duration reached)
+            sig_index = 0
+        
+        if not already_processed and self.save_processed_signals:
+            self.dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp, processed_length=int(sig_index))
+        
+        telemetry = np.concatenate([np.zeros(0, dtype=_dtype_chunk_telemetry)] + [r[2] for r in results])
+        self.chunk_telemetry[seg_num] = telemetry.take(np.argsort(telemetry['pos'], kind='stable'))
+        
+        self.dataio.reset_spikes(seg_num=seg_num, chan_grp=chan_grp, dtype=_dtype_spike)
+        if spikes.size > 0:
+            self.dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=spikes)
+        self.dataio.flush_spikes(seg_num=seg_num, chan_grp=chan_grp)
 
-    def run(self, duration=None, progressbar=True):
+    def initialize_offline_loop(self, duration=None):
+        """
+        Initialize the engine for all segments.
+        
+        Return duration_per_segment.
+        """
         assert hasattr(self, 'catalogue'), 'So peeler.change_params first'
         
         chan_grp = self.catalogue['chan_grp']
         
         duration_per_segment = self.dataio.get_duration_per_segments(duration)
+        self.chunk_telemetry = {}
         
         already_processed_segs = []
         for seg_num in range(self.dataio.nb_segment):
@@ -176,9 +519,50 @@ class Peeler:
         kargs['geometry'] = self.dataio.get_geometry(chan_grp)
         kargs['already_processed'] =  all(already_processed_segs)
         self.peeler_engine.initialize(**kargs)
+        self._engine_kargs = kargs
         
-        for seg_num in range(self.dataio.nb_segment):
-            self.run_offline_loop_one_segment(seg_num=seg_num, duration=duration_per_segment[seg_num], progressbar=progressbar)
+        return duration_per_segment
+
+    def run(self, duration=None, progressbar=True, n_jobs=1, parallel_mode='segment', block_size=None, prefetch=0):
+        """
+        Run the peeler on all segments.
+        
+        Parameters
+        ----------
+        duration: float or None
+            Total duration to process (in s). None is all.
+        progressbar: bool
+            Display tqdm progressbar.
+        n_jobs: int (1 by default)
+            Number of worker processes when n_jobs!=1. -1 is all cores.
+        parallel_mode: 'segment' or 'block' ('segment' by default)
+            When n_jobs!=1:
+              * 'segment' : segments are peeled in parallel processes.
+                The result is strictly the same as n_jobs=1.
+              * 'block' : each segment is split in time blocks (with small overlap)
+                that are peeled in parallel processes. Faster for few long segments
+                but spikes and processed signals can slightly differ near block borders.
+        block_size: int or None
+            Size of blocks in sample for the 'block' mode. None is segment length / n_jobs.
+        prefetch: int (0 by default)
+            When n_jobs==1, number of chunks read in advance by a background thread
+            (see DataIO.iter_over_chunk). Useful for slow storage.
+        """
+        duration_per_segment = self.initialize_offline_loop(duration=duration)
+        
+        if n_jobs == 1:
+            for seg_num in range(self.dataio.nb_segment):
+                self.run_offline_loop_one_segment(seg_num=seg_num, duration=duration_per_segment[seg_num], 
+                                progressbar=progressbar, prefetch=prefetch)
+        elif parallel_mode == 'block':
+            for seg_num in range(self.dataio.nb_segment):
+                self.run_parallel_one_segment(seg_num=seg_num, duration=duration_per_segment[seg_num],
+                                n_jobs=n_jobs, block_size=block_size, progressbar=progressbar)
+        elif parallel_mode == 'segment':
+            run_peeler_parallel([self], duration=duration, n_jobs=n_jobs, progressbar=progressbar, 
+                                    _already_initialized=True)
+        else:
+            raise(ValueError('parallel_mode must be block or segment'))
     
     # old alias just in case
     run_offline_all_segment = run
@@ -186,3 +570,125 @@ class Peeler:
 
 
     
+
+
+
+def _timed_preprocess(signalpreprocessor, pos, sigs_chunk):
+    # for the pipelined online loop : preprocessing duration in the background thread
+    t0 = time.perf_counter()
+    pos2, preprocessed_chunk = signalpreprocessor.process_data(pos, sigs_chunk)
+    return pos2, preprocessed_chunk, time.perf_counter() - t0
+
+
+def _run_one_block(dirname, catalogue, engine, internal_dtype, chunksize, engine_params, engine_kargs,
+                    seg_num, length, block_start, block_stop, warmup_size, tail_size, already_processed,
+                    save_processed_signals=True):
+    # this run in a separated process with its own DataIO and engine
+    from .dataio import DataIO
+    dataio = DataIO(dirname)
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, engine=engine, internal_dtype=internal_dtype,
+                    chunksize=chunksize, save_processed_signals=save_processed_signals, **engine_params)
+    peeler.peeler_engine.initialize(**engine_kargs)
+    
+    return peeler.run_offline_loop_one_block(seg_num=seg_num, length=length, 
+                        block_start=block_start, block_stop=block_stop, 
+                        warmup_size=warmup_size, tail_size=tail_size, already_processed=already_processed)
+
+
+def _run_one_segment(dirname, catalogue, engine, internal_dtype, chunksize, engine_params, engine_kargs,
+                    seg_num, duration, save_processed_signals=True):
+    # this run in a separated process with its own DataIO and engine
+    from .dataio import DataIO
+    dataio = DataIO(dirname)
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, engine=engine, internal_dtype=internal_dtype,
+                    chunksize=chunksize, save_processed_signals=save_processed_signals, **engine_params)
+    peeler.peeler_engine.initialize(**engine_kargs)
+    peeler.run_offline_loop_one_segment(seg_num=seg_num, duration=duration, progressbar=False)
+    return peeler.chunk_telemetry[seg_num]
+
+
+def run_peeler_parallel(peelers, duration=None, n_jobs=-1, progressbar=True, _already_initialized=False):
+    """
+    Run several Peeler (typically one per channel group) on all segments.
+    Each (chan_grp, seg_num) is an independent unit that is run in a pool of
+    worker processes. Results written in DataIO are the same as peeler.run() for each one.
+    
+    Usage
+    ----------
+    
+        peelers = []
+        for chan_grp in dataio.channel_groups.keys():
+            peeler = Peeler(dataio)
+            peeler.change_params(catalogue=dataio.load_catalogue(chan_grp=chan_grp))
+            peelers.append(peeler)
+        run_peeler_parallel(peelers, n_jobs=8)
+    
+    Parameters
+    ----------
+    peelers: list of Peeler
+        Peelers with params already set (change_params)
+    duration: float or None
+        Total duration to process (in s). None is all.
+    n_jobs: int
+        Number of worker processes. -1 is all cores.
+    progressbar: bool
+        Display tqdm progressbar (one step per unit).
+    """
+    units_args = []
+    for peeler in peelers:
+        if _already_initialized:
+            duration_per_segment = peeler.dataio.get_duration_per_segments(duration)
+        else:
+            duration_per_segment = peeler.initialize_offline_loop(duration=duration)
+        for seg_num in range(peeler.dataio.nb_segment):
+            units_args.append((peeler.dataio.dirname, peeler.catalogue, peeler.engine_name, peeler.internal_dtype,
+                        peeler.chunksize, peeler.engine_params, peeler._engine_kargs, seg_num, duration_per_segment[seg_num],
+                        peeler.save_processed_signals))
+    
+    results = run_units_in_parallel(_run_one_segment, units_args, n_jobs=n_jobs, progressbar=progressbar, desc='peeler')
+    
+    # workers have written on disk : reload arrays
+    i = 0
+    for peeler in peelers:
+        chan_grp = peeler.catalogue['chan_grp']
+        peeler.chunk_telemetry = {}
+        for seg_num in range(peeler.dataio.nb_segment):
+            peeler.chunk_telemetry[seg_num] = results[i]
+            i += 1
+            for name in ['processed_signals', 'spikes', 'spikes_time_index']:
+                peeler.dataio.arrays[chan_grp][seg_num].load_if_exists(name)
+
+
+def _stitch_block_spikes(all_block_spikes, block_starts, dedup_size):
+    """
+    Concatenate spikes of consecutive blocks.
+    A spike that fall exactly on a border can be found by both blocks with a small shift:
+    on the right side of a border, spikes with same label and close to a spike 
+    of the previous block are removed.
+    """
+    stitched = []
+    previous = None
+    for b, spikes in enumerate(all_block_spikes):
+        if previous is not None and previous.size > 0 and spikes.size > 0:
+            border = block_starts[b]
+            prev_near = previous[(previous['index'] >= border - dedup_size) & (previous['cluster_label'] >= 0)]
+            near_inds, = np.nonzero((spikes['index'] < border + dedup_size) & (spikes['cluster_label'] >= 0))
+            keep = np.ones(spikes.size, dtype='bool')
+            for ind in near_inds:
+                same = (prev_near['cluster_label'] == spikes[ind]['cluster_label']) & \
+                            (np.abs(prev_near['index'] - spikes[ind]['index']) <= dedup_size)
+                if np.any(same):
+                    keep[ind] = False
+            spikes = spikes[keep]
+        stitched.append(spikes)
+        previous = spikes
+    
+    if len(stitched) == 0:
+        return np.zeros(0, dtype=_dtype_spike)
+    spikes = np.concatenate(stitched)
+    spikes = spikes.take(np.argsort(spikes['index'], kind='stable'))
+    return spikes
@@ -1,10 +1,10 @@
 import time
 
 from .peeler_tools import *
-from .peeler_tools import _dtype_spike
+from .peeler_tools import _dtype_spike, _dtype_chunk_telemetry
 from .tools import make_color_dict
 
-from .signalpreprocessor import signalpreprocessor_engines
+from .signalpreprocessor import signalpreprocessor_engines, renormalize_chunk
 #~ from .peakdetector import get_peak_detector_class
 
 
@@ -179,7 +179,11 @@ class PeelerEngineBase(OpenCL_Helper):
             #~ ax.axhline(-sparse_threshold_mad)
             #~ plt.show()
     
-    def initialize(self, sample_rate=None, nb_channel=None, source_dtype=None, geometry=None, already_processed=False, processor_engine=None):
+    def initialize(self, sample_rate=None, nb_channel=None, source_dtype=None, geometry=None, already_processed=False,
+                    processor_engine=None, processor_n_jobs=None):
+        # re-initialization : threads of the previous preprocessor
+        self.close()
+        
         self.nb_channel = nb_channel
         self.sample_rate = sample_rate
         self.source_dtype = source_dtype
@@ -200,6 +204,8 @@ class PeelerEngineBase(OpenCL_Helper):
             p['normalize'] = True
             p['signals_medians'] = self.catalogue['signals_medians']
             p['signals_mads'] = self.catalogue['signals_mads']
+            if processor_n_jobs is not None and self.signalpreprocessor_engine == 'numpy_threads':
+                p['n_jobs'] = processor_n_jobs
             
             if hasattr(self, 'ctx') and self.ctx is not None and self.signalpreprocessor_engine == 'opencl':
                 # use local ctx and queue if exists for processor
@@ -247,12 +253,62 @@ class PeelerEngineBase(OpenCL_Helper):
         self.total_spike = 0
         self.near_border_good_spikes = []
         self.fifo_residuals = np.zeros((self.fifo_size, self.nb_channel), dtype=self.internal_dtype)
+        self.chunk_telemetry = np.zeros(1, dtype=_dtype_chunk_telemetry)
         
         if self.signalpreprocessor is not None:
             self.signalpreprocessor.reset_fifo_index()
         
         self.already_processed = already_processed
 
+    def get_chunk_telemetry(self):
+        """
+        Telemetry of the last processed chunk : stage durations, peel loop
+        iterations and nb of spikes (array of 1 with _dtype_chunk_telemetry).
+        """
+        return self.chunk_telemetry
+    
+    def get_fifo_residuals(self):
+        return self.fifo_residuals
+    
+    def set_fifo_residuals(self, fifo_residuals):
+        self.fifo_residuals[:] = fifo_residuals
+    
+    def take_online_state(self, other):
+        """
+        Online catalogue hot-swap : continue the stream where an other engine
+        (the one of the previous catalogue) is, at a chunk boundary.
+        
+        Carried:
+          * total_spike and spikes near border not yet sent
+          * the right part of fifo_residuals (re-normalized if medians/mads changed)
+          * the filter state of the signal preprocessor when the filter is the same
+        
+        Return a dict that describe what have been carried.
+        """
+        self.total_spike = other.total_spike
+        self.near_border_good_spikes = list(other.near_border_good_spikes)
+        
+        fifo = np.array(other.get_fifo_residuals(), dtype=self.internal_dtype)
+        if self.signalpreprocessor is not None and other.signalpreprocessor is not None:
+            renormalize_chunk(fifo, other.signalpreprocessor, self.signalpreprocessor)
+        n = min(fifo.shape[0], self.fifo_size)
+        new_fifo = np.zeros((self.fifo_size, self.nb_channel), dtype=self.internal_dtype)
+        new_fifo[-n:, :] = fifo[-n:, :]
+        self.set_fifo_residuals(new_fifo)
+        
+        filter_state = False
+        if self.signalpreprocessor is not None and other.signalpreprocessor is not None:
+            filter_state = self.signalpreprocessor.take_filter_state(other.signalpreprocessor)
+        
+        return dict(fifo_carried=n, filter_state_carried=filter_state)
+    
+    def close(self):
+        """
+        Release threads of the signal preprocessor (for instance when the engine is replaced).
+        """
+        if getattr(self, 'signalpreprocessor', None) is not None:
+            self.signalpreprocessor.close()
+    
     def get_remaining_spikes(self):
         if len(self.near_border_good_spikes)>0:
             # deal with extra remaining spikes
@@ -281,15 +337,16 @@ class PeelerEngineGeneric(PeelerEngineBase):
             print('*'*10)
             print('process_one_chunk', pos)
         
+        t0 = time.perf_counter()
         abs_head_index, preprocessed_chunk = self.apply_processor( pos, sigs_chunk)
         
         # relation between inside chunk index and abs index
         to_local_shift = abs_head_index - self.fifo_size
         
         
-        #~ t1 = time.perf_counter()
+        t1 = time.perf_counter()
         self.detect_local_peaks_before_peeling_loop()
-        #~ t2 = time.perf_counter()
+        t2 = time.perf_counter()
         #~ print()
         #~ print('  detect_local_peaks_before_peeling_loop', (t2-t1)*1000)
         
@@ -302,6 +359,8 @@ class PeelerEngineGeneric(PeelerEngineBase):
             self._plot_before_peeling_loop()
 
         n_loop = 0
+        n_level = 0
+        reset_duration = 0.
         t3 = time.perf_counter()
         
         while True: # main loop
@@ -327,6 +386,7 @@ class PeelerEngineGeneric(PeelerEngineBase):
                     good_spikes.append(spike)
                     nb_good_spike+=1
                 n_loop +=1 
+            n_level += 1
             
             #~ if self._plot_debug:
                 #~ print('***end inner loop', n_loop,'nb_good_spike', nb_good_spike)
@@ -334,18 +394,19 @@ class PeelerEngineGeneric(PeelerEngineBase):
             if nb_good_spike == 0:
                 break
             else:
-                #~ t1 = time.perf_counter()
+                t5 = time.perf_counter()
                 self.reset_to_not_tested(good_spikes[-nb_good_spike:])
-                #~ t2 = time.perf_counter()
+                reset_duration += time.perf_counter() - t5
                 #~ print('  reset_to_not_tested', (t2-t1)*1000)
             
             if self._plot_debug:
                 self._plot_after_inner_peeling_loop()
         
         
+        t4 = time.perf_counter()
+        
         if self._plot_debug:
         #~ if True:
-            t4 = time.perf_counter()
             print('mainloop classify_and_align ', len(good_spikes), ' spike', (t4-t3)*1000, 'ms', 'n_loop', n_loop)
             self._plot_after_peeling_loop(good_spikes)
         
@@ -385,6 +446,19 @@ class PeelerEngineGeneric(PeelerEngineBase):
         all_spikes = all_spikes.take(np.argsort(all_spikes['index']))
         self.total_spike += all_spikes.size
         
+        t6 = time.perf_counter()
+        tel = self.chunk_telemetry
+        tel['pos'] = pos
+        tel['preprocess'] = t1 - t0
+        tel['detect'] = t2 - t1
+        tel['classify'] = t4 - t3 - reset_duration
+        tel['reset'] = reset_duration
+        tel['total'] = t6 - t0
+        tel['budget_ratio'] = (t6 - t0) * self.sample_rate / self.chunksize
+        tel['n_loop'] = n_loop
+        tel['n_level'] = n_level
+        tel['n_spike'] = all_spikes.size
+        
         #~ print(good_spikes.size, all_spikes.size)
         #~ exit()
         return abs_head_index, preprocessed_chunk, self.total_spike, all_spikes
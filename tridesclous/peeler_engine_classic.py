@@ -21,7 +21,7 @@ else:
 try:
     import numba
     HAVE_NUMBA = True
-    from .numba_tools import numba_loop_sparse_dist
+    from .numba_tools import numba_loop_sparse_dist, numba_batch_sparse_dist
 except ImportError:
     HAVE_NUMBA = False
 
@@ -39,9 +39,22 @@ class PeelerEngineClassic(PeelerEngineGeneric):
     
     def change_params(self,
                 argmin_method='numba',
+                batch_mode=False,
                 **kargs):
+        """
+        Parameters
+        ----------
+        argmin_method: 'numba', 'opencl', 'pythran' or 'numpy'
+            Method for computing the distance between a waveform and all templates.
+        batch_mode: bool (False by default)
+            Classify all non overlapping peaks of a peeling level at once (vectorized
+            distance, jitter, acceptation and prediction substraction) instead of one by one.
+            This is faster with high firing rates. The result is not strictly the same
+            because peaks are not peeled in the amplitude order inside one batch.
+        """
         PeelerEngineGeneric.change_params(self, **kargs)
         self.argmin_method = argmin_method
+        self.batch_mode = batch_mode
 
         if self.use_sparse_template:
             assert self.argmin_method in ('numba', 'opencl')
@@ -104,17 +117,24 @@ class PeelerEngineClassic(PeelerEngineGeneric):
         self.peakdetector.change_params(**p)
         
         self.mask_not_already_tested = np.ones(self.fifo_size - 2 * self.n_span, dtype='bool')
+        
+        # for batch mode
+        self.batch_spikes = []
+        # 2 candidates in the same batch must not share any sample even with the shift
+        self.batch_min_distance = self.peak_width + 2 * self.maximum_jitter_shift + 2
     
     def initialize_before_each_segment(self, **kargs):
         PeelerEngineGeneric.initialize_before_each_segment(self, **kargs)
         self.peakdetector.reset_fifo_index()
         self.mask_not_already_tested[:] = 1
+        self.batch_spikes = []
     
 
     def detect_local_peaks_before_peeling_loop(self):
         # negative mask 1: not tested 0: already tested
         self.mask_not_already_tested[:] = True
         self.local_peaks_mask = self.peakdetector.get_mask_peaks_in_chunk(self.fifo_residuals)
+        self.batch_spikes = []
         
         
         
@@ -309,6 +329,246 @@ class PeelerEngineClassic(PeelerEngineGeneric):
     
 
 
+    def classify_and_align_next_spike(self):
+        if not self.batch_mode:
+            return PeelerEngineGeneric.classify_and_align_next_spike(self)
+        
+        # in batch mode spikes are classified by batch and then given one by one
+        # to the generic peeling loop
+        if len(self.batch_spikes) == 0:
+            self.batch_spikes = self.classify_and_align_batch()
+            if len(self.batch_spikes) == 0:
+                return Spike(0, LABEL_NO_MORE_PEAK, 0)
+            self.batch_spikes.reverse()
+        return self.batch_spikes.pop()
+    
+    def select_next_peaks_batch(self):
+        """
+        Select all non overlapping peaks not already tested.
+        Greedy by amplitude so the first one is the one of select_next_peak().
+        """
+        local_peaks_indexes,  = np.nonzero(self.local_peaks_mask & self.mask_not_already_tested)
+        if local_peaks_indexes.size == 0:
+            return local_peaks_indexes
+        
+        local_peaks_indexes += self.n_span
+        amplitudes = np.max(np.abs(self.fifo_residuals[local_peaks_indexes, :]), axis=1)
+        order = np.argsort(-amplitudes, kind='stable')
+        
+        d = self.batch_min_distance
+        blocked = np.zeros(self.fifo_size + 2 * d, dtype='bool')
+        selected = []
+        for ind in local_peaks_indexes[order]:
+            if not blocked[ind + d]:
+                selected.append(ind)
+                blocked[ind+1:ind + 2*d] = True
+        return np.array(selected, dtype='int64')
+    
+    def get_best_template_batch(self, left_inds):
+        n = left_inds.size
+        
+        if self.argmin_method == 'numba':
+            all_dist = numba_batch_sparse_dist(self.fifo_residuals, left_inds, self.catalogue['centers0'],
+                                        self.sparse_mask_level1, self.maximum_jitter_shift)
+            all_dist = all_dist.reshape(n, -1)
+            best = np.argmin(all_dist, axis=1)
+            shift_inds, cluster_idxs = np.divmod(best, self.nb_cluster)
+            shifts = shift_inds - self.maximum_jitter_shift
+        elif self.argmin_method == 'numpy':
+            # dense : |wf - center|**2 = |wf|**2 - 2 wf.center + |center|**2 with one matrix product
+            waveforms = self.fifo_residuals[left_inds[:, None] + np.arange(self.peak_width)[None, :], :]
+            wf_flat = waveforms.reshape(n, -1)
+            centers_flat = self.catalogue['centers0'].reshape(self.nb_cluster, -1)
+            dist = np.sum(wf_flat**2, axis=1)[:, None] - 2 * wf_flat @ centers_flat.T + np.sum(centers_flat**2, axis=1)[None, :]
+            cluster_idxs = np.argmin(dist, axis=1)
+            shifts = np.zeros(n, dtype='int64')
+        else:
+            # opencl and pythran : one by one
+            cluster_idxs = np.zeros(n, dtype='int64')
+            shifts = np.zeros(n, dtype='int64')
+            for i, left_ind in enumerate(left_inds):
+                cluster_idx, shift, distance = self.get_best_template(left_ind, None)
+                cluster_idxs[i] = cluster_idx
+                if shift is not None:
+                    shifts[i] = shift
+        
+        return cluster_idxs, shifts
+    
+    def estimate_jitter_batch(self, left_inds, cluster_idxs):
+        # vectorized version of estimate_jitter
+        sample_inds = np.arange(self.peak_width)[None, :]
+        chan_max = self.catalogue['extremum_channel'][cluster_idxs][:, None]
+        wf0 = self.catalogue['centers0'][cluster_idxs[:, None], sample_inds, chan_max]
+        wf1 = self.catalogue['centers1'][cluster_idxs[:, None], sample_inds, chan_max]
+        wf2 = self.catalogue['centers2'][cluster_idxs[:, None], sample_inds, chan_max]
+        wf = self.fifo_residuals[left_inds[:, None] + sample_inds, chan_max]
+        
+        wf1_norm2= self.catalogue['wf1_norm2'][cluster_idxs]
+        wf2_norm2 = self.catalogue['wf2_norm2'][cluster_idxs]
+        wf1_dot_wf2 = self.catalogue['wf1_dot_wf2'][cluster_idxs]
+        
+        h = wf - wf0
+        h0_norm2 = np.sum(h * h, axis=1)
+        h_dot_wf1 = np.sum(h * wf1, axis=1)
+        jitter0 = h_dot_wf1/wf1_norm2
+        h1_norm2 = np.sum((h-jitter0[:, None]*wf1)**2, axis=1)
+        
+        h_dot_wf2 = np.sum(h * wf2, axis=1)
+        rss_first = -2*h_dot_wf1 + 2*jitter0*(wf1_norm2 - h_dot_wf2) + 3*jitter0**2*wf1_dot_wf2 + jitter0**3*wf2_norm2
+        rss_second = 2*(wf1_norm2 - h_dot_wf2) + 6*jitter0*wf1_dot_wf2 + 3*jitter0**2*wf2_norm2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jitter1 = jitter0 - rss_first/rss_second
+        
+        #order 1 is better than order 0
+        jitter1 = np.where(h0_norm2 > h1_norm2, jitter1, 0.)
+        return jitter1
+    
+    def accept_tempate_batch(self, left_inds, cluster_idxs, jitters):
+        # vectorized version of accept_tempate
+        # channels outside sparse_mask_level2 have weight=0 so the criteria is the same
+        waveforms = self.fifo_residuals[left_inds[:, None] + np.arange(self.peak_width)[None, :], :]
+        if self.inter_sample_oversampling:
+            j = jitters[:, None, None]
+            pred_wf = self.catalogue['centers0'][cluster_idxs] + j * self.catalogue['centers1'][cluster_idxs] + \
+                                j**2/2 * self.catalogue['centers2'][cluster_idxs]
+        else:
+            pred_wf = self.catalogue['centers0'][cluster_idxs]
+        
+        wf_nrj = np.sum(waveforms**2, axis=1)
+        residual_nrj = np.sum((waveforms-pred_wf)**2, axis=1)
+        weight = self.weight_per_template[cluster_idxs]
+        
+        thresh = 0.7
+        crietria_weighted = (wf_nrj>residual_nrj).astype('float') * weight
+        accept = np.sum(crietria_weighted, axis=1) >= thresh * np.sum(weight, axis=1)
+        accept &= np.abs(jitters) <= (self.maximum_jitter_shift - 0.5)
+        return accept
+    
+    def classify_and_align_batch(self):
+        """
+        Vectorized equivalent of classify_and_align_next_spike for all non overlapping peaks.
+        Accepted predictions are substracted in one pass.
+        Return a list of Spike.
+        """
+        peak_inds = self.select_next_peaks_batch()
+        n = peak_inds.size
+        if n == 0:
+            return []
+        
+        labels = np.full(n, LABEL_UNCLASSIFIED, dtype='int64')
+        jitters = np.zeros(n, dtype='float64')
+        left_inds = peak_inds + self.n_left
+        
+        right_limit = (left_inds+self.peak_width+self.maximum_jitter_shift+1) >= self.fifo_size
+        left_limit = left_inds <= self.maximum_jitter_shift
+        labels[right_limit] = LABEL_RIGHT_LIMIT
+        labels[left_limit & ~right_limit] = LABEL_LEFT_LIMIT
+        todo = ~right_limit & ~left_limit
+        
+        if self.catalogue['centers0'].shape[0]==0:
+            todo[:] = False
+        
+        if np.any(todo) and self.alien_value_threshold is not None:
+            inds, = np.nonzero(todo)
+            waveforms = self.fifo_residuals[left_inds[inds, None] + np.arange(self.peak_width)[None, :], :]
+            alien = np.any((waveforms>self.alien_value_threshold) | (waveforms<-self.alien_value_threshold), axis=(1, 2))
+            labels[inds[alien]] = LABEL_ALIEN
+            todo[inds[alien]] = False
+        
+        cluster_idxs = np.full(n, -1, dtype='int64')
+        if np.any(todo):
+            inds, = np.nonzero(todo)
+            cluster_idxs[inds], shifts = self.get_best_template_batch(left_inds[inds])
+            left_inds[inds] += shifts
+            ok = cluster_idxs[inds] >= 0
+            todo[inds[~ok]] = False
+        
+        if self.inter_sample_oversampling and np.any(todo):
+            inds, = np.nonzero(todo)
+            jitter = self.estimate_jitter_batch(left_inds[inds], cluster_idxs[inds])
+            shift = -np.round(jitter).astype('int64')
+            
+            # try better jitter
+            left2 = left_inds[inds] + shift
+            retry = (np.abs(jitter) > 0.5) & (left2 + self.peak_width < self.fifo_size) & (left2 >= 0)
+            if np.any(retry):
+                new_jitter = self.estimate_jitter_batch(left2[retry], cluster_idxs[inds[retry]])
+                better = np.abs(new_jitter) < np.abs(jitter[retry])
+                r, = np.nonzero(retry)
+                r = r[better]
+                jitter[r] = new_jitter[better]
+                left_inds[inds[r]] += shift[r]
+                shift[r] = -np.round(new_jitter[better]).astype('int64')
+            jitters[inds] = jitter
+            
+            # security to not be outside the fifo
+            max_shift = np.abs(shift) > self.maximum_jitter_shift
+            right = ~max_shift & ((left_inds[inds]+shift+self.peak_width)>=self.fifo_size)
+            left = ~max_shift & ~right & ((left_inds[inds] + shift) < 0)
+            labels[inds[max_shift]] = LABEL_MAXIMUM_SHIFT
+            labels[inds[right]] = LABEL_RIGHT_LIMIT
+            labels[inds[left]] = LABEL_LEFT_LIMIT
+            todo[inds[max_shift | right | left]] = False
+        
+        if np.any(todo):
+            inds, = np.nonzero(todo)
+            accept = self.accept_tempate_batch(left_inds[inds], cluster_idxs[inds], jitters[inds])
+            labels[inds[accept]] = self.catalogue['cluster_labels'][cluster_idxs[inds[accept]]]
+            jitters[inds[~accept]] = 0.
+        
+        good = labels >= 0
+        
+        if self.inter_sample_oversampling:
+            # second security check for borders
+            left_check = left_inds - np.round(jitters).astype('int64')
+            labels[good & (left_check<0)] = LABEL_LEFT_LIMIT
+            labels[good & (left_check>=0) & ((left_check+self.peak_width) >=self.fifo_size)] = LABEL_RIGHT_LIMIT
+            good = labels >= 0
+            
+            # ensure jitter in range [-0.5, 0.5]
+            shift = -np.round(jitters).astype('int64')
+            jitters[good] += shift[good]
+            left_inds[good] += shift[good]
+        
+        spike_inds = np.where(good, left_inds - self.n_left, peak_inds)
+        
+        # not accepted : set peak tested to not test it again
+        self.mask_not_already_tested[peak_inds[~good] - self.n_span] = False
+        
+        # accepted : remove all predictions from residuals in one pass
+        if np.any(good):
+            self.on_accepted_spikes_batch(spike_inds[good], cluster_idxs[good], jitters[good])
+        
+        spikes = []
+        for i in range(n):
+            if labels[i] >= 0 and self.inter_sample_oversampling:
+                jitter = jitters[i]
+            elif labels[i] >= 0:
+                jitter = None
+            else:
+                jitter = jitters[i]
+            spikes.append(Spike(spike_inds[i], labels[i], jitter))
+        return spikes
+    
+    def on_accepted_spikes_batch(self, peak_inds, cluster_idxs, jitters):
+        # vectorized version of make_prediction_one_spike + on_accepted_spike
+        sample_inds = np.arange(self.peak_width)[None, :]
+        pos = peak_inds + self.n_left
+        if self.inter_sample_oversampling:
+            r = self.catalogue['subsample_ratio']
+            shift = -np.round(jitters).astype('int64')
+            pos = pos + shift
+            int_jitter = np.trunc((jitters+shift)*r).astype('int64') + r//2
+            preds = self.catalogue['interp_centers0'][cluster_idxs[:, None], int_jitter[:, None] + r * sample_inds, :]
+        else:
+            preds = self.catalogue['centers0'][cluster_idxs]
+        np.subtract.at(self.fifo_residuals, pos[:, None] + sample_inds, preds.astype(self.fifo_residuals.dtype))
+        
+        # this prevent search peaks in the zone until next "reset_to_not_tested"
+        zone = (peak_inds + self.n_left - self.n_span)[:, None] + sample_inds
+        zone = zone[(zone>=0) & (zone<self.mask_not_already_tested.size)]
+        self.mask_not_already_tested[zone] = False
+
     def accept_tempate(self, left_ind, cluster_idx, jitter, distance):
         #~ self._debug_nb_accept_tempate += 1
         #~ import matplotlib.pyplot as plt
@@ -62,7 +62,7 @@ class PeelerEngineGeometrical(PeelerEngineGeneric):
         #~ self.strict_template = False
         
         if self.use_sparse_template:
-            assert self.argmin_method in ('numba', 'opencl')
+            assert self.argmin_method in ('numba', 'opencl', 'xcorr')
         
         if self.argmin_method == 'numpy':
             assert not self.use_sparse_template
@@ -110,6 +110,8 @@ class PeelerEngineGeometrical(PeelerEngineGeneric):
             else:
                 self.channels_adjacency[c] = np.arange(self.nb_channel, dtype='int64')
         
+        if self.argmin_method == 'xcorr':
+            self.make_xcorr_bank()
         
         if self.argmin_method == 'opencl'  and self.catalogue['centers0'].size>0:
             
@@ -181,6 +183,49 @@ class PeelerEngineGeometrical(PeelerEngineGeneric):
         #~ self.mask_not_already_tested = np.ones((self.fifo_size - 2 * self.n_span,self.nb_channel),  dtype='bool')
         
 
+    def make_xcorr_bank(self):
+        """
+        Precompute for each channel the bank of templates used by argmin_method='xcorr'.
+        
+        For each channel the candidate clusters are the ones of sparse_mask_level3
+        and the channels are the union of their sparse_mask_level2.
+        Each row of the bank is one cluster at one subsample offset (taken from interp_centers0)
+        masked with its own sparse_mask_level2 and flatten as (channel, sample).
+        
+        So distances of all candidates clusters at all shifts and all subsample offsets
+        is one matrix product per peak (see get_best_template).
+        """
+        centers = self.catalogue['centers0']
+        nb_cluster = centers.shape[0]
+        
+        if self.inter_sample_oversampling:
+            r = self.catalogue['subsample_ratio']
+            # interp_centers0[k, p::r, :] is the template at subsample offset p
+            bank = self.catalogue['interp_centers0'].reshape(nb_cluster, self.peak_width, r, self.nb_channel)
+        else:
+            r = 1
+            bank = centers.reshape(nb_cluster, self.peak_width, 1, self.nb_channel)
+        # shape is (nb_cluster, r, nb_channel, peak_width)
+        bank = bank.transpose(0, 2, 3, 1).astype('float32')
+        bank = bank * self.sparse_mask_level2[:, None, :, None]
+        
+        self.xcorr_subsample_ratio = r
+        # jitter of each subsample offset, see make_prediction_one_spike
+        self.xcorr_jitters = (np.arange(r) - r//2) / r
+        
+        self.xcorr_bank = {}
+        for c in range(self.nb_channel):
+            possibles_cluster_idx, = np.nonzero(self.sparse_mask_level3[:, c])
+            if possibles_cluster_idx.size == 0:
+                # no entry : get_best_template() give cluster_idx=-1
+                continue
+            channels, = np.nonzero(np.any(self.sparse_mask_level2[possibles_cluster_idx, :], axis=0))
+            templates = bank[possibles_cluster_idx, :, :, :][:, :, channels, :]
+            templates = templates.reshape(possibles_cluster_idx.size * r, -1).copy()
+            templates_norm2 = np.sum(templates**2, axis=1)
+            masks = self.sparse_mask_level2[possibles_cluster_idx, :][:, channels].astype('float32')
+            self.xcorr_bank[c] = (possibles_cluster_idx, channels, templates, templates_norm2, masks)
+
     def initialize_before_each_segment(self, **kargs):
         PeelerEngineGeneric.initialize_before_each_segment(self, **kargs)
         self.peakdetector.reset_fifo_index()
@@ -424,6 +469,34 @@ class PeelerEngineGeometrical(PeelerEngineGeneric):
                 #~ ax.plot(self.shifts, all_dist, marker='o')
                 #~ ax.set_title(f'{left_ind-self.n_left} {chan_ind} {shift}')
         
+        elif self.argmin_method == 'xcorr':
+            if chan_ind not in self.xcorr_bank:
+                # no candidate cluster for this channel (same as numba)
+                return -1, None, None
+            possibles_cluster_idx, channels, templates, templates_norm2, masks = self.xcorr_bank[chan_ind]
+            r = self.xcorr_subsample_ratio
+            
+            long_waveform = self.fifo_residuals[left_ind-self.maximum_jitter_shift:left_ind+self.peak_width+self.maximum_jitter_shift, :][:, channels]
+            # all shifted waveforms with shape (nb_shift, nb_chan, peak_width)
+            waveforms = np.lib.stride_tricks.sliding_window_view(long_waveform, self.peak_width, axis=0)
+            waveforms = waveforms.reshape(self.nb_shift, -1)
+            
+            nrj_by_chan = np.sum((waveforms**2).reshape(self.nb_shift, channels.size, self.peak_width), axis=2)
+            nrj = np.sum(nrj_by_chan, axis=1)
+            
+            # distance on the union of channels : ||w||^2 - 2 <w, t> + ||t||^2
+            # outside the template mask this is the waveform energy, like numba_loop_sparse_dist
+            all_dist = nrj[:, None] - 2 * (waveforms @ templates.T) + templates_norm2[None, :]
+            
+            ind_shift, ind = np.unravel_index(np.argmin(all_dist), all_dist.shape)
+            ind_clus, ind_sub = divmod(ind, r)
+            cluster_idx = possibles_cluster_idx[ind_clus]
+            shift = self.shifts[ind_shift]
+            self._xcorr_jitter = self.xcorr_jitters[ind_sub]
+            
+            # distance restricted to sparse_mask_level2 (as numba_explore_shifts) for accept_tempate
+            distance = all_dist[ind_shift, ind] - nrj[ind_shift] + nrj_by_chan[ind_shift, :] @ masks[ind_clus, :]
+        
         elif self.argmin_method == 'numpy':
             assert not self.use_sparse_template
             # replace by this (indentique but faster, a but)
@@ -469,6 +542,12 @@ class PeelerEngineGeometrical(PeelerEngineGeneric):
     
     #~ def estimate_jitter(self, left_ind, cluster_idx):
         #~ return 0.
+    
+    def estimate_jitter(self, left_ind, cluster_idx):
+        if self.argmin_method == 'xcorr':
+            # already estimated by get_best_template with the bank
+            return self._xcorr_jitter
+        return PeelerEngineGeneric.estimate_jitter(self, left_ind, cluster_idx)
 
     def accept_tempate(self, left_ind, cluster_idx, jitter, distance):
         if jitter is None:
@@ -54,7 +54,8 @@ class PeelerEngineGeometricalCl(PeelerEngineGeneric):
         #~ if self.argmin_method == 'opencl':
         OpenCL_Helper.initialize_opencl(self, cl_platform_index=self.cl_platform_index, cl_device_index=self.cl_device_index)
         
-        PeelerEngineGeneric.initialize(self, processor_engine='opencl', **kargs)
+        kargs['processor_engine'] = 'opencl'
+        PeelerEngineGeneric.initialize(self, **kargs)
         
 
         # some attrs
@@ -417,6 +418,15 @@ class PeelerEngineGeometricalCl(PeelerEngineGeneric):
                                                                     self.signalpreprocessor.output_backward_cl,
                                                                     np.int32(self.fifo_roll_size))
     
+    def get_fifo_residuals(self):
+        # fifo residuals live on the device
+        pyopencl.enqueue_copy(self.queue,  self.fifo_residuals, self.fifo_residuals_cl)
+        return self.fifo_residuals
+    
+    def set_fifo_residuals(self, fifo_residuals):
+        self.fifo_residuals[:] = fifo_residuals
+        pyopencl.enqueue_copy(self.queue,  self.fifo_residuals_cl, self.fifo_residuals)
+    
     def apply_processor(self, pos, sigs_chunk):
         if self._plot_debug:
             print('apply_processor')
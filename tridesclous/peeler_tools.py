@@ -24,6 +24,45 @@ _dtype_spike = [('index', 'int64'), ('cluster_label', 'int64'), ('jitter', 'floa
 
 Spike = namedtuple('Spike', ('index', 'cluster_label', 'jitter'))
 
+# per chunk telemetry of the peeler engine, durations are in seconds
+# budget_ratio is total / (chunksize / sample_rate) : >=1 means not real time
+_dtype_chunk_telemetry = [('pos', 'int64'), ('preprocess', 'float64'), ('detect', 'float64'),
+                ('classify', 'float64'), ('reset', 'float64'), ('total', 'float64'),
+                ('budget_ratio', 'float64'), ('n_loop', 'int64'), ('n_level', 'int64'), ('n_spike', 'int64'),]
+
+_telemetry_stages = ('preprocess', 'detect', 'classify', 'reset', 'total')
+
+
+def summarize_chunk_telemetry(telemetry, alarm_ratio=0.8):
+    """
+    Aggregate per chunk telemetry (array of _dtype_chunk_telemetry).
+    
+    alarm_ratio: a chunk is in alarm when its processing time is above
+        alarm_ratio * chunksize / sample_rate
+    
+    Return a dict.
+    """
+    summary = OrderedDict()
+    summary['nb_chunk'] = telemetry.size
+    if telemetry.size == 0:
+        return summary
+    
+    for stage in _telemetry_stages:
+        d = telemetry[stage]
+        summary[stage] = OrderedDict(mean=float(np.mean(d)), median=float(np.median(d)),
+                    p99=float(np.percentile(d, 99)), max=float(np.max(d)), sum=float(np.sum(d)))
+    
+    ratio = telemetry['budget_ratio']
+    summary['budget_ratio'] = OrderedDict(mean=float(np.mean(ratio)), median=float(np.median(ratio)),
+                    p99=float(np.percentile(ratio, 99)), max=float(np.max(ratio)))
+    summary['n_loop_mean'] = float(np.mean(telemetry['n_loop']))
+    summary['n_level_mean'] = float(np.mean(telemetry['n_level']))
+    summary['n_spike'] = int(np.sum(telemetry['n_spike']))
+    summary['nb_chunk_alarm'] = int(np.sum(ratio > alarm_ratio))
+    summary['alarm'] = summary['nb_chunk_alarm'] > 0
+    
+    return summary
+
 
 def make_prediction_on_spike_with_label(spike_index, spike_label, spike_jitter, dtype, catalogue):
     assert spike_label >= 0
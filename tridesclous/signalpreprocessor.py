@@ -1,3 +1,6 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import scipy.signal
 import numpy as np
 
@@ -7,12 +10,86 @@ if HAVE_PYOPENCL:
     mf = pyopencl.mem_flags
 
 
+try:
+    import numba
+    HAVE_NUMBA = True
+    from .numba_tools import numba_remove_common_ref
+except ImportError:
+    HAVE_NUMBA = False
+
+
 #~ from pyacq.dsp.overlapfiltfilt import SosFiltfilt_Scipy
 from .tools import FifoBuffer, median_mad
 
 
+common_ref_modes = ['median', 'mean']
+
+# 'full' : the backward filter is run over the whole fifo (chunksize + lostfront_chunksize) at each chunk
+# 'projection' : the backward filter state after the lostfront margin is a precomputed linear
+#                projection of the margin, so only chunksize samples are filtered at each chunk
+backward_modes = ['projection', 'full']
+
+
+def make_common_ref_groups(geometry, shank_gap_um=100.):
+    """
+    Group channels by shank given the geometry (nb_channel, 2) in um.
+    Channels are sorted on x and a new group start when the gap on x is more than shank_gap_um.
+    The result (list of list of channel index) can be given as common_ref_groups.
+    """
+    geometry = np.asarray(geometry)
+    order = np.argsort(geometry[:, 0], kind='stable')
+    x = geometry[order, 0]
+    splits, = np.nonzero(np.diff(x) > shank_gap_um)
+    groups = np.split(order, splits + 1)
+    return [sorted(int(c) for c in group) for group in groups]
+
+
+def remove_common_ref(data, mode='median', groups=None, engine=None):
+    """
+    Remove inplace the common reference sample by sample.
+    
+    Arguments
+    ---------------
+    data: np.ndarray (nb_sample, nb_channel)
+        modified inplace (and returned)
+    mode: 'median' or 'mean'
+        'median' is the robust one (and the historical one)
+    groups: None or list of list of channel index
+        None is one global reference. Otherwise each group (shank) has its own reference.
+        Channel not in any group are untouched.
+    engine: None, 'numba' or 'numpy'
+        None is numba when available : a selection kernel (no full sort) run in parallel over time blocks.
+    """
+    assert mode in common_ref_modes, 'common_ref_mode must be in {}'.format(common_ref_modes)
+    if engine is None:
+        engine = 'numba' if HAVE_NUMBA else 'numpy'
+    
+    if engine == 'numba':
+        assert HAVE_NUMBA, 'You must install numba'
+        if groups is None:
+            groups = [np.arange(data.shape[1])]
+        groups_channels = np.concatenate([np.asarray(group, dtype='int64') for group in groups])
+        groups_offsets = np.cumsum([0] + [len(group) for group in groups]).astype('int64')
+        block_size = 256
+        numba_remove_common_ref(data, groups_channels, groups_offsets, mode == 'median', block_size)
+    elif engine == 'numpy':
+        if groups is None:
+            groups = [slice(None)]
+        for group in groups:
+            if mode == 'median':
+                ref = np.median(data[:, group], axis=1)
+            elif mode == 'mean':
+                ref = np.mean(data[:, group], axis=1)
+            data[:, group] -= ref[:, None]
+    else:
+        raise(NotImplementedError)
+    
+    return data
+
+
 def offline_signal_preprocessor(sigs, sample_rate, common_ref_removal=True,
-        highpass_freq=300., lowpass_freq=None, output_dtype='float32', normalize=True, **unused):
+        highpass_freq=300., lowpass_freq=None, output_dtype='float32', normalize=True,
+        common_ref_mode='median', common_ref_groups=None, **unused):
     #cast
     sigs = sigs.astype(output_dtype)
     
@@ -32,7 +109,7 @@ def offline_signal_preprocessor(sigs, sample_rate, common_ref_removal=True,
 
     # common reference removal
     if common_ref_removal:
-        filtered_sigs = filtered_sigs - np.median(filtered_sigs, axis=1)[:, None]
+        filtered_sigs = remove_common_ref(filtered_sigs, mode=common_ref_mode, groups=common_ref_groups)
     
     # normalize
     if normalize:
@@ -59,6 +136,46 @@ def estimate_medians_mads_after_preprocesing(sigs, sample_rate, **params):
     
 
 
+def make_backward_projection(coefficients, size):
+    """
+    Matrix (nb_section*2, size) that give the state of the sos filter
+    after filtering size samples from a null state.
+    Column j is the state for a unit impulse at sample j, so it is
+    the state of the impulse response after size-1-j samples.
+    """
+    nb_section = coefficients.shape[0]
+    z = np.zeros((nb_section, 2))
+    states = np.zeros((size, nb_section, 2))
+    for i in range(size):
+        x = 1. if i == 0 else 0.
+        for s in range(nb_section):
+            b0, b1, b2, a0, a1, a2 = coefficients[s, :]
+            y = b0 * x + z[s, 0]
+            z[s, 0] = b1 * x - a1 * y + z[s, 1]
+            z[s, 1] = b2 * x - a2 * y
+            x = y
+        states[i] = z
+    
+    projection = states[::-1].reshape(size, nb_section * 2).T.copy()
+    return projection
+
+
+def renormalize_chunk(data, old_preprocessor, new_preprocessor):
+    """
+    Inplace: data normalized with signals_medians/signals_mads of old_preprocessor
+    become normalized with the ones of new_preprocessor.
+    """
+    if not (old_preprocessor.normalize and new_preprocessor.normalize):
+        return
+    if np.array_equal(old_preprocessor.signals_medians, new_preprocessor.signals_medians) and \
+            np.array_equal(old_preprocessor.signals_mads, new_preprocessor.signals_mads):
+        return
+    data *= old_preprocessor.signals_mads
+    data += old_preprocessor.signals_medians
+    data -= new_preprocessor.signals_medians
+    data /= new_preprocessor.signals_mads
+
+
 class SignalPreprocessor_base:
     def __init__(self,sample_rate, nb_channel, chunksize, input_dtype):
         self.sample_rate = sample_rate
@@ -68,24 +185,32 @@ class SignalPreprocessor_base:
 
     
     def change_params(self, common_ref_removal=True,
+                                            common_ref_mode='median',
+                                            common_ref_groups=None,
                                             highpass_freq=300.,
                                             lowpass_freq=None,
                                             smooth_size=0,
                                             output_dtype='float32', 
                                             normalize=True,
                                             lostfront_chunksize = None,
+                                            backward_mode='projection',
                                             signals_medians=None, signals_mads=None):
                 
         self.signals_medians = signals_medians
         self.signals_mads = signals_mads
         
         self.common_ref_removal = common_ref_removal
+        assert common_ref_mode in common_ref_modes, 'common_ref_mode must be in {}'.format(common_ref_modes)
+        self.common_ref_mode = common_ref_mode
+        self.common_ref_groups = common_ref_groups
         self.highpass_freq = highpass_freq
         self.lowpass_freq = lowpass_freq
         self.smooth_size = int(smooth_size)
         self.output_dtype = np.dtype(output_dtype)
         self.normalize = normalize
         self.lostfront_chunksize = lostfront_chunksize
+        assert backward_mode in backward_modes, 'backward_mode must be in {}'.format(backward_modes)
+        self.backward_mode = backward_mode
         
         # set default lostfront_chunksize if none is provided
         if self.lostfront_chunksize is None or self.lostfront_chunksize<=0:
@@ -144,6 +269,40 @@ class SignalPreprocessor_base:
         # must be for each new segment when index 
         # start back
         raise(NotImplmentedError)
+    
+    def get_filter_state(self):
+        """
+        State of the online filter (before common ref and normalization).
+        None when the engine do not support it.
+        """
+        return None
+    
+    def set_filter_state(self, state):
+        raise(NotImplementedError)
+    
+    def take_filter_state(self, other):
+        """
+        Continue the stream where an other preprocessor is (for instance the one of
+        the previous catalogue) so there is no filter transient.
+        This is possible only if the filter is the same.
+        Return True if the state have been taken.
+        """
+        if self.nb_channel != other.nb_channel or self.chunksize != other.chunksize or \
+                self.lostfront_chunksize != other.lostfront_chunksize or \
+                self.coefficients.shape != other.coefficients.shape or \
+                not np.allclose(self.coefficients, other.coefficients):
+            return False
+        state = other.get_filter_state()
+        if state is None or self.get_filter_state() is None:
+            return False
+        self.set_filter_state(state)
+        return True
+    
+    def close(self):
+        """
+        Release resources (threads) of the preprocessor.
+        """
+        pass
 
 
 
@@ -155,6 +314,10 @@ class SignalPreprocessor_Numpy(SignalPreprocessor_base):
        * normalize (optional)
     
     """
+    def change_params(self, **kargs):
+        SignalPreprocessor_base.change_params(self, **kargs)
+        if self.backward_mode == 'projection':
+            self.backward_projection = make_backward_projection(self.coefficients, self.lostfront_chunksize)
         
     def process_data(self, pos, data):
         
@@ -198,7 +361,15 @@ class SignalPreprocessor_Numpy(SignalPreprocessor_base):
             
         # NEW IMPLENTATION
         backward_chunk = self.forward_buffer.buffer
-        backward_filtered = scipy.signal.sosfilt(self.coefficients, backward_chunk[::-1, :], zi=None, axis=0)
+        if self.backward_mode == 'full':
+            backward_filtered = scipy.signal.sosfilt(self.coefficients, backward_chunk[::-1, :], zi=None, axis=0)
+        elif self.backward_mode == 'projection':
+            # the backward pass over the lostfront margin start from a null state
+            # so its final state is only a projection of the margin : then only chunksize samples are filtered
+            reversed_chunk = backward_chunk[::-1, :]
+            zi = np.dot(self.backward_projection, reversed_chunk[:self.lostfront_chunksize, :])
+            zi = zi.reshape(self.nb_section, 2, self.nb_channel)
+            backward_filtered, _ = scipy.signal.sosfilt(self.coefficients, reversed_chunk[self.lostfront_chunksize:, :], zi=zi, axis=0)
         backward_filtered = backward_filtered[::-1, :]
         backward_filtered = backward_filtered.astype(self.output_dtype)
         
@@ -216,21 +387,108 @@ class SignalPreprocessor_Numpy(SignalPreprocessor_base):
         
         #~ print('pos', pos, 'pos2', pos2, data2.shape)
         
+        self.remove_ref_and_normalize(data2)
+        
+        return pos2, data2
+    
+    def remove_ref_and_normalize(self, data2):
         # removal ref
         if self.common_ref_removal:
-            data2 -= np.median(data2, axis=1)[:, None]
+            remove_common_ref(data2, mode=self.common_ref_mode, groups=self.common_ref_groups)
         
         #normalize
         if self.normalize:
             data2 -= self.signals_medians
             data2 /= self.signals_mads
-        
-        return pos2, data2
     
     def reset_fifo_index(self):
         self.forward_buffer.reset()
         self.zi[:] = 0
     
+    def get_filter_state(self):
+        return dict(zi=self.zi.copy(), buffer=self.forward_buffer.buffer.copy(), last_index=self.forward_buffer.last_index)
+    
+    def set_filter_state(self, state):
+        # sosfilt promote zi to float64 : keep the dtype of the state
+        self.zi = state['zi'].copy()
+        self.forward_buffer.buffer[:] = state['buffer']
+        self.forward_buffer.last_index = state['last_index']
+
+
+class SignalPreprocessor_NumpyThreads(SignalPreprocessor_Numpy):
+    """
+    Same as SignalPreprocessor_Numpy but channels are sharded across a pool of threads.
+    scipy.signal.sosfilt release the GIL so shards are filtered in parallel.
+    Each shard is a SignalPreprocessor_Numpy with its own fifo and zi state.
+    Common reference and normalization are applied after on all channels.
+    
+    Extra param:
+      * n_jobs: number of threads (and shards), 2 by default, -1 is all cores
+    
+    The thread pool is released by close() and re-created on the next process_data().
+    """
+    def change_params(self, **kargs):
+        n_jobs = kargs.pop('n_jobs', 2)
+        SignalPreprocessor_base.change_params(self, **kargs)
+        
+        if n_jobs is None or n_jobs <= 0:
+            n_jobs = os.cpu_count()
+        n_shard = max(1, min(n_jobs, self.nb_channel))
+        limits = np.linspace(0, self.nb_channel, n_shard + 1).astype('int64')
+        self.shard_slices = [slice(limits[i], limits[i+1]) for i in range(n_shard)]
+        
+        # shards only filter
+        shard_params = dict(kargs)
+        shard_params.update(common_ref_removal=False, normalize=False, signals_medians=None, signals_mads=None,
+                            lostfront_chunksize=self.lostfront_chunksize)
+        self.shard_preprocessors = []
+        for sl in self.shard_slices:
+            shard = SignalPreprocessor_Numpy(self.sample_rate, sl.stop - sl.start, self.chunksize, self.input_dtype)
+            shard.change_params(**shard_params)
+            self.shard_preprocessors.append(shard)
+        
+        self.close()
+    
+    def close(self):
+        if getattr(self, 'executor', None) is not None:
+            self.executor.shutdown(wait=True)
+        self.executor = None
+    
+    def process_data(self, pos, data):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.shard_slices))
+        futures = [self.executor.submit(shard.process_data, pos, data[:, sl])
+                            for shard, sl in zip(self.shard_preprocessors, self.shard_slices)]
+        results = [future.result() for future in futures]
+        
+        pos2 = results[0][0]
+        if pos2 is None:
+            return None, None
+        
+        if len(results) == 1:
+            data2 = results[0][1]
+        else:
+            data2 = np.concatenate([data_shard for _, data_shard in results], axis=1)
+        
+        self.remove_ref_and_normalize(data2)
+        
+        return pos2, data2
+    
+    def reset_fifo_index(self):
+        for shard in self.shard_preprocessors:
+            shard.reset_fifo_index()
+    
+    def get_filter_state(self):
+        # shards are concatenated on channel axis
+        states = [shard.get_filter_state() for shard in self.shard_preprocessors]
+        return dict(zi=np.concatenate([st['zi'] for st in states], axis=2),
+                    buffer=np.concatenate([st['buffer'] for st in states], axis=1),
+                    last_index=states[0]['last_index'])
+    
+    def set_filter_state(self, state):
+        for shard, sl in zip(self.shard_preprocessors, self.shard_slices):
+            shard.set_filter_state(dict(zi=state['zi'][:, :, sl], buffer=state['buffer'][:, sl], last_index=state['last_index']))
+    
         
         
 
@@ -286,7 +544,7 @@ class SignalPreprocessor_OpenCL(SignalPreprocessor_base, OpenCL_Helper):
             #TODO make OpenCL for this
             # removal ref
             if self.common_ref_removal:
-                data2 -= np.median(data2, axis=1)[:, None]
+                remove_common_ref(data2, mode=self.common_ref_mode, groups=self.common_ref_groups)
             
             
             #normalize
@@ -474,4 +732,5 @@ _extra_code_nomalize = """
 
 
 signalpreprocessor_engines = { 'numpy' : SignalPreprocessor_Numpy,
+                                                'numpy_threads' : SignalPreprocessor_NumpyThreads,
                                                 'opencl' : SignalPreprocessor_OpenCL}
@@ -5,7 +5,7 @@ import shutil
 
 from tridesclous import download_dataset
 from tridesclous.dataio import DataIO
-from tridesclous.catalogueconstructor import CatalogueConstructor
+from tridesclous.catalogueconstructor import CatalogueConstructor, run_signalprocessor_parallel
 from tridesclous.tools import median_mad
 
 from matplotlib import pyplot as plt
@@ -332,6 +332,194 @@ def test_feature_with_lda_selection():
     print(cc.some_features.shape)
     print(cc.some_features)
     
+
+def test_compute_centroids_parallel():
+    dataio = DataIO(dirname='test_catalogueconstructor')
+    cc = CatalogueConstructor(dataio=dataio)
+    
+    all_medians = []
+    all_mads = []
+    for n_jobs, median_method in [(1, 'exact'), (2, 'exact'), (2, 'approx'), (3, 'exact')]:
+        # same spike selection for each run
+        np.random.seed(42)
+        t1 = time.perf_counter()
+        cc.compute_all_centroid(n_jobs=n_jobs, median_method=median_method)
+        t2 = time.perf_counter()
+        print('compute_all_centroid', n_jobs, median_method, t2-t1)
+        all_medians.append(cc.centroids_median.copy())
+        all_mads.append(cc.centroids_mad.copy())
+    
+    np.testing.assert_array_equal(all_medians[0], all_medians[1])
+    np.testing.assert_array_equal(all_mads[0], all_mads[1])
+    # labels are dispatched by batch (one per worker)
+    np.testing.assert_array_equal(all_medians[0], all_medians[3])
+    np.testing.assert_array_equal(all_mads[0], all_mads[3])
+    
+    # approximation is about histogram bin size
+    assert np.max(np.abs(all_medians[0] - all_medians[2])) < 0.2
+    assert np.max(np.abs(all_mads[0] - all_mads[2])) < 0.2
+
+
+def test_run_signalprocessor_parallel():
+    if os.path.exists('test_catalogueconstructor_parallel'):
+        shutil.rmtree('test_catalogueconstructor_parallel')
+    
+    dataio = DataIO(dirname='test_catalogueconstructor_parallel')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    channel_groups = {0: {'channels': list(range(7))}, 1: {'channels': list(range(7, 14))}}
+    dataio.set_channel_groups(channel_groups)
+    
+    ccs = []
+    for chan_grp in (0, 1):
+        cc = CatalogueConstructor(dataio=dataio, chan_grp=chan_grp)
+        cc.set_global_params(chunksize=1024, memory_mode='memmap', mode='dense', n_jobs=1)
+        cc.set_preprocessor_params(highpass_freq=300, lowpass_freq=5000., lostfront_chunksize=None)
+        cc.set_peak_detector_params(method='global', engine='numpy', peak_sign='-', relative_threshold=5)
+        cc.estimate_signals_noise(seg_num=0, duration=10.)
+        ccs.append(cc)
+    
+    # serial
+    serial_peaks = []
+    serial_sigs = []
+    for cc in ccs:
+        cc.run_signalprocessor(duration=20., detect_peak=True)
+        serial_peaks.append(cc.all_peaks.copy())
+        serial_sigs.append([dataio.get_signals_chunk(seg_num=seg_num, chan_grp=cc.chan_grp, signal_type='processed').copy()
+                                for seg_num in range(dataio.nb_segment)])
+    
+    # one cc parallel on segments
+    ccs[0].run_signalprocessor(duration=20., detect_peak=True, n_jobs=2)
+    np.testing.assert_array_equal(serial_peaks[0], ccs[0].all_peaks)
+    
+    # all channel groups and segments
+    t1 = time.perf_counter()
+    run_signalprocessor_parallel(ccs, duration=20., detect_peak=True, n_jobs=3, progressbar=False)
+    t2 = time.perf_counter()
+    print('run_signalprocessor_parallel', t2-t1)
+    
+    for i, cc in enumerate(ccs):
+        assert cc.all_peaks.size > 0
+        np.testing.assert_array_equal(serial_peaks[i], cc.all_peaks)
+        for seg_num in range(dataio.nb_segment):
+            sigs = dataio.get_signals_chunk(seg_num=seg_num, chan_grp=cc.chan_grp, signal_type='processed')
+            np.testing.assert_array_equal(serial_sigs[i][seg_num], sigs)
+
+
+def test_re_detect_peak_from_candidates():
+    if os.path.exists('test_catalogueconstructor_candidates'):
+        shutil.rmtree('test_catalogueconstructor_candidates')
+    
+    dataio = DataIO(dirname='test_catalogueconstructor_candidates')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.add_one_channel_group(channels=range(14), chan_grp=0)
+    
+    cc = CatalogueConstructor(dataio=dataio)
+    cc.set_global_params(chunksize=1024, memory_mode='memmap', mode='sparse', n_jobs=1)
+    cc.set_preprocessor_params(highpass_freq=300, lowpass_freq=5000., lostfront_chunksize=None)
+    cc.set_peak_detector_params(method='geometrical', engine='numpy', peak_sign='-', relative_threshold=4.,
+                        peak_span_ms=0.3, adjacency_radius_um=200.)
+    cc.estimate_signals_noise(seg_num=0, duration=10.)
+    cc.run_signalprocessor(duration=20., detect_peak=True)
+    
+    cc.cache_peak_candidates(min_relative_threshold=4., max_peak_span_ms=1.)
+    assert cc.peak_candidates.size > 0
+    
+    for relative_threshold, peak_span_ms in [(4., 0.3), (6., 0.3), (5., 0.7), (8., 1.)]:
+        kargs = dict(method='geometrical', engine='numpy', peak_sign='-', relative_threshold=relative_threshold,
+                        peak_span_ms=peak_span_ms, adjacency_radius_um=200.)
+        
+        # full scan
+        candidates = cc.peak_candidates
+        cc.peak_candidates = None
+        t1 = time.perf_counter()
+        cc.re_detect_peak(**kargs)
+        t2 = time.perf_counter()
+        scan_peaks = cc.all_peaks.copy()
+        cc.peak_candidates = candidates
+        
+        # filter
+        assert cc.can_re_detect_from_candidates()
+        t3 = time.perf_counter()
+        cc.re_detect_peak(**kargs)
+        t4 = time.perf_counter()
+        print('re_detect_peak', relative_threshold, peak_span_ms, 'scan', t2-t1, 'candidates', t4-t3)
+        
+        assert scan_peaks.size > 0
+        np.testing.assert_array_equal(scan_peaks, cc.all_peaks)
+    
+    # out of the cache range : full scan
+    cc.re_detect_peak(method='geometrical', engine='numpy', peak_sign='-', relative_threshold=3.,
+                        peak_span_ms=0.3, adjacency_radius_um=200.)
+    assert not cc.can_re_detect_from_candidates()
+    
+    # new preprocessing invalidate the cache
+    cc.run_signalprocessor(duration=20., detect_peak=True)
+    assert cc.peak_candidates is None
+    
+    shutil.rmtree('test_catalogueconstructor_candidates')
+
+
+def test_estimate_signals_noise_streaming():
+    if os.path.exists('test_catalogueconstructor_noise'):
+        shutil.rmtree('test_catalogueconstructor_noise')
+    
+    dataio = DataIO(dirname='test_catalogueconstructor_noise')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.add_one_channel_group(channels=range(14), chan_grp=0)
+    
+    cc = CatalogueConstructor(dataio=dataio)
+    cc.set_global_params(chunksize=1024, memory_mode='memmap', mode='dense', n_jobs=1)
+    cc.set_preprocessor_params(highpass_freq=300, lowpass_freq=5000., lostfront_chunksize=None)
+    
+    cc.estimate_signals_noise(seg_num=0, duration=10.)
+    exact_medians = cc.signals_medians.copy()
+    exact_mads = cc.signals_mads.copy()
+    
+    t1 = time.perf_counter()
+    cc.estimate_signals_noise(duration=10., method='streaming', seed=42)
+    t2 = time.perf_counter()
+    print('estimate_signals_noise streaming', t2-t1)
+    
+    # blocks are taken in all segments so this is not the same samples
+    assert np.all(np.abs(cc.signals_medians - exact_medians) < 0.05 * exact_mads)
+    assert np.all(np.abs(cc.signals_mads - exact_mads) < 0.05 * exact_mads)
+    
+    shutil.rmtree('test_catalogueconstructor_noise')
+
+
+def test_estimate_signals_noise_streaming_short_segments():
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    sigs = np.memmap(filenames[0], dtype=params['dtype'], mode='r').reshape(-1, params['total_channel'])
+    
+    # segments shorter than warmup + 16 chunks : smaller blocks
+    # segments shorter than warmup + 1 chunk : fallback to exact
+    for seg_lengths in ([12000, 2500], [2500]):
+        if os.path.exists('test_catalogueconstructor_noise'):
+            shutil.rmtree('test_catalogueconstructor_noise')
+        os.mkdir('test_catalogueconstructor_noise')
+        short_filenames = []
+        for i, length in enumerate(seg_lengths):
+            filename = os.path.join('test_catalogueconstructor_noise', 'short_{}.raw'.format(i))
+            sigs[:length].tofile(filename)
+            short_filenames.append(filename)
+        
+        dataio = DataIO(dirname='test_catalogueconstructor_noise/tdc')
+        dataio.set_data_source(type='RawData', filenames=short_filenames, **params)
+        dataio.add_one_channel_group(channels=range(14), chan_grp=0)
+        
+        cc = CatalogueConstructor(dataio=dataio)
+        cc.set_global_params(chunksize=1024, memory_mode='memmap', mode='dense', n_jobs=1)
+        cc.set_preprocessor_params(highpass_freq=300, lowpass_freq=5000., lostfront_chunksize=None)
+        cc.estimate_signals_noise(duration=10., method='streaming', seed=42)
+        assert cc.signals_mads.shape == (14, )
+        assert np.all(cc.signals_mads > 0)
+    
+    shutil.rmtree('test_catalogueconstructor_noise')
+    
+    
 if __name__ == '__main__':
     test_catalogue_constructor()
     
@@ -345,5 +533,14 @@ if __name__ == '__main__':
     #~ debug_interp_centers0()
     
     #~ test_feature_with_lda_selection()
+    
+    #~ test_compute_centroids_parallel()
+    
+    #~ test_run_signalprocessor_parallel()
+    
+    #~ test_re_detect_peak_from_candidates()
+    
+    #~ test_estimate_signals_noise_streaming()
+    #~ test_estimate_signals_noise_streaming_short_segments()
 
 
@@ -8,7 +8,7 @@ from tridesclous import download_dataset
 from tridesclous.dataio import DataIO
 from tridesclous.catalogueconstructor import CatalogueConstructor
 from tridesclous.autoparams import get_auto_params_for_catalogue
-from tridesclous.cataloguetools import  apply_all_catalogue_steps
+from tridesclous.cataloguetools import  apply_all_catalogue_steps, apply_all_catalogue_steps_parallel
 
 from matplotlib import pyplot as plt
 
@@ -29,6 +29,32 @@ def test_apply_all_catalogue_steps():
     cc = CatalogueConstructor(dataio, chan_grp=0)
     apply_all_catalogue_steps(cc, params, verbose=True)
     
+
+def test_apply_all_catalogue_steps_parallel():
+    if os.path.exists('test_cataloguetools_parallel'):
+        shutil.rmtree('test_cataloguetools_parallel')
+    
+    dataio = DataIO(dirname='test_cataloguetools_parallel')
+    localdir, filenames, params = download_dataset(name='locust')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.set_channel_groups({0: {'channels': [0, 1]}, 1: {'channels': [2, 3]}})
+    
+    params = get_auto_params_for_catalogue(dataio, chan_grp=0)
+    params['duration'] = 10.
+    
+    done = []
+    chan_grps = apply_all_catalogue_steps_parallel(dataio, params, n_jobs=2, callback=done.append)
+    assert sorted(chan_grps) == [0, 1]
+    assert done == chan_grps
+    
+    for chan_grp in chan_grps:
+        catalogue = dataio.load_catalogue(chan_grp=chan_grp)
+        assert catalogue['chan_grp'] == chan_grp
+        assert catalogue['centers0'].shape[2] == 2
+        cc = CatalogueConstructor(dataio, chan_grp=chan_grp)
+        assert cc.nb_peak > 0
+    
+    shutil.rmtree('test_cataloguetools_parallel')
     
     
     
@@ -36,4 +62,6 @@ def test_apply_all_catalogue_steps():
 if __name__ == '__main__':
     test_apply_all_catalogue_steps()
     
+    #~ test_apply_all_catalogue_steps_parallel()
+    
     
\ No newline at end of file
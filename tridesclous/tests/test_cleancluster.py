@@ -11,6 +11,7 @@ from tridesclous import mkQApp, CatalogueWindow
 from matplotlib import pyplot
 
 from tridesclous.tests.testingtools import setup_catalogue
+from tridesclous.waveformtools import equal_template, equal_template_pairs, HAVE_NUMBA
 
 
 #~ dataset_name='olfactory_bulb'
@@ -90,9 +91,39 @@ def test_auto_merge():
     t2 = time.perf_counter()
     print('auto_merge_cluster', t2-t1)
     
+    # no remaining pair can be merged
+    labels = cc.positive_cluster_labels
+    for i, k1 in enumerate(labels):
+        for k2 in labels[i+1:]:
+            ampl1 = np.abs(cc.clusters[cc.index_of_label(k1)]['extremum_amplitude'])
+            ampl2 = np.abs(cc.clusters[cc.index_of_label(k2)]['extremum_amplitude'])
+            thresh = max(max(ampl1, ampl2) * 0.2, 2.3)
+            assert not equal_template(cc.get_one_centroid(k1), cc.get_one_centroid(k2), thresh=thresh, n_shift=2)
+    
     cc.create_savepoint(name='after_auto_merge_cluster')
 
 
+def test_equal_template_pairs():
+    rng = np.random.RandomState(42)
+    nb_centroid, width, nb_chan = 30, 40, 8
+    centroids = rng.randn(nb_centroid, width, nb_chan).astype('float32') * 3
+    # some near duplicated with shift
+    centroids[10:20] = np.roll(centroids[:10], 1, axis=1) + rng.randn(10, width, nb_chan).astype('float32') * 0.3
+    
+    ind0, ind1 = np.triu_indices(nb_centroid, k=1)
+    pair_inds = np.stack([ind0, ind1], axis=1)
+    thresholds = rng.uniform(1., 3., size=ind0.size).astype('float32')
+    
+    expected = np.array([equal_template(centroids[i], centroids[j], thresh=t, n_shift=2)
+                        for (i, j), t in zip(pair_inds, thresholds)])
+    assert np.sum(expected) > 0
+    
+    engines = ['numpy'] + (['numba'] if HAVE_NUMBA else [])
+    for engine in engines:
+        equal = equal_template_pairs(centroids, pair_inds, thresholds, n_shift=2, engine=engine, block_size=64)
+        assert np.array_equal(equal, expected), engine
+
+
 
 
 def test_trash_low_extremum():
@@ -136,6 +167,7 @@ if __name__ == '__main__':
     #~ test_auto_split()
     #~ test_trash_not_aligned()
     #~ test_auto_merge()
+    #~ test_equal_template_pairs()
     #~ test_trash_low_extremum()
     test_trash_small_cluster()
     
@@ -59,7 +59,56 @@ def test_DataIO():
         for i_stop, sigs_chunk in dataio.iter_over_chunk(seg_num=seg_num, chunksize=1024):
             assert sigs_chunk.shape[0] == 1024
             assert sigs_chunk.shape[1] == 14
+    
+    # 'initial' is a copy by default, a view on the memmap only on demand
+    full = dataio.datasource.get_signals_chunk(seg_num=0, i_start=0, i_stop=1024)
+    sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=1024, signal_type='initial')
+    assert not np.shares_memory(sigs, full)
+    assert sigs.flags.writeable
+    sigs_view = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=1024, signal_type='initial', view=True)
+    assert np.shares_memory(sigs_view, full)
+    np.testing.assert_array_equal(sigs, sigs_view)
+
+
 
+def test_iter_over_chunk_prefetch():
+    if os.path.exists('test_DataIO_prefetch'):
+        shutil.rmtree('test_DataIO_prefetch')
+    dataio = DataIO(dirname='test_DataIO_prefetch')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.set_channel_groups({0:{'channels':range(2, 9)}})
+    
+    # processed signals : a float copy of initial signals
+    seg_num = 0
+    length = dataio.get_segment_length(seg_num)
+    dataio.reset_processed_signals(seg_num=seg_num, chan_grp=0, dtype='float32')
+    sigs = dataio.get_signals_chunk(seg_num=seg_num, chan_grp=0, signal_type='initial')
+    dataio.set_signals_chunk(sigs.astype('float32'), seg_num=seg_num, chan_grp=0, i_start=0, i_stop=length)
+    dataio.flush_processed_signals(seg_num=seg_num, chan_grp=0, processed_length=length)
+    
+    # i_stop not multiple of chunksize : padding and last chunk
+    i_stop = length - 1000
+    for signal_type in ('initial', 'processed'):
+        for kargs in [dict(), dict(pad_width=300), dict(with_last_chunk=True), 
+                    dict(pad_width=3000, with_last_chunk=True), dict(i_start=512, with_last_chunk=True)]:
+            chunks = {}
+            for prefetch in (0, 1, 3):
+                chunks[prefetch] = [(ind, sigs_chunk.copy()) for ind, sigs_chunk in dataio.iter_over_chunk(seg_num=seg_num, chan_grp=0,
+                            chunksize=1024, i_stop=i_stop, signal_type=signal_type, prefetch=prefetch, **kargs)]
+            assert len(chunks[0]) > 0
+            for prefetch in (1, 3):
+                assert len(chunks[prefetch]) == len(chunks[0])
+                for (ind0, chunk0), (ind1, chunk1) in zip(chunks[0], chunks[prefetch]):
+                    assert ind0 == ind1
+                    assert chunk0.dtype == chunk1.dtype
+                    np.testing.assert_array_equal(chunk0, chunk1)
+    
+    # the consumer stop before the end : the reader thread must stop
+    for ind, sigs_chunk in dataio.iter_over_chunk(seg_num=seg_num, chan_grp=0, chunksize=1024, prefetch=2):
+        break
+    
+    shutil.rmtree('test_DataIO_prefetch')
 
 
 def test_DataIO_probes():
@@ -117,6 +166,7 @@ def test_dataio_catalogue():
 if __name__=='__main__':
     
     test_DataIO()
+    test_iter_over_chunk_prefetch()
     test_DataIO_probes()
     test_dataio_catalogue()
     
@@ -42,6 +42,49 @@ def test_RawDataSource():
     assert data.shape==datasource.get_segment_shape(0)
 
 
+def test_get_signals_chunk_by_channels():
+    from tridesclous.datasource import RawDataSource
+    
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    datasource = RawDataSource(filenames=filenames, **params)
+    full = datasource.get_signals_chunk(seg_num=0, i_start=1000, i_stop=2024)
+    
+    # contiguous : a copy by default, a view on the memmap only on demand
+    data = datasource.get_signals_chunk_by_channels(seg_num=0, i_start=1000, i_stop=2024, channels=[4, 5, 6, 7])
+    assert not np.shares_memory(data, full)
+    assert data.flags.writeable
+    assert np.array_equal(data, full[:, 4:8])
+    data = datasource.get_signals_chunk_by_channels(seg_num=0, i_start=1000, i_stop=2024, channels=[4, 5, 6, 7], view=True)
+    assert np.shares_memory(data, full)
+    assert np.array_equal(data, full[:, 4:8])
+    stats = datasource.get_io_stats()
+    assert stats['last_bytes_read'] == 1024 * 16 * full.dtype.itemsize
+    assert stats['last_bytes_used'] == 1024 * 4 * full.dtype.itemsize
+    
+    # scattered channels
+    channels = [1, 3, 8, 15]
+    data = datasource.get_signals_chunk_by_channels(seg_num=0, i_start=1000, i_stop=2024, channels=channels, view=True)
+    assert not np.shares_memory(data, full)
+    assert np.array_equal(data, full[:, channels])
+    
+    # in a buffer with dtype conversion
+    out = np.zeros((1024, 4), dtype='float32')
+    data = datasource.get_signals_chunk_by_channels(seg_num=0, i_start=1000, i_stop=2024, channels=channels, out=out)
+    assert data is out
+    assert np.array_equal(out, full[:, channels].astype('float32'))
+    
+    data = datasource.get_signals_chunk_by_channels(seg_num=0, i_start=1000, i_stop=2024, channels=channels, dtype='float64')
+    assert data.dtype == 'float64'
+    assert np.array_equal(data, full[:, channels].astype('float64'))
+    
+    assert datasource.get_io_stats()['amplification'] == 4.
+    
+    # out of range channels are an error (not clipped)
+    for channels in ([1, 3, 16], [15, 16], [-1, 3]):
+        with pytest.raises(IndexError):
+            datasource.get_signals_chunk_by_channels(seg_num=0, i_start=1000, i_stop=2024, channels=channels)
+
+
 def test_NeoRawIOAggregator():
     
     url_for_tests = "https://web.gin.g-node.org/NeuralEnsemble/ephy_testing_data/raw/master/"
@@ -73,5 +116,6 @@ def test_NeoRawIOAggregator():
 if __name__=='__main__':
     test_InMemoryDataSource()
     test_RawDataSource()
+    test_get_signals_chunk_by_channels()
     test_NeoRawIOAggregator()
     
\ No newline at end of file
@@ -12,6 +12,8 @@ from matplotlib import pyplot
 
 from tridesclous.tests.testingtools import setup_catalogue
 
+import sklearn.decomposition
+
 dataset_name='olfactory_bulb'
 
 
@@ -48,6 +50,40 @@ def test_all_decomposition():
 
     
 
+def test_pca_by_channel():
+    dirname = 'test_decomposition'
+    
+    dataio = DataIO(dirname=dirname)
+    cc = CatalogueConstructor(dataio=dataio)
+    
+    n = 3
+    cc.extract_some_features(method='pca_by_channel', n_components_by_channel=n, random_state=0, n_jobs=2)
+    
+    # reference : one svd by channel and one read by channel
+    some_peaks = cc.all_peaks[cc.some_peaks_index]
+    channel_adjacency = dataio.get_channel_adjacency(chan_grp=cc.chan_grp, adjacency_radius_um=200)
+    for chan in range(cc.nb_channel):
+        sel = some_peaks['channel'] == chan
+        wf_chan = cc.get_some_waveforms(peaks_index=cc.some_peaks_index[sel], channel_indexes=[chan])[:, :, 0]
+        if wf_chan.shape[0] - 1 <= n:
+            assert np.all(cc.some_features[:, chan*n:(chan+1)*n] == 0)
+            continue
+        pca = sklearn.decomposition.TruncatedSVD(n_components=n, random_state=0)
+        pca.fit(wf_chan)
+        
+        sel = np.in1d(some_peaks['channel'], channel_adjacency[chan])
+        wf_chan = cc.get_some_waveforms(peaks_index=cc.some_peaks_index[sel], channel_indexes=[chan])[:, :, 0]
+        features = cc.some_features[:, chan*n:(chan+1)*n]
+        assert np.allclose(features[sel], pca.transform(wf_chan), atol=1e-3)
+        assert np.all(features[~sel] == 0)
+    
+    # projections are cached : projector is back on reload
+    cc2 = CatalogueConstructor(dataio=DataIO(dirname=dirname))
+    assert cc2.projector is not None
+    noise_features = cc2.projector.transform(cc2.some_noise_snippet)
+    assert np.allclose(noise_features, cc.some_noise_features, atol=1e-4)
+
+
 def debug_one_decomposition():
     dirname = 'test_catalogueconstructor'
     
@@ -76,6 +112,7 @@ def debug_one_decomposition():
 if __name__ == '__main__':
     #~ setup_module()
     #~ test_all_decomposition()
+    #~ test_pca_by_channel()
     
     debug_one_decomposition()
 
@@ -108,7 +108,93 @@ def test_ArrayCollection():
     one_test_ArrayCollection(withparent=True, memory_mode='memmap')
     one_test_ArrayCollection(withparent=False, memory_mode='ram')
     one_test_ArrayCollection(withparent=True, memory_mode='ram')
+
+
+def test_compressed_array():
+    if os.path.exists('test_ArrayCollection'):
+        shutil.rmtree('test_ArrayCollection')
+    
+    sigs = np.random.randn(10000, 5).astype('float32') * 3.
+    
+    for codec in ('int16', 'int16+zlib', 'zlib', 'lzma'):
+        ac = ArrayCollection(dirname='test_ArrayCollection', parent=None)
+        ac.create_array('processed_signals', 'float32', sigs.shape, 'compressed', chunksize=1024, codec=codec)
+        arr = ac.get('processed_signals')
+        
+        # write not aligned to chunks like the peeler (lostfront)
+        pos = 0
+        for i_stop in range(700, sigs.shape[0], 1024):
+            arr[pos:i_stop, :] = sigs[pos:i_stop]
+            pos = i_stop
+        arr[pos:, :] = sigs[pos:]
+        ac.flush_array('processed_signals')
+        
+        # reload
+        ac = ArrayCollection(dirname='test_ArrayCollection', parent=None)
+        ac.load_if_exists('processed_signals')
+        arr = ac.get('processed_signals')
+        assert arr.shape == sigs.shape
+        assert arr.dtype == sigs.dtype
+        
+        if codec.startswith('int16'):
+            tol = np.max(np.abs(sigs)) / 32767.
+        else:
+            tol = 0.
+        assert np.all(np.abs(arr[:, :] - sigs) <= tol)
+        assert np.all(np.abs(arr[3000:5001, :] - sigs[3000:5001]) <= tol)
+        assert np.all(np.abs(arr[2047:2049, [1, 3]] - sigs[2047:2049, [1, 3]]) <= tol)
+        assert np.abs(arr[5000, 2] - sigs[5000, 2]) <= tol
+        
+        assert arr.nbytes_on_disk() < sigs.nbytes
+        print(codec, arr.nbytes_on_disk() / sigs.nbytes)
+    
+
+
+def test_compressed_array_rewrite():
+    if os.path.exists('test_ArrayCollection'):
+        shutil.rmtree('test_ArrayCollection')
+    
+    sigs = np.random.randn(10000, 5).astype('float32') * 3.
+    
+    ac = ArrayCollection(dirname='test_ArrayCollection', parent=None)
+    ac.create_array('processed_signals', 'float32', sigs.shape, 'compressed', chunksize=1024, codec='zlib')
+    arr = ac.get('processed_signals')
+    arr[:, :] = sigs
+    ac.flush_array('processed_signals')
+    size0 = arr.nbytes_on_disk()
+    
+    # same size or smaller : in place
+    for i in range(3):
+        arr[:, :] = sigs
+        ac.flush_array('processed_signals')
+    arr[2000:4000, :] = 0.
+    ac.flush_array('processed_signals')
+    assert arr.nbytes_on_disk() == size0
+    
+    # bigger : the free slots are reused so the file do not grow for ever
+    for i in range(3):
+        arr[2000:4000, :] = sigs[2000:4000]
+        ac.flush_array('processed_signals')
+        arr[2000:4000, :] = 0.
+        ac.flush_array('processed_signals')
+    arr[:, :] = sigs
+    ac.flush_array('processed_signals')
+    assert arr.nbytes_on_disk() <= size0 * 1.3
+    
+    # reload : free slots are found again from the index
+    ac = ArrayCollection(dirname='test_ArrayCollection', parent=None)
+    ac.load_if_exists('processed_signals')
+    arr = ac.get('processed_signals')
+    np.testing.assert_array_equal(arr[:, :], sigs)
+    arr[2000:4000, :] = 0.
+    ac.flush_array('processed_signals')
+    arr[2000:4000, :] = sigs[2000:4000]
+    ac.flush_array('processed_signals')
+    assert arr.nbytes_on_disk() <= size0 * 1.3
+    np.testing.assert_array_equal(arr[:, :], sigs)
     
     
 if __name__=='__main__':
     test_ArrayCollection()
+    test_compressed_array()
+    test_compressed_array_rewrite()
@@ -11,6 +11,13 @@ import shutil
 import os
 import time
 
+import numpy as np
+import scipy.spatial
+import sklearn.metrics
+
+from tridesclous import metrics
+from tridesclous.metrics import cosine_similarity_with_max, HAVE_NUMBA
+
 
 def setup_module():
     setup_catalogue('test_metrics', dataset_name='olfactory_bulb')
@@ -49,6 +56,125 @@ def test_all_metrics():
     
 
 
+def test_cosine_similarity_with_max():
+    def func(u, v):
+        m = np.maximum(np.abs(u), np.abs(v))
+        return np.dot(u, v.T) / np.dot(m, m.T)
+    
+    def reference(x):
+        sim = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(x, metric=func))
+        return sim + np.eye(sim.shape[0])
+    
+    rng = np.random.RandomState(0)
+    nb, width, nb_chan = 40, 30, 16
+    x = rng.randn(nb, width, nb_chan).astype('float32')
+    sparse_mask = rng.rand(nb, nb_chan) < 0.3
+    
+    ref = reference(x.reshape(nb, -1))
+    sim = cosine_similarity_with_max(x.reshape(nb, -1))
+    assert np.allclose(sim, ref, atol=1e-5)
+    
+    rows = np.array([0, 5, 39])
+    sim_rows = cosine_similarity_with_max(x.reshape(nb, -1), rows=rows)
+    assert np.allclose(sim_rows, ref[rows, :], atol=1e-5)
+    
+    ref_sparse = reference((x * sparse_mask[:, None, :]).reshape(nb, -1))
+    engines = ['numpy'] + (['numba'] if HAVE_NUMBA else [])
+    for engine in engines:
+        sim = cosine_similarity_with_max(x, sparse_mask=sparse_mask, engine=engine)
+        assert np.allclose(sim, ref_sparse, atol=1e-5, equal_nan=True), engine
+        sim_rows = cosine_similarity_with_max(x, rows=rows, sparse_mask=sparse_mask, engine=engine)
+        assert np.allclose(sim_rows, ref_sparse[rows, :], atol=1e-5, equal_nan=True), engine
+
+
+def test_cluster_similarity_incremental():
+    dataio = DataIO(dirname='test_metrics')
+    cc = CatalogueConstructor(dataio=dataio)
+    
+    cc.compute_cluster_similarity()
+    cc.compute_cluster_ratio_similarity()
+    
+    # merge 2 clusters : only the row of the merged one is computed again
+    k1, k2 = cc.positive_cluster_labels[:2]
+    mask = cc.all_peaks['cluster_label'] == k2
+    cc.all_peaks['cluster_label'][mask] = k1
+    cc.pop_labels_from_cluster([k2])
+    cc.compute_one_centroid(k1)
+    
+    cc.compute_cluster_similarity()
+    cc.compute_cluster_ratio_similarity()
+    incremental = cc.cluster_similarity.copy(), cc.cluster_ratio_similarity.copy()
+    
+    # full computation
+    cc._similarity_keys = {}
+    cc.compute_cluster_similarity()
+    cc.compute_cluster_ratio_similarity()
+    assert incremental[0].shape[0] == cc.positive_cluster_labels.size
+    assert np.allclose(incremental[0], cc.cluster_similarity, equal_nan=True)
+    assert np.allclose(incremental[1], cc.cluster_ratio_similarity, equal_nan=True)
+
+
+def test_spike_silhouette_approx():
+    dataio = DataIO(dirname='test_metrics')
+    cc = CatalogueConstructor(dataio=dataio)
+    
+    for space in ('waveforms', 'features'):
+        cc.compute_spike_silhouette(method='exact', space=space)
+        exact = cc.spike_silhouette.copy()
+        
+        # with all spikes as reference and small blocks this is the exact silhouette
+        cc.compute_spike_silhouette(method='subsample', space=space, n_spike_by_cluster=cc.some_peaks_index.size, size_max=1e5)
+        assert np.allclose(cc.spike_silhouette, exact, atol=1e-4)
+        
+        t0 = time.perf_counter()
+        cc.compute_spike_silhouette(method='subsample', space=space, n_spike_by_cluster=50, seed=0)
+        t1 = time.perf_counter()
+        print('subsample', space, t1-t0, np.mean(np.abs(cc.spike_silhouette - exact)))
+        assert cc.spike_silhouette.shape == exact.shape
+        
+        cc.compute_spike_silhouette(method='simplified', space=space, size_max=1e5)
+        assert cc.spike_silhouette.shape == exact.shape
+        assert np.all(np.abs(cc.spike_silhouette) <= 1.)
+
+
+def test_cluster_similarity_sparse_opt_in():
+    dataio = DataIO(dirname='test_metrics')
+    cc = CatalogueConstructor(dataio=dataio)
+    
+    # dense by default whatever the mode
+    cc.compute_cluster_similarity()
+    mask = cc.cluster_labels >= 0
+    wfs = cc.centroids_median[mask, :, :]
+    dense = cosine_similarity_with_max(wfs)
+    assert np.allclose(cc.cluster_similarity, dense, atol=1e-5, equal_nan=True)
+    
+    # restricted to the sparse mask only on demand
+    cc.compute_cluster_similarity(sparse=True)
+    sparse = cosine_similarity_with_max(wfs, sparse_mask=cc.centroids_sparse_mask[mask, :])
+    assert np.allclose(cc.cluster_similarity, sparse, atol=1e-5, equal_nan=True)
+    
+    cc.compute_cluster_similarity()
+    assert np.allclose(cc.cluster_similarity, dense, atol=1e-5, equal_nan=True)
+
+
+def test_silhouette_approx_bounded_memory():
+    rng = np.random.RandomState(0)
+    dim = 20
+    labels = np.repeat(np.arange(3), 200)
+    data = rng.randn(labels.size, dim) + labels[:, None] * 1.5
+    size_max = 2000
+    
+    def get_data(ind):
+        # the reference set is read by block too
+        assert ind.size * dim <= size_max
+        return data[ind]
+    
+    exact = sklearn.metrics.silhouette_samples(data, labels)
+    silhouette = metrics.compute_silhouette_approx(get_data, labels, method='subsample',
+                        n_spike_by_cluster=labels.size, size_max=size_max)
+    assert np.allclose(silhouette, exact, atol=1e-6)
+
+
 @pytest.mark.skipif(ON_CI_CLOUD, reason='ON_CI_CLOUD')
 def test_cluster_ratio():
     dataio = DataIO(dirname='test_metrics')
@@ -72,6 +198,11 @@ if __name__ == '__main__':
     setup_module()
     
     test_all_metrics()
+    #~ test_cosine_similarity_with_max()
+    #~ test_cluster_similarity_incremental()
+    #~ test_spike_silhouette_approx()
+    #~ test_cluster_similarity_sparse_opt_in()
+    #~ test_silhouette_approx_bounded_memory()
     test_cluster_ratio()
     
     #~ plt.show()
\ No newline at end of file
@@ -110,6 +110,7 @@ def test_compare_offline_online_engines():
         ('global', 'numpy'),
         ('geometrical', 'numpy'),
         ('geometrical', 'numba'),
+        ('geometrical', 'numba_list'),
     ]
     
     if HAVE_PYOPENCL:
@@ -156,6 +157,7 @@ def test_compare_offline_online_engines():
 
     offline_peaks['geometrical', 'numpy'] = peaks
     offline_peaks['geometrical', 'numba'] = peaks
+    offline_peaks['geometrical', 'numba_list'] = peaks
     offline_peaks['geometrical', 'opencl'] = peaks
 
     online_peaks = {}
@@ -358,6 +360,7 @@ def test_peak_sign_symetry():
         ('global', 'numpy'),
         ('geometrical', 'numpy'),
         ('geometrical', 'numba'),
+        ('geometrical', 'numba_list'),
     ]
     if HAVE_PYOPENCL:
         engine_names += [
@@ -401,6 +404,8 @@ def test_peak_sign_symetry():
 
         assert np.array_equal(online_peaks[method, engine, '-'], online_peaks[method, engine, '+'])
     
+    assert np.array_equal(online_peaks['geometrical', 'numba', '-'], online_peaks['geometrical', 'numba_list', '-'])
+    
     if HAVE_PYOPENCL:
         assert np.array_equal(online_peaks['global', 'numpy', '-'], online_peaks['global', 'opencl', '-'])
         assert np.array_equal(online_peaks['geometrical', 'numpy', '-'], online_peaks['geometrical', 'numba', '-'])
@@ -412,6 +417,40 @@ def test_peak_sign_symetry():
 
     
 
+def test_geometrical_numba_list_engine():
+    chunksize=1024
+    sigs, sample_rate, normed_sigs, geometry = get_normed_sigs(chunksize=chunksize)
+    nb_channel = normed_sigs.shape[1]
+    args = (sample_rate, nb_channel, chunksize, 'float32', geometry)
+    
+    for peak_sign in ('-', '+'):
+        all_peaks = {}
+        for engine in ('numba', 'numba_list'):
+            peakdetector = get_peak_detector_class('geometrical', engine)(*args)
+            peakdetector.change_params(peak_span_ms=0.9, relative_threshold=5, peak_sign=peak_sign,
+                            adjacency_radius_um=100.)
+            
+            peaks = []
+            t1 = time.perf_counter()
+            for i in range(normed_sigs.shape[0]//chunksize):
+                pos = (i+1)*chunksize
+                chunk = normed_sigs[pos-chunksize:pos,:]
+                time_ind_peaks, chan_ind_peaks, peak_val_peaks = peakdetector.process_data(pos, chunk)
+                if time_ind_peaks is not None:
+                    peaks.append(np.stack([time_ind_peaks, chan_ind_peaks], axis=1))
+                    assert np.array_equal(peak_val_peaks, normed_sigs[time_ind_peaks, chan_ind_peaks])
+            t2 = time.perf_counter()
+            print(engine, peak_sign, 'process time', t2-t1)
+            all_peaks[engine] = np.concatenate(peaks)
+            
+            # mask used by peeler on a longer buffer than chunksize
+            fifo = normed_sigs[:chunksize*3]
+            all_peaks[engine, 'mask'] = peakdetector.get_mask_peaks_in_chunk(fifo)
+        
+        assert all_peaks['numba'].shape[0] > 0
+        np.testing.assert_array_equal(all_peaks['numba'], all_peaks['numba_list'])
+        np.testing.assert_array_equal(all_peaks['numba', 'mask'], all_peaks['numba_list', 'mask'])
+
     
 if __name__ == '__main__':
     #~ test_compare_offline_online_engines()
@@ -422,4 +461,6 @@ if __name__ == '__main__':
     #~ benchmark_speed()
     
     test_peak_sign_symetry()
+    
+    #~ test_geometrical_numba_list_engine()
     
\ No newline at end of file
@@ -13,6 +13,7 @@ import  pyqtgraph as pg
 from tridesclous.dataio import DataIO
 from tridesclous.catalogueconstructor import CatalogueConstructor
 from tridesclous import Peeler
+from tridesclous.peeler import run_peeler_parallel
 from tridesclous.peeler_cl import Peeler_OpenCl
 
 from tridesclous.peakdetector import  detect_peaks_in_chunk
@@ -65,6 +66,51 @@ def test_peeler_classic():
     print(count_by_label)
     
 
+def test_peeler_classic_batch():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0, name='with_oversampling')
+    
+    all_spikes = []
+    for batch_mode in (False, True):
+        peeler = Peeler(dataio)
+        peeler.change_params(engine='classic', catalogue=catalogue,chunksize=1024,
+                        argmin_method='numba', batch_mode=batch_mode)
+        t1 = time.perf_counter()
+        peeler.run(progressbar=False)
+        t2 = time.perf_counter()
+        print('batch_mode', batch_mode, 'peeler.run_loop', t2-t1)
+        all_spikes.append(dataio.get_spikes(chan_grp=0).copy())
+    
+    spikes0, spikes1 = all_spikes
+    assert np.all(np.diff(spikes1['index'])>=0)
+    labels = catalogue['clusters']['cluster_label']
+    for label in labels:
+        n0 = np.sum(spikes0['cluster_label'] == label)
+        n1 = np.sum(spikes1['cluster_label'] == label)
+        print(label, n0, n1)
+        assert abs(n0 - n1) <= 0.05 * n0 + 2
+    
+    # match spikes of both modes by index within the jitter tolerance
+    good0 = spikes0[spikes0['cluster_label'] >= 0]
+    good1 = spikes1[spikes1['cluster_label'] >= 0]
+    tolerance = peeler.peeler_engine.maximum_jitter_shift
+    ind = np.clip(np.searchsorted(good1['index'], good0['index']), 1, good1.size - 1)
+    ind = np.where(np.abs(good1['index'][ind - 1] - good0['index']) <= np.abs(good1['index'][ind] - good0['index']), ind - 1, ind)
+    matched = np.abs(good1['index'][ind] - good0['index']) <= tolerance
+    print('matched', np.mean(matched))
+    assert np.mean(matched) > 0.98
+    
+    same_label = good0['cluster_label'][matched] == good1['cluster_label'][ind[matched]]
+    print('label agreement', np.mean(same_label))
+    assert np.mean(same_label) > 0.97
+    
+    # jitter of matched pairs with the same label
+    jitter_diff = np.abs(good0['jitter'][matched][same_label] - good1['jitter'][ind[matched]][same_label])
+    print('jitter diff median', np.median(jitter_diff))
+    assert np.median(jitter_diff) < 0.01
+    assert np.mean(jitter_diff < 0.05) > 0.95
+
+
 def test_peeler_geometry():
     dataio = DataIO(dirname='test_peeler')
     
@@ -99,6 +145,68 @@ def test_peeler_geometry():
         print(count_by_label)
 
 
+def test_peeler_geometry_xcorr():
+    dataio = DataIO(dirname='test_peeler')
+    
+    catalogue0 = dataio.load_catalogue(chan_grp=0)
+    catalogue1 = dataio.load_catalogue(chan_grp=0, name='with_oversampling')
+    
+    for catalogue in (catalogue0, catalogue1):
+        print()
+        print('inter_sample_oversampling', catalogue['inter_sample_oversampling'])
+        
+        all_spikes = {}
+        for argmin_method in ('numba', 'xcorr'):
+            peeler = Peeler(dataio)
+            peeler.change_params(engine='geometrical',
+                                        catalogue=catalogue,
+                                        chunksize=1024,
+                                        argmin_method=argmin_method)
+            t1 = time.perf_counter()
+            peeler.run(progressbar=False)
+            t2 = time.perf_counter()
+            print(argmin_method, 'peeler.run_loop', t2-t1)
+            all_spikes[argmin_method] = dataio.get_spikes(chan_grp=0).copy()
+        
+        spikes0, spikes1 = all_spikes['numba'], all_spikes['xcorr']
+        labels = catalogue['clusters']['cluster_label']
+        count0 = np.array([np.sum(spikes0['cluster_label'] == label) for label in labels])
+        count1 = np.array([np.sum(spikes1['cluster_label'] == label) for label in labels])
+        print(count0)
+        print(count1)
+        
+        # cluster choice is done jointly with shift and jitter so small differences are expected
+        assert abs(np.sum(count1) - np.sum(count0)) <= 0.05 * np.sum(count0)
+        if catalogue['inter_sample_oversampling']:
+            jitters = spikes1['jitter'][spikes1['cluster_label'] >= 0]
+            assert np.all(np.abs(jitters) <= 0.5)
+
+
+def test_peeler_geometry_channel_without_cluster():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    # no cluster is candidate on the main channel of the first cluster
+    chan_ind = catalogue['extremum_channel'][0]
+    catalogue = dict(catalogue)
+    catalogue['sparse_mask_level3'] = catalogue['sparse_mask_level3'].copy()
+    catalogue['sparse_mask_level3'][:, chan_ind] = False
+    
+    for argmin_method in ('numba', 'xcorr'):
+        peeler = Peeler(dataio)
+        peeler.change_params(engine='geometrical', catalogue=catalogue,
+                                    chunksize=1024, argmin_method=argmin_method)
+        peeler.run(progressbar=False, duration=10.)
+        
+        engine = peeler.peeler_engine
+        if argmin_method == 'xcorr':
+            assert chan_ind not in engine.xcorr_bank
+        left_ind = engine.fifo_size // 2
+        cluster_idx, shift, distance = engine.get_best_template(left_ind, chan_ind)
+        assert cluster_idx == -1
+        assert shift is None
+
+
 @pytest.mark.skipif(ON_CI_CLOUD, reason='ON_CI_CLOUD')
 def test_peeler_geometry_cl():
     dataio = DataIO(dirname='test_peeler')
@@ -338,6 +446,131 @@ def test_peeler_with_and_without_preprocessor():
     
 
 
+def test_peeler_parallel_blocks():
+    dataio = DataIO(dirname='test_peeler2')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    all_spikes = []
+    all_sigs = []
+    for n_jobs in (1, 2):
+        peeler = Peeler(dataio)
+        peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=1024)
+        # force processing from raw signals
+        dataio.reset_processed_signals(seg_num=0, chan_grp=0, dtype='float32')
+        t1 = time.perf_counter()
+        peeler.run(progressbar=False, n_jobs=n_jobs, parallel_mode='block', block_size=30000)
+        t2 = time.perf_counter()
+        print('n_jobs', n_jobs, 'peeler run_time', t2 - t1)
+        all_spikes.append(dataio.get_spikes(seg_num=0, chan_grp=0).copy())
+        all_sigs.append(dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed').copy())
+    
+    spikes0, spikes1 = all_spikes
+    print(spikes0.size, spikes1.size)
+    assert np.all(np.diff(spikes1['index'])>=0)
+    assert dataio.get_processed_length(seg_num=0, chan_grp=0) > 0
+    
+    # first block is exactly the serial loop
+    keep0 = spikes0['index'] < 30000
+    keep1 = spikes1['index'] < 30000
+    np.testing.assert_array_equal(spikes0[keep0]['index'], spikes1[keep1]['index'])
+    np.testing.assert_array_equal(spikes0[keep0]['cluster_label'], spikes1[keep1]['cluster_label'])
+    
+    # other blocks : the warmup is long enough for the filter state to settle
+    # so spikes near borders are the same (index and label)
+    n = dataio.get_processed_length(seg_num=0, chan_grp=0)
+    borders = np.arange(30000, n, 30000)
+    for border in borders:
+        near0 = spikes0[np.abs(spikes0['index'] - border) < 2048]
+        near1 = spikes1[np.abs(spikes1['index'] - border) < 2048]
+        np.testing.assert_array_equal(near0['index'], near1['index'])
+        np.testing.assert_array_equal(near0['cluster_label'], near1['cluster_label'])
+    np.testing.assert_array_equal(spikes0['index'], spikes1['index'])
+    np.testing.assert_array_equal(spikes0['cluster_label'], spikes1['cluster_label'])
+    
+    sigs0, sigs1 = all_sigs[0][:n], all_sigs[1][:n]
+    assert np.max(np.abs(sigs0 - sigs1)) < 1e-3
+
+
+def test_peeler_parallel_segments():
+    dataio = DataIO(dirname='test_peeler2')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    all_spikes = []
+    for n_jobs in (1, 2):
+        peeler = Peeler(dataio)
+        peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=1024)
+        for seg_num in range(dataio.nb_segment):
+            dataio.reset_processed_signals(seg_num=seg_num, chan_grp=0, dtype='float32')
+        peeler.run(progressbar=False, n_jobs=n_jobs, parallel_mode='segment')
+        all_spikes.append([dataio.get_spikes(seg_num=seg_num, chan_grp=0).copy() for seg_num in range(dataio.nb_segment)])
+    
+    # the same with the scheduler function
+    peeler = Peeler(dataio)
+    peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=1024)
+    run_peeler_parallel([peeler], n_jobs=2, progressbar=False)
+    all_spikes.append([dataio.get_spikes(seg_num=seg_num, chan_grp=0).copy() for seg_num in range(dataio.nb_segment)])
+    
+    for seg_num in range(dataio.nb_segment):
+        print(seg_num, all_spikes[0][seg_num].size)
+        for i in (1, 2):
+            for k in ('index', 'cluster_label', 'jitter'):
+                np.testing.assert_array_equal(all_spikes[0][seg_num][k], all_spikes[i][seg_num][k])
+
+
+def test_peeler_without_saving_processed_signals():
+    dataio = DataIO(dirname='test_peeler2')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    windows = [(0, 2048), (10000, 12345), (50000, 51024)]
+    
+    all_spikes = []
+    all_sigs = []
+    for save_processed_signals in (True, False):
+        for seg_num in range(dataio.nb_segment):
+            dataio.reset_processed_signals(seg_num=seg_num, chan_grp=0, dtype='float32')
+        peeler = Peeler(dataio)
+        peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=1024,
+                        save_processed_signals=save_processed_signals)
+        peeler.run(progressbar=False)
+        all_spikes.append([dataio.get_spikes(seg_num=seg_num, chan_grp=0).copy() for seg_num in range(dataio.nb_segment)])
+        sigs = [dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=i_start, i_stop=i_stop,
+                        signal_type='processed').copy() for i_start, i_stop in windows]
+        all_sigs.append(sigs)
+        
+        processed_length = dataio.arrays[0][0].get_annotation('processed_signals', 'processed_length')
+        if save_processed_signals:
+            assert processed_length > windows[-1][1]
+        else:
+            assert processed_length == 0
+    
+    for seg_num in range(dataio.nb_segment):
+        for k in ('index', 'cluster_label', 'jitter'):
+            np.testing.assert_array_equal(all_spikes[0][seg_num][k], all_spikes[1][seg_num][k])
+    
+    for sigs0, sigs1 in zip(*all_sigs):
+        assert sigs0.shape == sigs1.shape
+        # recompute start some chunks before so the filter transient is gone
+        assert np.max(np.abs(sigs0 - sigs1)) < 0.01
+    
+    # in recompute mode waveforms are read with the same path as get_signals_chunk : exact
+    # the processed_signals array is not used at all (here removed)
+    dataio.arrays[0][0].detach_array('processed_signals')
+    spikes = all_spikes[1][0]
+    peak_indexes = spikes['index'][(spikes['index'] > 100) & (spikes['index'] < dataio.get_segment_length(0) - 100)]
+    n_left, n_right = catalogue['n_left'], catalogue['n_right']
+    waveforms = dataio.get_some_waveforms(seg_num=0, chan_grp=0, peak_sample_indexes=peak_indexes,
+                                n_left=n_left, n_right=n_right)
+    assert waveforms.dtype == np.dtype('float32')
+    for i in np.random.RandomState(0).choice(peak_indexes.size, 50, replace=False):
+        ind = peak_indexes[i]
+        sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=ind+n_left, i_stop=ind+n_right, signal_type='processed')
+        np.testing.assert_array_equal(waveforms[i], sigs)
+    
+    # next normal run clear the recompute mode
+    dataio.reset_processed_signals(seg_num=0, chan_grp=0, dtype='float32')
+    assert '0' not in dataio.info['processed_signals_recompute']
+
+
 def open_PeelerWindow():
     dataio = DataIO(dirname='test_peeler')
     #~ dataio = DataIO(dirname='test_peeler2')
@@ -349,6 +582,249 @@ def open_PeelerWindow():
     app.exec_()
 
 
+def test_get_spikes_time_window():
+    dataio = DataIO(dirname='test_peeler')
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0).copy()
+    assert np.all(np.diff(spikes['index']) >= 0)
+    
+    for t_start, t_stop in [(None, 1000), (5000, 60000), (spikes['index'][3], spikes['index'][3] + 1), (10**9, None)]:
+        spikes_win = dataio.get_spikes(seg_num=0, chan_grp=0, t_start=t_start, t_stop=t_stop)
+        keep = np.ones(spikes.size, dtype='bool')
+        if t_start is not None:
+            keep &= spikes['index'] >= t_start
+        if t_stop is not None:
+            keep &= spikes['index'] < t_stop
+        np.testing.assert_array_equal(spikes_win['index'], spikes['index'][keep])
+
+
+def test_get_spikes_time_window_read_only():
+    dataio = DataIO(dirname='test_peeler')
+    arrays = dataio.arrays[0][0]
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0).copy()
+    
+    # folder without spikes_time_index (older version) : the index is not written by a query
+    arrays.detach_array('spikes_time_index', mmap_close=True)
+    os.remove(arrays._fname('spikes_time_index'))
+    dataio = DataIO(dirname='test_peeler')
+    arrays = dataio.arrays[0][0]
+    mtime = os.path.getmtime(arrays._fname('spikes'))
+    spikes_win = dataio.get_spikes(seg_num=0, chan_grp=0, t_start=5000, t_stop=60000)
+    keep = (spikes['index'] >= 5000) & (spikes['index'] < 60000)
+    np.testing.assert_array_equal(spikes_win['index'], spikes['index'][keep])
+    assert not arrays.has_key('spikes_time_index')
+    assert not os.path.exists(arrays._fname('spikes_time_index'))
+    assert os.path.getmtime(arrays._fname('spikes')) == mtime
+    
+    # unsorted spikes on disk : error instead of reordering the file
+    spikes_disk = dataio.get_spikes(seg_num=0, chan_grp=0)
+    spikes_disk[:] = spikes[::-1]
+    arrays.flush_array('spikes')
+    with pytest.raises(ValueError):
+        DataIO(dirname='test_peeler').get_spikes(seg_num=0, chan_grp=0, t_start=5000, t_stop=60000)
+    
+    # the write path sort and build the index
+    dataio.reset_spikes(seg_num=0, chan_grp=0, dtype=spikes.dtype)
+    dataio.append_spikes(seg_num=0, chan_grp=0, spikes=spikes[::-1])
+    dataio.flush_spikes(seg_num=0, chan_grp=0)
+    assert arrays.has_key('spikes_time_index')
+    np.testing.assert_array_equal(dataio.get_spikes(seg_num=0, chan_grp=0)['index'], spikes['index'])
+
+
+def test_peeler_online_loop_pipelined():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    chunksize = 1024
+    length = dataio.get_segment_length(0) // 4
+    
+    all_spikes = []
+    all_sigs = []
+    for processor_engine, pipelined in [(None, False), ('numpy_threads', False), ('numpy_threads', True)]:
+        peeler = Peeler(dataio)
+        peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=chunksize)
+        peeler.initialize_online_loop(sample_rate=dataio.sample_rate, nb_channel=dataio.nb_channel(0),
+                        source_dtype=dataio.source_dtype, geometry=dataio.get_geometry(chan_grp=0),
+                        processor_engine=processor_engine, pipelined=pipelined)
+        
+        spikes = []
+        sigs = {}
+        for pos in range(chunksize, length, chunksize):
+            sigs_chunk = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=pos-chunksize, i_stop=pos, signal_type='initial')
+            sig_index, preprocessed_chunk, total_spike, spikes_chunk = peeler.process_one_chunk(pos, sigs_chunk)
+            if sig_index is None:
+                assert pipelined
+                continue
+            sigs[sig_index] = preprocessed_chunk.copy()
+            spikes.append(spikes_chunk.copy())
+        all_spikes.append(np.concatenate(spikes))
+        all_sigs.append(sigs)
+    
+    # sharding channels do not change anything
+    np.testing.assert_array_equal(all_spikes[0]['index'], all_spikes[1]['index'])
+    np.testing.assert_array_equal(all_spikes[0]['cluster_label'], all_spikes[1]['cluster_label'])
+    
+    # pipelined is one chunk late : same signals and same spikes except the last chunk
+    for sig_index, preprocessed_chunk in all_sigs[2].items():
+        np.testing.assert_array_equal(all_sigs[0][sig_index], preprocessed_chunk)
+    last_index = max(all_sigs[2].keys())
+    keep = all_spikes[0]['index'] < last_index - 2 * chunksize
+    n = np.sum(keep)
+    assert n > 0
+    np.testing.assert_array_equal(all_spikes[0]['index'][:n], all_spikes[2]['index'][:n])
+    np.testing.assert_array_equal(all_spikes[0]['cluster_label'][:n], all_spikes[2]['cluster_label'][:n])
+
+
+def test_peeler_online_threads_release():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    chunksize = 1024
+    kargs = dict(sample_rate=dataio.sample_rate, nb_channel=dataio.nb_channel(0),
+                        source_dtype=dataio.source_dtype, geometry=dataio.get_geometry(chan_grp=0))
+    
+    def process_chunks(peeler, n, start=0):
+        # the stream continue from start (0 after initialize_online_loop)
+        for pos in range(start + chunksize, start + chunksize * (n + 1), chunksize):
+            sigs_chunk = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=pos-chunksize, i_stop=pos, signal_type='initial')
+            peeler.process_one_chunk(pos, sigs_chunk)
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=chunksize)
+    
+    # conservative default nb of threads, or the given one
+    peeler.initialize_online_loop(processor_engine='numpy_threads', pipelined=True, **kargs)
+    assert len(peeler.peeler_engine.signalpreprocessor.shard_slices) == min(2, dataio.nb_channel(0))
+    peeler.initialize_online_loop(processor_engine='numpy_threads', processor_n_jobs=3, pipelined=True, **kargs)
+    signalpreprocessor = peeler.peeler_engine.signalpreprocessor
+    assert len(signalpreprocessor.shard_slices) == min(3, dataio.nb_channel(0))
+    process_chunks(peeler, 3)
+    assert signalpreprocessor.executor is not None
+    assert peeler.preprocess_executor is not None
+    
+    # stop : threads are released and re-created if the loop continue
+    peeler.close_online_loop()
+    assert signalpreprocessor.executor is None
+    assert peeler.preprocess_executor is None
+    process_chunks(peeler, 2, start=3*chunksize)
+    assert signalpreprocessor.executor is not None
+    
+    # re-initialization : threads of the previous preprocessor are released
+    peeler.initialize_online_loop(processor_engine='numpy_threads', pipelined=False, **kargs)
+    assert signalpreprocessor.executor is None
+    assert peeler.preprocess_executor is None
+    
+    # hot-swap : threads of the previous engine are released
+    signalpreprocessor = peeler.peeler_engine.signalpreprocessor
+    process_chunks(peeler, 2)
+    prepared = peeler.prepare_online_engine(catalogue=catalogue, engine='geometrical',
+                                chunksize=chunksize, processor_engine='numpy_threads', **kargs)
+    peeler.swap_online_engine(prepared)
+    assert signalpreprocessor.executor is None
+    peeler.close_online_loop()
+
+
+def test_peeler_online_hot_swap():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    chunksize = 1024
+    length = dataio.get_segment_length(0) // 4
+    swap_pos = (length // chunksize // 2) * chunksize
+    kargs = dict(sample_rate=dataio.sample_rate, nb_channel=dataio.nb_channel(0),
+                        source_dtype=dataio.source_dtype, geometry=dataio.get_geometry(chan_grp=0))
+    
+    for processor_engine, pipelined in [(None, False), ('numpy_threads', True)]:
+        all_spikes = []
+        all_sigs = []
+        for with_swap in (False, True):
+            peeler = Peeler(dataio)
+            peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=chunksize)
+            peeler.initialize_online_loop(processor_engine=processor_engine, pipelined=pipelined, **kargs)
+            
+            spikes = []
+            sigs = {}
+            for pos in range(chunksize, length, chunksize):
+                if with_swap and pos == swap_pos:
+                    # same catalogue : the swap must be transparent
+                    prepared = peeler.prepare_online_engine(catalogue=catalogue, engine='geometrical',
+                                                chunksize=chunksize, processor_engine=processor_engine, **kargs)
+                    old_engine = peeler.peeler_engine
+                    report = peeler.swap_online_engine(prepared)
+                    assert peeler.peeler_engine is not old_engine
+                    assert report['filter_state_carried']
+                    assert report['fifo_carried'] > 0
+                sigs_chunk = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=pos-chunksize, i_stop=pos, signal_type='initial')
+                sig_index, preprocessed_chunk, total_spike, spikes_chunk = peeler.process_one_chunk(pos, sigs_chunk)
+                if sig_index is None:
+                    continue
+                sigs[sig_index] = preprocessed_chunk.copy()
+                spikes.append(spikes_chunk.copy())
+            all_spikes.append(np.concatenate(spikes))
+            all_sigs.append(sigs)
+        
+        assert all_sigs[0].keys() == all_sigs[1].keys()
+        for sig_index in all_sigs[0]:
+            np.testing.assert_array_equal(all_sigs[0][sig_index], all_sigs[1][sig_index])
+        np.testing.assert_array_equal(all_spikes[0]['index'], all_spikes[1]['index'])
+        np.testing.assert_array_equal(all_spikes[0]['cluster_label'], all_spikes[1]['cluster_label'])
+
+
+def test_peeler_telemetry():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    chunksize = 1024
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=chunksize)
+    peeler.run(progressbar=False, duration=10.)
+    
+    telemetry = peeler.chunk_telemetry[0]
+    length = int(10. * dataio.sample_rate)
+    assert telemetry.size == length // chunksize
+    assert np.all(np.diff(telemetry['pos']) == chunksize)
+    for stage in ('preprocess', 'detect', 'classify', 'reset'):
+        assert np.all(telemetry[stage] >= 0)
+        assert np.all(telemetry[stage] <= telemetry['total'])
+    assert np.all(telemetry['n_level'] >= 1)
+    
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    assert np.sum(telemetry['n_spike']) <= spikes.size
+    
+    summary = peeler.get_telemetry_summary()
+    print(summary)
+    assert summary['nb_chunk'] == telemetry.size
+    assert summary['chunk_duration'] == chunksize / dataio.sample_rate
+    
+    # alarm when the processing time reach the budget
+    summary = peeler.get_telemetry_summary(alarm_ratio=0.)
+    assert summary['alarm']
+    assert summary['nb_chunk_alarm'] == telemetry.size
+    summary = peeler.get_telemetry_summary(alarm_ratio=1e9)
+    assert not summary['alarm']
+    
+    # parallel runs give the same chunks
+    for parallel_mode in ('block', 'segment'):
+        peeler.run(progressbar=False, duration=10., n_jobs=2, parallel_mode=parallel_mode)
+        telemetry_parallel = peeler.chunk_telemetry[0]
+        np.testing.assert_array_equal(telemetry_parallel['pos'], telemetry['pos'])
+        summary = peeler.get_telemetry_summary()
+        assert summary['nb_chunk'] == telemetry.size
+    
+    # pipelined online loop : preprocessing is done in the background thread
+    peeler = Peeler(dataio)
+    peeler.change_params(engine='geometrical', catalogue=catalogue, chunksize=chunksize)
+    peeler.initialize_online_loop(sample_rate=dataio.sample_rate, nb_channel=dataio.nb_channel(0),
+                    source_dtype=dataio.source_dtype, geometry=dataio.get_geometry(chan_grp=0), pipelined=True)
+    preprocess = []
+    for pos in range(chunksize, chunksize * 20, chunksize):
+        sigs_chunk = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=pos-chunksize, i_stop=pos, signal_type='initial')
+        sig_index, preprocessed_chunk, total_spike, spikes = peeler.process_one_chunk(pos, sigs_chunk)
+        if sig_index is None:
+            continue
+        tel = peeler.peeler_engine.get_chunk_telemetry()
+        preprocess.append(tel['preprocess'][0])
+        assert tel['budget_ratio'][0] >= tel['preprocess'][0] * dataio.sample_rate / chunksize
+    assert np.all(np.array(preprocess) > 0)
+    peeler.close_online_loop()
+
+
 def test_export_spikes():
     dataio = DataIO(dirname='test_peeler')
     dataio.export_spikes()
@@ -429,8 +905,14 @@ if __name__ =='__main__':
     
     #~ test_peeler_classic()
     
+    #~ test_peeler_classic_batch()
+    
     #~ test_peeler_geometry()
     
+    #~ test_peeler_geometry_xcorr()
+    
+    #~ test_peeler_geometry_channel_without_cluster()
+    
     #~ test_peeler_geometry_cl()
     
     
@@ -442,6 +924,19 @@ if __name__ =='__main__':
     
     test_peeler_with_and_without_preprocessor()
     
+    #~ test_peeler_without_saving_processed_signals()
+    
+    #~ test_get_spikes_time_window()
+    #~ test_get_spikes_time_window_read_only()
+    
+    #~ test_peeler_online_loop_pipelined()
+    
+    #~ test_peeler_online_threads_release()
+    
+    #~ test_peeler_online_hot_swap()
+    
+    #~ test_peeler_telemetry()
+    
     #~ test_export_spikes()
     
     
@@ -1,7 +1,8 @@
 from tridesclous import get_dataset
 from tridesclous.signalpreprocessor import signalpreprocessor_engines, offline_signal_preprocessor
 
-from tridesclous.signalpreprocessor import HAVE_PYOPENCL
+from tridesclous.signalpreprocessor import HAVE_PYOPENCL, HAVE_NUMBA
+from tridesclous.signalpreprocessor import remove_common_ref, make_common_ref_groups
 
 import time
 
@@ -290,10 +291,89 @@ def test_smooth_with_filtfilt():
     
 
 
+
+def test_remove_common_ref():
+    rng = np.random.RandomState(42)
+    geometry = np.zeros((12, 2))
+    geometry[:, 0] = [0, 0, 20, 20, 250, 250, 270, 270, 500, 500, 520, 520]
+    geometry[:, 1] = np.arange(12) * 20.
+    groups = make_common_ref_groups(geometry)
+    assert groups == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11]]
+    
+    engines = ['numpy']
+    if HAVE_NUMBA:
+        engines.append('numba')
+    
+    # odd and even number of channels and a shank with ties
+    for nb_channel in (7, 12):
+        sigs = rng.randn(5000, nb_channel).astype('float32')
+        sigs[:, 3] = sigs[:, 2]
+        for mode in ('median', 'mean'):
+            for grps in (None, [[0, 1, 2], [3, 4, 5, 6]]):
+                if mode == 'median':
+                    func = np.median
+                else:
+                    func = np.mean
+                expected = sigs.copy()
+                if grps is None:
+                    expected -= func(sigs, axis=1)[:, None]
+                else:
+                    for group in grps:
+                        expected[:, group] -= func(sigs[:, group], axis=1)[:, None]
+                
+                for engine in engines:
+                    data = sigs.copy()
+                    remove_common_ref(data, mode=mode, groups=grps, engine=engine)
+                    assert np.max(np.abs(data - expected)) < 1e-5, (nb_channel, mode, grps, engine)
+    
+    # offline with groups
+    sigs = rng.randn(10000, 12).astype('float32')
+    params = dict(common_ref_removal=True, common_ref_mode='mean', common_ref_groups=groups,
+                        highpass_freq=300., normalize=False)
+    processed = offline_signal_preprocessor(sigs, 10000., **params)
+    for group in groups:
+        assert np.max(np.abs(np.mean(processed[:, group], axis=1))) < 1e-4
+
+
+def test_backward_modes():
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    sigs = sigs[:sigs.shape[0]//4, :]
+    
+    params = {
+                'common_ref_removal' : False,
+                'highpass_freq': 300.,
+                'lowpass_freq': 4000.,
+                'smooth_size':0,
+                'output_dtype': 'float32',
+                'normalize' : True,
+                'lostfront_chunksize': None,
+                }
+    offline_sig = offline_signal_preprocessor(sigs, sample_rate, **params)
+    
+    # small chunksize : the lostfront margin is larger than the chunk
+    for chunksize in (64, 1024):
+        online_sigs = {}
+        for backward_mode in ('full', 'projection'):
+            online_sigs[backward_mode] = run_online('numpy', sigs, sample_rate, chunksize, backward_mode=backward_mode, **params)
+        
+        # same result than the full backward filter
+        assert online_sigs['full'].shape == online_sigs['projection'].shape
+        residual = np.abs(online_sigs['full'].astype('float64') - online_sigs['projection'].astype('float64'))
+        assert np.max(residual) < 1e-3
+        
+        # and the same accuracy against offline
+        online_sig = online_sigs['projection']
+        min_size = online_sig.shape[0]
+        residual = np.abs(online_sig[chunksize:min_size].astype('float64')-offline_sig[chunksize:min_size].astype('float64'))
+        residual_normed = residual/np.mean(np.abs(offline_sig[chunksize:min_size].astype('float64')))
+        assert np.max(residual_normed)<0.05, 'online differt from offline more than 5%'
+
     
 if __name__ == '__main__':
     #~ test_compare_offline_online_engines()
     #~ test_smooth_with_filtfilt()
+    #~ test_remove_common_ref()
+    #~ test_backward_modes()
     
     explore_lostfront_chunksize()
     
@@ -10,6 +10,15 @@ def test_get_median_mad():
     pass
     
 
+def test_median_mad_approx():
+    data = np.random.randn(20000, 30, 4).astype('float32') * 3. + np.arange(4)
+    med, mad = median_mad(data, axis=0)
+    blocks = (data[i:i+1000] for i in range(0, data.shape[0], 1000))
+    med2, mad2 = median_mad_approx(blocks, nbins=1000)
+    assert med2.shape == med.shape
+    assert np.max(np.abs(med - med2)) < 0.05
+    assert np.max(np.abs(mad - mad2)) < 0.05
+
 def test_FifoBuffer():
     n = 5
     fifo = FifoBuffer((1024+64, n), dtype='int16')
@@ -89,6 +98,7 @@ def test_rgba_to_int32():
 
 if __name__ == '__main__':
     #~ test_get_median_mad()
+    #~ test_median_mad_approx()
     #~ test_FifoBuffer()
     #~ test_get_neighborhood()
     #~ test_fix_prb_file_py2()
@@ -1,8 +1,11 @@
 import numpy as np
 import time
+import os
+import shutil
 
 
 from tridesclous.waveformtools import extract_chunks
+from tridesclous.iotools import CompressedChunkedArray
 
 #~ size = 1000000
 size = 1000
@@ -54,13 +57,75 @@ def test_extract_chunks_with_channel_indexes():
     print('extract_chunks channel_indexes', t1-t0)
 
 
+def test_extract_chunks_engines():
+    signals = np.random.randn(size, nb_channel).astype('float32')
+    indexes = np.random.randint(low=-width, high=size, size=nb_peak)
+    keep = (indexes>=0) & (indexes<(size - width))
+    n = np.sum(keep)
+    peak_channel_indexes = np.random.randint(low=0, high=nb_channel, size=nb_peak)
+    channel_adjacency = {c: np.array([cc for cc in range(nb_channel) if abs(cc - c) <=1]) for c in range(nb_channel)}
+    
+    # reference with a loop
+    ref = np.zeros((n, width, nb_channel), dtype='float32')
+    ref_sparse = np.zeros((n, width, nb_channel), dtype='float32')
+    for i, (ind, chan) in enumerate(zip(indexes[keep], peak_channel_indexes[keep])):
+        ref[i] = signals[ind:ind+width, :]
+        chans = channel_adjacency[chan]
+        ref_sparse[i][:, chans] = signals[ind:ind+width, chans]
+    
+    for engine in ('numpy', 'numba'):
+        chunks = np.zeros((nb_peak, width, nb_channel), dtype='float32')
+        t0 = time.perf_counter()
+        extract_chunks(signals, indexes, width, chunks=chunks, engine=engine)
+        t1 = time.perf_counter()
+        print('extract_chunks', engine, t1-t0)
+        np.testing.assert_array_equal(chunks[:n], ref)
+        
+        chunks = extract_chunks(signals, indexes, width, channel_indexes=[0,2,3], engine=engine)
+        np.testing.assert_array_equal(chunks[:n], ref[:, :, [0,2,3]])
+        
+        chunks = np.zeros((nb_peak, width, nb_channel), dtype='float32')
+        extract_chunks(signals, indexes, width, channel_adjacency=channel_adjacency,
+                    peak_channel_indexes=peak_channel_indexes, chunks=chunks, engine=engine)
+        np.testing.assert_array_equal(chunks[:n], ref_sparse)
+
+
+    
 
+def test_extract_chunks_compressed(monkeypatch):
+    if os.path.exists('test_extract_wf_compressed'):
+        shutil.rmtree('test_extract_wf_compressed')
+    os.mkdir('test_extract_wf_compressed')
     
+    signals = np.random.randn(size * 10, nb_channel).astype('float32')
+    indexes = np.random.randint(low=0, high=size*10-width, size=500)
+    filename = os.path.join('test_extract_wf_compressed', 'sigs.raw')
+    arr = CompressedChunkedArray(filename, signals.shape, 'float32', chunksize=1024, codec='zlib', mode='w+')
+    arr[:, :] = signals
+    arr.flush()
+    
+    ref = extract_chunks(signals, indexes, width, engine='numpy')
+    
+    # the whole segment must not be decoded
+    def no_full_decode(self, dtype=None):
+        raise AssertionError('full decode')
+    monkeypatch.setattr(CompressedChunkedArray, '__array__', no_full_decode)
+    
+    for engine in (None, 'numba', 'numpy'):
+        chunks = extract_chunks(arr, indexes, width, engine=engine)
+        np.testing.assert_array_equal(chunks, ref)
+    
+    arr.close()
+    shutil.rmtree('test_extract_wf_compressed')
+
 
+    
 if __name__ == '__main__':
     test_extract_chunks_memory()
     test_extract_chunks_memmap()
     test_extract_chunks_with_channel_indexes()
+    test_extract_chunks_engines()
+    #~ test_extract_chunks_compressed()
     
     
     
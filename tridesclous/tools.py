@@ -29,6 +29,92 @@ def median_mad(data, axis=0):
     return med, mad
 
 
+def median_mad_approx(blocks, nbins=1000, value_range=None):
+    """
+    Bounded memory approximation of median_mad(data, axis=0) when data
+    is given by blocks along axis 0 (for instance waveforms of a big cluster).
+    
+    One histogram per element is accumulated (nbins x element), then median and mad
+    are read on the cumulative histogram with linear interpolation inside bins.
+    Precision is about (value_range[1]-value_range[0])/nbins.
+    
+    Arguments
+    ----------------
+    blocks : iterable of np.ndarray
+        all with the same shape except axis 0.
+    nbins: int
+        number of bins of histograms.
+    value_range: tuple or None
+        (min, max) of histograms. If None, this is estimated on the first block
+        with a margin. Values outside are put in edge bins.
+        min and max can also be arrays (one range per element, shape of block.shape[1:]).
+    
+    Returns
+    -----------
+    med: np.ndarray
+    mad: np.ndarray
+    """
+    counts = None
+    for block in blocks:
+        block = np.asarray(block)
+        if block.shape[0] == 0:
+            continue
+        if counts is None:
+            shape = block.shape[1:]
+            n_el = int(np.prod(shape))
+            if value_range is None:
+                lo, hi = float(np.min(block)), float(np.max(block))
+                margin = max(hi - lo, 1e-6) * 0.5
+                value_range = (lo - margin, hi + margin)
+            lo, hi = value_range
+            lo = np.broadcast_to(np.asarray(lo, dtype='float64').ravel(), (n_el, ))
+            hi = np.broadcast_to(np.asarray(hi, dtype='float64').ravel(), (n_el, ))
+            step = (hi - lo) / nbins
+            counts = np.zeros(nbins * n_el, dtype='int64')
+            el_index = np.arange(n_el)
+        
+        flat = block.reshape(block.shape[0], n_el)
+        bins = np.floor((flat - lo) / step).astype('int64')
+        np.clip(bins, 0, nbins-1, out=bins)
+        counts += np.bincount((bins * n_el + el_index[None, :]).ravel(), minlength=nbins * n_el)
+    
+    assert counts is not None, 'median_mad_approx need at least one non empty block'
+    counts = counts.reshape(nbins, n_el)
+    cdf = np.zeros((nbins + 1, n_el), dtype='float64')
+    cdf[1:] = np.cumsum(counts, axis=0)
+    cdf /= cdf[-1:, :]
+    
+    def cdf_at(x):
+        # linear interpolation of the cdf at x (one value per element)
+        pos = np.clip((x - lo) / step, 0, nbins)
+        i = np.minimum(np.floor(pos).astype('int64'), nbins - 1)
+        frac = pos - i
+        return cdf[i, el_index] * (1 - frac) + cdf[i + 1, el_index] * frac
+    
+    def inverse_cdf(q):
+        i = np.argmax(cdf >= q, axis=0)
+        i = np.maximum(i, 1)
+        c0, c1 = cdf[i-1, el_index], cdf[i, el_index]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(c1 > c0, (q - c0) / (c1 - c0), 0.)
+        return lo + (i - 1 + frac) * step
+    
+    med = inverse_cdf(0.5)
+    
+    # mad : smallest d such that mass in [med-d, med+d] is 0.5, by bisection
+    d_lo = np.zeros(n_el)
+    d_hi = np.full(n_el, hi - lo)
+    for _ in range(int(np.ceil(np.log2(nbins))) + 4):
+        d = (d_lo + d_hi) / 2
+        inside = cdf_at(med + d) - cdf_at(med - d)
+        over = inside >= 0.5
+        d_hi = np.where(over, d, d_hi)
+        d_lo = np.where(over, d_lo, d)
+    mad = (d_lo + d_hi) / 2 * 1.4826
+    
+    return med.reshape(shape).astype(block.dtype), mad.reshape(shape).astype(block.dtype)
+
+
 def get_pairs_over_threshold(m, labels, threshold):
     """
     detect pairs over threhold in a similarity matrice
@@ -86,6 +172,54 @@ class FifoBuffer:
         self.buffer[:] = 0
 
 
+def run_units_in_parallel(func, units_args, n_jobs=-1, progressbar=True, desc=None, callback=None):
+    """
+    Simple scheduler that run func(*args) for independent units
+    (typically one (chan_grp, seg_num) pair) in a pool of worker processes.
+    
+    params
+    -----
+    func: a function at module level (must be pickable)
+    units_args: list of tuple of arguments, one per unit
+    n_jobs: nb of worker process, -1 is all cores
+    progressbar: display a tqdm progressbar updated each time a unit is done
+    desc: label of the progressbar
+    callback: None or callback(i, result) called in the calling thread as soon as
+        the unit i is done (units finish in any order)
+    
+    returns
+    ----
+    
+    results: list of results in the same order than units_args
+    
+    """
+    from concurrent.futures import as_completed
+    from joblib import cpu_count
+    from joblib.executor import get_memmapping_executor
+    from tqdm import tqdm
+    
+    if n_jobs < 0:
+        n_jobs = max(1, cpu_count() + 1 + n_jobs)
+    n_jobs = max(1, min(n_jobs, len(units_args)))
+    
+    # same reusable loky executor as joblib.Parallel(backend='loky')
+    # so both can be used in the same process
+    executor = get_memmapping_executor(n_jobs)
+    futures = {executor.submit(func, *args): i for i, args in enumerate(units_args)}
+    
+    results = [None] * len(units_args)
+    iterator = as_completed(futures)
+    if progressbar:
+        iterator = tqdm(iterable=iterator, total=len(units_args), desc=desc)
+    for future in iterator:
+        i = futures[future]
+        results[i] = future.result()
+        if callback is not None:
+            callback(i, results[i])
+    
+    return results
+
+
 def get_neighborhood(geometry, radius_um):
     """
     get neighborhood given geometry array and radius
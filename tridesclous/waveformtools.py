@@ -1,13 +1,19 @@
 import numpy as np
 import joblib
 
-
+try:
+    import numba
+    HAVE_NUMBA = True
+    from .numba_tools import numba_extract_chunks, numba_extract_chunks_channels, numba_extract_chunks_sparse
+    from .numba_tools import numba_equal_template_pairs
+except ImportError:
+    HAVE_NUMBA = False
 
 
 
 def extract_chunks(signals, left_sample_indexes, width, 
                 channel_indexes=None, channel_adjacency=None, 
-                peak_channel_indexes=None, chunks=None):
+                peak_channel_indexes=None, chunks=None, engine=None):
     """
     This cut small chunks on signals and return concatenate them.
     This use numpy.array for input/output.
@@ -31,6 +37,11 @@ def extract_chunks(signals, left_sample_indexes, width,
         must be None.
     peak_channel_indexes: np.array None
         Position of the peak on channel space used only when channel_adjacency not None.
+    chunks: np.ndarray or None
+        Output buffer (can be a memmap). Allocated if None.
+    engine: 'numba' or 'numpy' or None
+        None is numba when available. 'numba' is parallel across peaks,
+        'numpy' copy by block of peaks with a fancy index.
         
     Returns
     -----------
@@ -42,32 +53,67 @@ def extract_chunks(signals, left_sample_indexes, width,
         assert channel_indexes is None
         assert peak_channel_indexes is not None, 'For sparse eaxtraction peak_channel_indexes must be provide'
     
+    if engine is None:
+        engine = 'numba' if HAVE_NUMBA else 'numpy'
+    
+    if engine == 'numba' and not isinstance(signals, np.ndarray):
+        # for instance CompressedChunkedArray : np.asarray() would decode the whole segment
+        # the numpy engine only read the chunks that cover the peaks, block by block
+        engine = 'numpy'
+    
     if chunks is None:
         if channel_indexes is None:
             chunks = np.empty((left_sample_indexes.size, width, signals.shape[1]), dtype = signals.dtype)
         else:
             chunks = np.empty((left_sample_indexes.size, width, len(channel_indexes)), dtype = signals.dtype)
-        
+    
+    left_sample_indexes = np.asarray(left_sample_indexes)
     keep = (left_sample_indexes>=0) & (left_sample_indexes<(signals.shape[0] - width))
-    left_sample_indexes2 = left_sample_indexes[keep]
+    left_sample_indexes2 = left_sample_indexes[keep].astype('int64')
     if peak_channel_indexes is not None:
-        peak_channel_indexes2 = peak_channel_indexes[keep]
-    
-    if channel_indexes is None and channel_adjacency is None:
-        # all channels
-        for i, ind in enumerate(left_sample_indexes2):
-            chunks[i,:,:] = signals[ind:ind+width,:]
-    elif channel_indexes is not None:
-        for i, ind in enumerate(left_sample_indexes2):
-            chunks[i,:,:] = signals[ind:ind+width,:][:, channel_indexes]
-            
-    elif channel_adjacency is not None:
-        # sparse
-        assert peak_channel_indexes is not None
-        for i, ind in enumerate(left_sample_indexes2):
-            chan = peak_channel_indexes2[i]
-            chans = channel_adjacency[chan]
-            chunks[i,:,:][:, chans] = signals[ind:ind+width,:][:, chans]
+        peak_channel_indexes2 = np.asarray(peak_channel_indexes)[keep].astype('int64')
+    
+    if left_sample_indexes2.size == 0:
+        return chunks
+    
+    if channel_adjacency is not None:
+        # sparse : dict to boolean mask
+        nb_chan = signals.shape[1]
+        adjacency_mask = np.zeros((nb_chan, nb_chan), dtype='bool')
+        for chan, chans in channel_adjacency.items():
+            adjacency_mask[chan, chans] = True
+    
+    if engine == 'numba':
+        assert HAVE_NUMBA, 'You must install numba'
+        # signals is a ndarray or a memmap here : np.asarray is a plain view (no copy) that numba accept
+        sigs = np.asarray(signals)
+        out = np.asarray(chunks)
+        if channel_indexes is None and channel_adjacency is None:
+            numba_extract_chunks(sigs, left_sample_indexes2, width, out)
+        elif channel_indexes is not None:
+            channel_indexes = np.asarray(channel_indexes, dtype='int64')
+            numba_extract_chunks_channels(sigs, left_sample_indexes2, width, channel_indexes, out)
+        else:
+            numba_extract_chunks_sparse(sigs, left_sample_indexes2, width, peak_channel_indexes2, adjacency_mask, out)
+    
+    elif engine == 'numpy':
+        # block of peaks to bound the temporary from fancy indexing
+        block_size = 1024
+        offsets = np.arange(width)
+        for i0 in range(0, left_sample_indexes2.size, block_size):
+            i1 = min(i0 + block_size, left_sample_indexes2.size)
+            sample_indexes = left_sample_indexes2[i0:i1, None] + offsets[None, :]
+            if channel_indexes is None and channel_adjacency is None:
+                chunks[i0:i1, :, :] = signals[sample_indexes.flatten(), :].reshape(i1-i0, width, -1)
+            elif channel_indexes is not None:
+                chunks[i0:i1, :, :] = signals[sample_indexes.flatten(), :][:, channel_indexes].reshape(i1-i0, width, -1)
+            else:
+                wfs = signals[sample_indexes.flatten(), :].reshape(i1-i0, width, -1)
+                mask = adjacency_mask[peak_channel_indexes2[i0:i1], :]
+                # slice is a view so this write in chunks
+                np.copyto(chunks[i0:i1, :, :], wfs, where=mask[:, None, :])
+    else:
+        raise(NotImplementedError)
 
     return chunks
 
@@ -107,3 +153,53 @@ def equal_template(centroid0, centroid1, thresh=2.0, n_shift = 2):
             break
     
     return equal
+
+
+def equal_template_pairs(centroids, pair_inds, thresholds, n_shift=2, engine=None, block_size=256):
+    """
+    Vectorized version of equal_template for many pairs of centroids.
+    
+    Arguments
+    ---------------
+    centroids: np.ndarray
+        shape (nb_centroid, width, nb_channel)
+    pair_inds: np.ndarray
+        shape (nb_pair, 2) index in centroids of each pair
+    thresholds: np.ndarray
+        shape (nb_pair, ) thresh for each pair
+    n_shift: int
+        maximum shift
+    engine: None or 'numpy' or 'numba'
+        None is numba when available.
+    block_size: int
+        number of pairs computed at once with numpy to limit memory.
+    
+    Returns
+    -----------
+    equal: np.ndarray bool shape (nb_pair, )
+    """
+    if engine is None:
+        engine = 'numba' if HAVE_NUMBA else 'numpy'
+    
+    pair_inds = np.asarray(pair_inds, dtype='int64').reshape(-1, 2)
+    thresholds = np.asarray(thresholds, dtype=centroids.dtype)
+    equal = np.zeros(pair_inds.shape[0], dtype='bool')
+    if pair_inds.shape[0] == 0:
+        return equal
+    
+    if engine == 'numba':
+        centroids = np.ascontiguousarray(centroids)
+        numba_equal_template_pairs(centroids, pair_inds, thresholds, n_shift, equal)
+    elif engine == 'numpy':
+        width = centroids.shape[1] - 2 * n_shift
+        for b0 in range(0, pair_inds.shape[0], block_size):
+            b1 = min(b0 + block_size, pair_inds.shape[0])
+            wf0 = centroids[pair_inds[b0:b1, 0], n_shift:n_shift+width, :]
+            c1 = centroids[pair_inds[b0:b1, 1], :, :]
+            for shift in range(n_shift*2+1):
+                d = np.max(np.abs(c1[:, shift:shift+width, :] - wf0), axis=(1, 2))
+                equal[b0:b1] |= d < thresholds[b0:b1]
+    else:
+        raise(NotImplementedError)
+    
+    return equal